@@ -20,12 +20,15 @@ const Chatbot = (props) => {
     const [requestNarratedResponses, setRequestNarratedResponses] = useState(false);
 
     const submitTextPrompt = async () => {
-        setMessages(prevMessages => [...prevMessages, {text: message, type: 'user'}]);
+        setMessages(prevMessages => [...prevMessages, {text: message, type: 'user'}, {text: "", type: 'system'}]);
         setMessage("");
-        await IOService.postTextPrompt({message, requestNarratedResponses})
-            .then((response) => {
-                setMessages(prevMessages => [...prevMessages, {text: response.text, type: 'system'}]);
-            })
+
+        // Render the reply as it streams in by rewriting the trailing system bubble
+        const updateReply = (text) => {
+            setMessages(prevMessages => [...prevMessages.slice(0, -1), {text, type: 'system'}]);
+        };
+        await IOService.postTextPromptStream({message, requestNarratedResponses}, updateReply)
+            .then((response) => updateReply(response.text));
     }
 
     return (
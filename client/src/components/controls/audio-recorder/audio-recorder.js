@@ -8,6 +8,7 @@ const AudioRecorder = (props) => {
     const [recording, setRecording] = useState(false);
     const mediaRecorderRef = useRef(null);
     const audioChunksRef = useRef([]);
+    const audioStreamRef = useRef(null);
 
     const toggleRecording = async () => {
         if (!navigator.mediaDevices.getUserMedia) {
@@ -17,23 +18,24 @@ const AudioRecorder = (props) => {
         } else {
             setRecording((prevRecording) => !prevRecording);
             if (recording) {
-                const blob = await IOService.stopRecordingAudio(mediaRecorderRef, audioChunksRef);
-                await IOService.postAudioPrompt(blob,
-                    {
-                        mode: props.mode,
-                        requestNarratedResponses: props.requestNarratedResponses
-                    }).then((response) => {
-                        props.setMessagesRef(
-                            prevMessages => [
-                                ...prevMessages,
-                                {
-                                    text: response.text,
-                                    transcription: response.transcription,
-                                    type: 'bot'
-                                }]);
-                    });
+                // Most of the recording has already been transcribed while it was streamed
+                await IOService.stopRecordingAudio(mediaRecorderRef, audioChunksRef);
+                await audioStreamRef.current.finish().then((response) => {
+                    props.setMessagesRef(
+                        prevMessages => [
+                            ...prevMessages,
+                            {
+                                text: response.text,
+                                transcription: response.transcription,
+                                type: 'bot'
+                            }]);
+                });
             } else {
-                await IOService.startRecordingAudio(audioChunksRef, mediaRecorderRef);
+                audioStreamRef.current = await IOService.openAudioPromptStream({
+                    mode: props.mode,
+                    requestNarratedResponses: props.requestNarratedResponses
+                });
+                await IOService.startRecordingAudio(audioChunksRef, mediaRecorderRef, audioStreamRef.current.send);
             }
         }
     }
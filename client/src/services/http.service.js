@@ -4,25 +4,71 @@ const defaultHeaders = {};
 const post = async (props) => {
     const requestUrl = buildRequestUrl(props);
 
-    let headers = props.headers || defaultHeaders;
-    let body = props.body || null;
+    const response = await fetch(requestUrl, {
+        method: "POST",
+        body: buildRequestBody(props),
+        headers: props.headers || defaultHeaders,
+    });
+    return await response.json();
+};
+
+// POSTs a request whose response is a Server-Sent Event stream, calling onEvent({event, data}) per event
+const postStream = async (props, onEvent) => {
+    const requestUrl = buildRequestUrl(props);
+
+    const response = await fetch(requestUrl, {
+        method: "POST",
+        body: buildRequestBody(props),
+        headers: props.headers || defaultHeaders,
+    });
 
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary = buffer.indexOf("\n\n");
+        while (boundary !== -1) {
+            onEvent(parseServerSentEvent(buffer.slice(0, boundary)));
+            buffer = buffer.slice(boundary + 2);
+            boundary = buffer.indexOf("\n\n");
+        }
+    }
+};
+
+const buildRequestBody = (props) => {
     if (props.formData) {
         const formData = new FormData();
         Object.entries(props.formData).forEach(([key, value]) => {
             formData.append(key, value);
         });
-        body = formData;
+        return formData;
     }
+    return props.body || null;
+};
 
-    const response = await fetch(requestUrl, {
-        method: "POST",
-        body: body,
-        headers: headers,
+const parseServerSentEvent = (raw) => {
+    let event = "message";
+    let data = "";
+    raw.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+            data += line.slice(5).trim();
+        }
     });
-    return await response.json();
+    return { event, data: data ? JSON.parse(data) : {} };
 };
 
+// Resolves a path returned by the server, e.g. a narration's audio_url, against the server's address
+const resolveUrl = (path) => `${baseUrl}${path}`;
+
 const buildRequestUrl = (props) => {
     const params = props.params
         ? `?${new URLSearchParams(props.params).toString()}`
@@ -31,5 +77,7 @@ const buildRequestUrl = (props) => {
 };
 
 export const HTTPService = {
-    post
+    post,
+    postStream,
+    resolveUrl
 };
\ No newline at end of file
@@ -1,10 +1,30 @@
 import { HTTPService } from "./http.service";
 
+// Identifies this page's conversation to the server, which keeps a separate history per session
+const sessionId = crypto.randomUUID();
+
+// Narration is fetched as binary from a short-lived URL rather than inlined as base64, as Opus where the browser can play it
+const audioParams = {
+    "audioTransport": "url",
+    "audioCodec": new Audio().canPlayType('audio/ogg; codecs=opus') ? "opus" : "wav"
+};
+
+// The playable URL of a response's audio: the server's audio_url, or an object URL of inline base64 audio or a blob
+const getAudioUrl = (data, key = "audio") => {
+    if (data.audio_url) {
+        return HTTPService.resolveUrl(data.audio_url);
+    }
+    const blob = data.blob
+        ? data.blob
+        : new Blob([Uint8Array.from(atob(data[key]), c => c.charCodeAt(0))], { type: data.audio_type || "audio/wav" });
+    return URL.createObjectURL(blob);
+};
+
+const hasAudio = (data, key = "audio") => Boolean(data.audio_url || data.blob || data[key]);
+
 const handleAudioPlayback = async (data) => {
     const df = document.createDocumentFragment();
-    const blob = data.blob ? data.blob : new Blob([Uint8Array.from(atob(data.audio), c => c.charCodeAt(0))]);
-    const url = URL.createObjectURL(blob);
-    const audio = new Audio(url);
+    const audio = new Audio(getAudioUrl(data));
 
     df.appendChild(audio); // keep in fragment until finished playing
     audio.addEventListener("ended", function () {
@@ -14,19 +34,47 @@ const handleAudioPlayback = async (data) => {
     return audio;
 };
 
+// Returns play(chunk), which plays narration chunk events back to back in the order they arrive.
+// Each chunk is loaded as soon as it arrives so it is ready to start when the previous one ends.
+const createAudioQueue = () => {
+    let previous = Promise.resolve();
+    return (chunk) => {
+        const url = getAudioUrl(chunk, "audio_chunk");
+        const audio = new Audio(url);
+        audio.preload = "auto";
+
+        previous = previous.then(() => new Promise((resolve) => {
+            const done = () => {
+                if (url.startsWith("blob:")) {
+                    URL.revokeObjectURL(url);
+                }
+                resolve();
+            };
+            audio.addEventListener("ended", done, { once: true });
+            audio.play().catch(error => {
+                console.error('Error playing audio:', error);
+                done();
+            });
+        }));
+        return previous;
+    };
+};
+
 const postTextPrompt = async (props) => {
     const response = await HTTPService.post({
         endpoint: 'api/v1/tts',
         params: {
             "narrateResponse": props.requestNarratedResponses || false,
-            "mode": props.mode || "question"
+            "mode": props.mode || "question",
+            "sessionId": sessionId,
+            ...audioParams
         },
         formData: {
             "userMessage": props.message || ""
         }
     });
 
-    if (response.audio) {
+    if (hasAudio(response)) {
         await handleAudioPlayback(response);
     }
 
@@ -35,6 +83,49 @@ const postTextPrompt = async (props) => {
     };
 };
 
+// Streams the reply token by token, calling onToken(text) with the reply decoded so far.
+// Narration arrives as one audio chunk per sentence, and playback starts with the first chunk.
+const postTextPromptStream = async (props, onToken) => {
+    let reply = "";
+    let audio = null;
+    const playAudio = createAudioQueue();
+
+    await HTTPService.postStream({
+        endpoint: 'api/v1/tts',
+        params: {
+            "narrateResponse": props.requestNarratedResponses || false,
+            "mode": props.mode || "question",
+            "sessionId": sessionId,
+            "stream": true,
+            ...audioParams
+        },
+        formData: {
+            "userMessage": props.message || ""
+        }
+    }, ({ event, data }) => {
+        if (event === "done") {
+            reply = data.reply || reply;
+            audio = data.audio;
+        } else if (event === "audio") {
+            playAudio(data);
+            return;
+        } else if (event === "error") {
+            console.error("Error streaming reply:", data.error);
+        } else if (data.token) {
+            reply += data.token;
+        }
+        onToken(reply);
+    });
+
+    if (audio) {
+        await handleAudioPlayback({ audio });
+    }
+
+    return {
+        text: reply
+    };
+};
+
 const postAudioPrompt = async (blob, props) => {
     const response = await HTTPService.post({
         endpoint: "api/v1/asr",
@@ -44,11 +135,13 @@ const postAudioPrompt = async (blob, props) => {
         },
         params: {
             "narrateResponse": props.requestNarratedResponses || false,
-            "mode": props.mode || "question"
+            "mode": props.mode || "question",
+            "sessionId": sessionId,
+            ...audioParams
         }
     });
 
-    if (response.audio) {
+    if (hasAudio(response)) {
         await handleAudioPlayback(response);
     }
 
@@ -58,7 +151,55 @@ const postAudioPrompt = async (blob, props) => {
     }
 };
 
-const startRecordingAudio = async (audioChunksRef, mediaRecorderRef) => {
+// Opens a streaming transcription so a recording is transcribed while the user is still speaking.
+// send(blob) uploads the next recorded piece in order; finish() ends the stream and resolves like postAudioPrompt.
+const openAudioPromptStream = async (props) => {
+    const contentType = "audio/webm; codecs=opus";
+    const stream = await HTTPService.post({
+        endpoint: "api/v1/asr/stream",
+        headers: {
+            "Content-Type": contentType
+        },
+        params: {
+            "narrateResponse": props.requestNarratedResponses || false,
+            "mode": props.mode || "question",
+            "sessionId": sessionId,
+            ...audioParams
+        }
+    });
+
+    let pending = Promise.resolve();
+    const upload = (blob, params) => {
+        pending = pending.then(() => HTTPService.post({
+            endpoint: `api/v1/asr/stream/${stream.id}`,
+            body: blob,
+            headers: {
+                "Content-Type": contentType
+            },
+            params
+        }));
+        return pending;
+    };
+
+    const finish = async () => {
+        const response = await upload(new Blob([]), { "final": true });
+        if (hasAudio(response)) {
+            await handleAudioPlayback(response);
+        }
+
+        return {
+            text: response.reply || "",
+            transcription: response.transcription || "",
+        }
+    };
+
+    return {
+        send: (blob) => upload(blob),
+        finish
+    };
+};
+
+const startRecordingAudio = async (audioChunksRef, mediaRecorderRef, onChunk) => {
     return navigator.mediaDevices.getUserMedia({ audio: true }).then((stream) => {
         const defaultMimeType = 'audio/webm;codecs=opus';
         const mimeType = (
@@ -82,6 +223,9 @@ const startRecordingAudio = async (audioChunksRef, mediaRecorderRef) => {
         mediaRecorderRef.current.ondataavailable = (event) => {
             if (event.data.size > 0) {
                 audioChunksRef.current.push(event.data);
+                if (onChunk) {
+                    onChunk(event.data);
+                }
             }
         };
 
@@ -109,8 +253,10 @@ const stopRecordingAudio = (mediaRecorderRef, audioChunksRef) => {
 };
 
 export const IOService = {
+    openAudioPromptStream,
     postAudioPrompt,
     postTextPrompt,
+    postTextPromptStream,
     startRecordingAudio,
     stopRecordingAudio
 };
\ No newline at end of file
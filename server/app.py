@@ -1,49 +1,293 @@
-import os
+import functools
+import importlib
+import json
+import time
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 
 from services.env import EnvService, EnvVars
 
 from utils.logger import Logger, LogLevel
-from utils.nlp.agent import Agent
-from utils.nlp.trainer import Trainer
+from utils.metrics import METRICS, METRICS_CONTENT_TYPE
+from utils.startup import Startup
 
 DEBUG = EnvService.is_debug()
 ROUTE_ASR = EnvService.get(EnvVars.ROUTE_ASR.value, "/api/v1/asr")
-ROUTE_IS_ALIVE = EnvService.get(EnvVars.ROUTE_IS_ALIVE.value, "/api/v1/is_alive")
-ROUTE_TRAINING_INIT = EnvService.get(EnvVars.ROUTE_TRAINING_INIT.value, "/api/v1/training")
+ROUTE_IS_ALIVE = EnvService.get(
+    EnvVars.ROUTE_IS_ALIVE.value, "/api/v1/is_alive"
+)
+ROUTE_IS_READY = EnvService.get(
+    EnvVars.ROUTE_IS_READY.value, "/api/v1/is_ready"
+)
+ROUTE_METRICS = EnvService.get(EnvVars.ROUTE_METRICS.value, "/metrics")
+ROUTE_MODEL = EnvService.get(EnvVars.ROUTE_MODEL.value, "/api/v1/model")
+ROUTE_TRAINING_INIT = EnvService.get(
+    EnvVars.ROUTE_TRAINING_INIT.value, "/api/v1/training"
+)
 ROUTE_TTS = EnvService.get(EnvVars.ROUTE_TTS.value, "/api/v1/tts")
 SERVER_HOST = EnvService.get(EnvVars.SERVER_HOST.value, "0.0.0.0")
 SERVER_PORT = EnvService.get_int(EnvVars.SERVER_PORT.value, 1587)
 
+# The LLM instance and the background runner for dataset training jobs, both
+# built by start_server. Routes that use them answer 503 until startup is ready.
+agent = None
+training_jobs = None
+startup = Startup()
 
-# Initialize the LLM instance
-agent = Agent(DEBUG)
 
-# Initialize the dataset training module
-trainer = Trainer(model=agent.model, tokenizer=agent.tokenizer)
+def start_server():
+    """
+    The startup pipeline, run on a background thread so the server binds
+    straight away.
+    """
+    global agent, training_jobs
+
+    with startup.phase("imports"):
+        from utils.nlp.agent import Agent
+        from utils.nlp.jobs import TrainingJobRunner
+
+    loaded = startup.parallel(
+        {
+            "agent": lambda: Agent(DEBUG, startup),
+            "trainer_imports": lambda: importlib.import_module(
+                "utils.nlp.trainer"
+            ),
+        }
+    )
+    agent = loaded["agent"]
+    with startup.phase("warmup"):
+        agent.warm_up()
+    training_jobs = TrainingJobRunner(on_complete=handle_training_job_complete)
+
+
+# Hot swaps newly trained models in when requested
+def handle_training_job_complete(job):
+    from utils.nlp.trainer import TrainingRequestOpts
+
+    if job.options.get(TrainingRequestOpts.HOT_SWAP.value) and job.output_dir:
+        agent.reload_model(job.output_dir)
+
+
+def requires_startup(route):
+    """
+    Answers 503 with the startup report until the startup pipeline has finished.
+    """
+
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if not startup.is_ready():
+            return (
+                jsonify(
+                    {
+                        "error": "Server is starting.",
+                        "startup": startup.to_dict(),
+                    }
+                ),
+                503,
+            )
+        return route(*args, **kwargs)
+
+    return wrapper
+
+
+def model_memory() -> dict | None:
+    if agent is None:
+        return None
+    from utils.nlp.registry import MODEL_REGISTRY
+
+    return {
+        (entry["key"],): entry["size_bytes"]
+        for entry in MODEL_REGISTRY.to_dict()["models"]
+    }
+
+
+def process_memory() -> int | None:
+    if agent is None:
+        return None
+    from utils.nlp.registry import ModelRegistry
+
+    return ModelRegistry.process_rss_bytes()
+
+
+def speculation(field: str) -> float | None:
+    """
+    A field of the speculative decoder's report, None while nothing has been
+    measured or without a draft model.
+    """
+    speculator = agent.scheduler.speculator if agent is not None else None
+    return speculator.to_dict()[field] if speculator is not None else None
+
+
+# Served at ROUTE_METRICS along with the request stage latencies and token
+# counts of utils/metrics.py
+HTTP_REQUEST_SECONDS = METRICS.histogram(
+    "myai_http_request_duration_seconds",
+    "Time to handle each request, by route.",
+    ("method", "route"),
+)
+HTTP_REQUESTS_IN_FLIGHT = METRICS.gauge(
+    "myai_http_requests_in_flight", "Requests being handled."
+)
+METRICS.gauge(
+    "myai_generation_queue_depth",
+    "Generation requests waiting for the scheduler.",
+    callback=lambda: (
+        agent.scheduler.queue_depth() if agent is not None else None
+    ),
+)
+METRICS.gauge(
+    "myai_generation_active_requests",
+    "Generation requests being decoded.",
+    callback=lambda: (
+        agent.scheduler.active_count() if agent is not None else None
+    ),
+)
+METRICS.gauge(
+    "myai_speculative_acceptance_ratio",
+    "Share of draft tokens the model accepted.",
+    callback=lambda: speculation("acceptance_rate"),
+)
+METRICS.gauge(
+    "myai_speculative_tokens_per_pass",
+    "Tokens gained per speculative verification pass.",
+    callback=lambda: speculation("tokens_per_pass"),
+)
+METRICS.gauge(
+    "myai_speculative_speedup",
+    "Decode speed of a lone request with speculation over without it.",
+    callback=lambda: speculation("speedup"),
+)
+METRICS.gauge(
+    "myai_model_memory_bytes",
+    "Parameter and buffer memory of each loaded model.",
+    ("model",),
+    model_memory,
+)
+METRICS.gauge(
+    "process_resident_memory_bytes",
+    "Resident memory of the server process.",
+    callback=process_memory,
+)
+METRICS.gauge(
+    "myai_ready",
+    "1 once startup has finished, otherwise 0.",
+    callback=lambda: int(startup.is_ready()),
+)
+METRICS.gauge(
+    "myai_startup_phase_seconds",
+    "Time each startup phase took.",
+    ("phase",),
+    lambda: {
+        (phase,): seconds
+        for phase, seconds in startup.to_dict()["phases"].items()
+    },
+)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+startup.start(start_server)
+
+
+@app.before_request
+def track_request_start():
+    g.started_at = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+
+
+@app.teardown_request
+def track_request_end(_):
+    if "started_at" not in g:
+        return
+    HTTP_REQUESTS_IN_FLIGHT.dec()
+    route = (
+        request.url_rule.rule if request.url_rule is not None else "unmatched"
+    )
+    HTTP_REQUEST_SECONDS.labels(request.method, route).observe(
+        time.perf_counter() - g.started_at
+    )
 
 
 ### GETs
 ####################################################################################################
 @app.route(ROUTE_IS_ALIVE, methods=["GET"])
 def route_is_alive():
-    try:
-        response = agent.wake_agent()
-        return jsonify(response), 200
-    except Exception as e:
-        Logger.log(LogLevel.ERROR, f"Failed to wake agent, {e}")
-        return jsonify({"status": "Failed to wake agent."}), 500
+    # Liveness: the process is serving requests. Only a failed startup, which a
+    # restart may fix, reports otherwise.
+    if startup.has_failed():
+        return jsonify({"status": "failed", "error": startup.error}), 503
+    return jsonify({"status": "alive"}), 200
+
+
+@app.route(ROUTE_IS_READY, methods=["GET"])
+def route_is_ready():
+    # Readiness: models are loaded and warmed up, with per-phase startup timings
+    return jsonify(startup.to_dict()), 200 if startup.is_ready() else 503
+
+
+@app.route(ROUTE_METRICS, methods=["GET"])
+def route_metrics():
+    return Response(METRICS.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route(ROUTE_MODEL, methods=["GET"])
+@requires_startup
+def route_model_status():
+    return jsonify(agent.get_model_status()), 200
+
+
+@app.route(ROUTE_MODEL + "/registry", methods=["GET"])
+@requires_startup
+def route_model_registry():
+    from utils.nlp.registry import MODEL_REGISTRY
+
+    return jsonify(MODEL_REGISTRY.to_dict()), 200
+
+
+@app.route(ROUTE_TTS + "/cache", methods=["GET"])
+@requires_startup
+def route_speech_cache():
+    return jsonify(agent.synthesizer.speech_cache.to_dict()), 200
+
+
+@app.route(ROUTE_TTS + "/audio/<clip_id>", methods=["GET"])
+@requires_startup
+def route_audio_clip(clip_id):
+    clip = agent.audio_clips.get(clip_id)
+    if clip is None:
+        return jsonify({"error": "Audio not found or expired."}), 404
+
+    # Whole clips and byte ranges (206) alike, so players can start on partial
+    # content and seek
+    response = Response(clip.data, content_type=clip.content_type)
+    response.cache_control.private = True
+    response.cache_control.max_age = agent.audio_clips.ttl_seconds
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=len(clip.data)
+    )
 
 
 @app.route(ROUTE_TRAINING_INIT, methods=["GET"])
-def route_training_init():
+@requires_startup
+def route_training_run():
+    """
+    Deprecated: runs a training job and answers once it finishes, as this route
+    did before training jobs.
+    """
+    from utils.nlp.jobs import JobStatus
+    from utils.nlp.trainer import Trainer
+
+    Logger.log(
+        LogLevel.TRAINER,
+        f"GET {ROUTE_TRAINING_INIT} is deprecated, POST it to queue a training "
+        "job instead.",
+    )
     try:
-        trainer.handle_training_start(request)
+        job = training_jobs.submit(Trainer.parse_request_options(request))
+        job.wait()
+        assert job.status == JobStatus.COMPLETED, (
+            job.error or f"Training job {job.status.value}."
+        )
         return (
             jsonify(
                 {
@@ -57,28 +301,176 @@ def route_training_init():
         return jsonify({"error": "Error running training sequence."}), 500
 
 
+@app.route(ROUTE_TRAINING_INIT + "/jobs", methods=["GET"])
+@requires_startup
+def route_training_jobs():
+    return jsonify([job.to_dict() for job in training_jobs.list()]), 200
+
+
+@app.route(ROUTE_TRAINING_INIT + "/<job_id>", methods=["GET"])
+@requires_startup
+def route_training_job_status(job_id):
+    job = training_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Training job not found."}), 404
+    return jsonify(job.to_dict()), 200
+
+
 ### POSTs
 ####################################################################################################
 @app.route(ROUTE_ASR, methods=["POST"])
+@requires_startup
 def route_audio_prompt():
     try:
         response = agent.handle_audio_prompt(request)
-        return jsonify(response), 200
+        return jsonify(link_audio(response)), 200
     except Exception as e:
         Logger.log(LogLevel.ERROR, f"Error processing audio prompt, {e}")
         return jsonify({"error": "Error processing audio prompt."}), 500
 
 
+@app.route(ROUTE_ASR + "/stream", methods=["POST"])
+@requires_startup
+def route_audio_stream_open():
+    try:
+        return jsonify(agent.handle_audio_stream_open(request)), 201
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error opening audio stream, {e}")
+        return jsonify({"error": "Error opening audio stream."}), 500
+
+
+@app.route(ROUTE_ASR + "/stream/<stream_id>", methods=["POST"])
+@requires_startup
+def route_audio_stream_chunk(stream_id):
+    try:
+        response = agent.handle_audio_stream_chunk(request, stream_id)
+        if response is None:
+            return jsonify({"error": "Audio stream not found."}), 404
+        return jsonify(link_audio(response)), 200
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error processing audio stream, {e}")
+        agent.handle_audio_stream_cancel(stream_id)
+        return jsonify({"error": "Error processing audio stream."}), 500
+
+
 @app.route(ROUTE_TTS, methods=["POST"])
+@requires_startup
 def route_text_prompt():
     try:
+        if request.args.get("stream", "false").lower() == "true":
+            events = agent.handle_text_prompt_stream(request)
+            return Response(
+                stream_with_context(stream_events(events)),
+                mimetype="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                },
+            )
+
         response = agent.handle_text_prompt(request)
-        return jsonify(response), 200
+        return jsonify(link_audio(response)), 200
     except Exception as e:
         Logger.log(LogLevel.ERROR, f"Error processing text prompt, {e}")
         return jsonify({"error": "Error processing text prompt."}), 500
 
 
+@app.route(ROUTE_MODEL + "/reload", methods=["POST"])
+@requires_startup
+def route_model_reload():
+    path = request.args.get("path")
+    if path is not None and not agent.get_checkpoint_manifest().contains(path):
+        return jsonify({"error": "Checkpoint is not registered."}), 404
+    try:
+        if not agent.reload_model(path):
+            return (
+                jsonify({"error": "A model reload is already in progress."}),
+                409,
+            )
+        return jsonify(agent.get_model_status()), 202
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error reloading model, {e}")
+        return jsonify({"error": "Error reloading model."}), 500
+
+
+@app.route(ROUTE_MODEL + "/rollback", methods=["POST"])
+@requires_startup
+def route_model_rollback():
+    try:
+        if not agent.rollback_model():
+            return (
+                jsonify({"error": "A model reload is already in progress."}),
+                409,
+            )
+        return jsonify(agent.get_model_status()), 202
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error rolling back model, {e}")
+        return jsonify({"error": "Error rolling back model."}), 500
+
+
+@app.route(ROUTE_TRAINING_INIT, methods=["POST"])
+@requires_startup
+def route_training_init():
+    from utils.nlp.trainer import Trainer
+
+    try:
+        job = training_jobs.submit(Trainer.parse_request_options(request))
+        return jsonify(job.to_dict()), 202
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error submitting training job, {e}")
+        return jsonify({"error": "Error submitting training job."}), 500
+
+
+### DELETEs
+####################################################################################################
+@app.route(ROUTE_ASR + "/stream/<stream_id>", methods=["DELETE"])
+@requires_startup
+def route_audio_stream_cancel(stream_id):
+    if agent.handle_audio_stream_cancel(stream_id) is None:
+        return jsonify({"error": "Audio stream not found."}), 404
+    return "", 204
+
+
+@app.route(ROUTE_TRAINING_INIT + "/<job_id>", methods=["DELETE"])
+@requires_startup
+def route_training_job_cancel(job_id):
+    job = training_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Training job not found."}), 404
+    return jsonify(job.to_dict()), 202
+
+
+### Helpers
+####################################################################################################
+def stream_events(events):
+    """
+    Serializes agent events as Server-Sent Events, naming narration 'audio' and
+    the final reply 'done'.
+    """
+    try:
+        for event in events:
+            if "token" in event:
+                yield f"data: {json.dumps(event)}\n\n"
+            elif "audio_chunk" in event:
+                yield f"event: audio\ndata: {json.dumps(link_audio(event))}\n\n"
+            else:
+                yield f"event: done\ndata: {json.dumps(event)}\n\n"
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error streaming text prompt, {e}")
+        error = json.dumps({"error": "Error processing text prompt."})
+        yield f"event: error\ndata: {error}\n\n"
+
+
+def link_audio(response: dict) -> dict:
+    """
+    Adds the download URL of audio the agent stored as a clip (see
+    Agent.package_audio).
+    """
+    if response.get("audio_id"):
+        response["audio_url"] = f"{ROUTE_TTS}/audio/{response['audio_id']}"
+    return response
+
+
 ### Main
 ####################################################################################################
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+"""
+Decode latency and peak Python memory per second of audio for ASR uploads: the
+previous pydub -> WAV -> scipy -> float32 path against AudioService.load_audio
+for webm/opus, WAV and raw PCM uploads. Both decode paths run ffmpeg, whose own
+memory is not counted. Requires ffmpeg with libopus on the PATH.
+
+Run from the server directory:
+    python -m benchmarks.audio_decode [seconds ...]
+"""
+
+import io
+import numpy as np
+import subprocess
+import sys
+import time
+import tracemalloc
+import scipy.io.wavfile as wav
+
+from pydub import AudioSegment
+
+from services.audio import AUDIO_SAMPLE_RATE, FFMPEG_BINARY, AudioService
+
+DURATIONS = [float(s) for s in sys.argv[1:]] or [5.0, 30.0]
+RECORDING_SAMPLE_RATE = 48000
+REPEATS = 5
+
+
+def legacy_load_audio(raw_bytes) -> np.ndarray:
+    """
+    The previous AudioService.load_audio plus the float32 copy
+    Synthesizer.transcribe_audio made of it.
+    """
+    wav_buffer = io.BytesIO()
+    audio_segment = AudioSegment.from_file(io.BytesIO(raw_bytes), format="webm")
+    audio_segment = audio_segment.set_frame_rate(
+        AUDIO_SAMPLE_RATE
+    ).set_channels(1)
+    audio_segment.export(wav_buffer, format="wav")
+    wav_buffer.seek(0)
+    _, samples = wav.read(wav_buffer)
+    return np.array(samples, dtype=np.float32).flatten() / 32768.0
+
+
+def record(seconds: float) -> tuple[bytes, bytes, bytes]:
+    """
+    A speech-like test signal as a browser would upload it (webm/opus), as WAV,
+    and as raw 16 kHz PCM.
+    """
+    t = np.arange(int(seconds * RECORDING_SAMPLE_RATE)) / RECORDING_SAMPLE_RATE
+    signal = (
+        0.3
+        * np.sin(2 * np.pi * 220 * t)
+        * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t))
+    )
+    signal += 0.02 * np.random.default_rng(0).standard_normal(len(t))
+    pcm = (signal * 32767).astype("<i2")
+
+    wav_buffer = io.BytesIO()
+    wav.write(wav_buffer, RECORDING_SAMPLE_RATE, pcm)
+    webm = subprocess.run(
+        [
+            FFMPEG_BINARY,
+            "-loglevel",
+            "error",
+            "-f",
+            "wav",
+            "-i",
+            "pipe:0",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            "32k",
+            "-f",
+            "webm",
+            "pipe:1",
+        ],
+        input=wav_buffer.getvalue(),
+        capture_output=True,
+        check=True,
+    ).stdout
+
+    raw = AudioService.to_float32_mono(pcm, 1, RECORDING_SAMPLE_RATE, 32768.0)
+    return webm, wav_buffer.getvalue(), (raw * 32767).astype("<i2").tobytes()
+
+
+def measure(label: str, seconds: float, run):
+    run()  # Warm up ffmpeg and the page cache
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        run()
+    latency = (time.perf_counter() - start) / REPEATS
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{label:>22} {seconds:>5.0f}s: {latency * 1000 / seconds:>7.2f} ms/s "
+        "of audio,"
+        f" {peak / 1024 / seconds:>8.1f} KiB/s of audio peak"
+    )
+
+
+def main():
+    for seconds in DURATIONS:
+        webm, wav_bytes, pcm = record(seconds)
+        measure("legacy webm", seconds, lambda: legacy_load_audio(webm))
+        measure(
+            "webm",
+            seconds,
+            lambda: AudioService.load_audio(
+                webm, "audio/webm;codecs=opus", len(webm)
+            ),
+        )
+        measure(
+            "wav (48 kHz)",
+            seconds,
+            lambda: AudioService.load_audio(wav_bytes, "audio/wav"),
+        )
+        measure(
+            "pcm (16 kHz)",
+            seconds,
+            lambda: AudioService.load_audio(
+                pcm, f"audio/pcm;rate={AUDIO_SAMPLE_RATE}"
+            ),
+        )
+
+        legacy = legacy_load_audio(webm)
+        direct = AudioService.load_audio(
+            webm, "audio/webm;codecs=opus", len(webm)
+        )
+        length = min(len(legacy), len(direct))
+        error = np.max(np.abs(legacy[:length] - direct[:length]))
+        print(f"{'':>22} max sample difference from legacy decode: {error:.4f}")
+
+
+if __name__ == "__main__":
+    main()
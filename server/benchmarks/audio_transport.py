@@ -0,0 +1,116 @@
+"""
+Payload size and serialization time of a narrated reply: base64 WAV inside the
+JSON body (the previous format) against the JSON body plus a separately fetched
+binary clip (audioTransport=url) as WAV and as Opus. Server time covers encoding
+and building the JSON body; client time covers parsing the JSON body and, for
+base64, decoding the audio back to bytes. Requires ffmpeg with libopus on the
+PATH.
+
+Run from the server directory:
+    python -m benchmarks.audio_transport [seconds ...]
+"""
+
+import base64
+import json
+import numpy as np
+import sys
+import time
+
+from services.audio import CODEC_CONTENT_TYPES, AudioCodec
+from utils.nlp.synthesizer import Synthesizer
+
+DURATIONS = [float(s) for s in sys.argv[1:]] or [5.0, 15.0]
+# Bark's output rate
+SAMPLE_RATE = 24000
+REPEATS = 5
+REPLY = (
+    "Dogs are often named after their looks, so a brown dog might be called"
+    " Hazel or Cocoa."
+)
+
+
+def narration(seconds: float) -> np.ndarray:
+    """
+    A speech-like test signal: a voiced tone with syllable-rate amplitude
+    modulation and breath noise.
+    """
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    signal = (
+        0.3
+        * np.sin(2 * np.pi * 180 * t)
+        * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t))
+    )
+    signal += 0.02 * np.random.default_rng(0).standard_normal(len(t))
+    return signal.astype(np.float32)
+
+
+def inline(audio_data: np.ndarray) -> tuple[bytes, int]:
+    """The previous format: one JSON body with the WAV inlined as base64."""
+    wav = Synthesizer.encode_audio(audio_data, SAMPLE_RATE)
+    body = json.dumps(
+        {
+            "reply": REPLY,
+            "audio": base64.b64encode(wav).decode("utf-8"),
+            "audio_type": "audio/wav",
+        }
+    )
+    return body.encode("utf-8"), 0
+
+
+def linked(codec: AudioCodec):
+    def run(audio_data: np.ndarray) -> tuple[bytes, int]:
+        """A JSON body pointing at the clip, which is then served as is."""
+        clip = Synthesizer.encode_audio(audio_data, SAMPLE_RATE, codec=codec)
+        body = json.dumps(
+            {
+                "reply": REPLY,
+                "audio": None,
+                "audio_id": "0" * 32,
+                "audio_type": CODEC_CONTENT_TYPES[codec],
+                "audio_url": "/api/v1/tts/audio/" + "0" * 32,
+            }
+        )
+        return body.encode("utf-8"), len(clip)
+
+    return run
+
+
+def parse(body: bytes):
+    response = json.loads(body)
+    if response["audio"]:
+        base64.b64decode(response["audio"])
+
+
+def timed(run, *args) -> float:
+    run(*args)
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        run(*args)
+    return (time.perf_counter() - start) / REPEATS
+
+
+def main():
+    print(
+        f"{'':>12} {'':>6} {'body KiB':>9} {'clip KiB':>9} {'total KiB':>10} "
+        f"{'server ms':>10} {'client ms':>10}"
+    )
+    for seconds in DURATIONS:
+        audio_data = narration(seconds)
+        for label, run in (
+            ("base64 wav", inline),
+            ("url wav", linked(AudioCodec.WAV)),
+            ("url opus", linked(AudioCodec.OPUS)),
+        ):
+            body, clip = run(audio_data)
+            server = timed(run, audio_data)
+            client = timed(parse, body)
+            print(
+                f"{label:>12} {seconds:>5.0f}s {len(body) / 1024:>9.1f} "
+                f"{clip / 1024:>9.1f}"
+                f" {(len(body) + clip) / 1024:>10.1f} {server * 1000:>10.2f} "
+                f"{client * 1000:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Rows/sec of dataset formatting: the original per-row format_batch closure
+against the column-wise PatternFormatter, single-process and sharded across CPU
+cores. Uses a synthetic corpus shaped like GSM8K plus a SQuAD-style nested
+{"text": [...]} answer column.
+
+Run from the server directory:
+    python -m benchmarks.format_throughput [rows]
+"""
+
+import os
+import sys
+import time
+
+from datasets import Dataset
+
+from utils.nlp.formatter import PatternFormatter
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+PATTERN = "<Question>{}</Question><Answer>{}</Answer><Context>{}</Context>"
+COLUMNS = ["question", "answer", "answers"]
+
+
+def legacy_format_batch(batch):
+    """The formatter Trainer.combine_datasets used before PatternFormatter."""
+    formatted_texts = []
+    num_examples = len(batch[COLUMNS[0]])
+    for i in range(num_examples):
+        values = []
+        for col in COLUMNS:
+            val = batch[col][i]
+            if isinstance(val, dict) and "text" in val:
+                values.append(
+                    val["text"][0]
+                    if isinstance(val["text"], list) and val["text"]
+                    else ""
+                )
+            else:
+                values.append(str(val))
+        formatted_texts.append(PATTERN.format(*values))
+    return {"text": formatted_texts}
+
+
+def build_corpus(rows: int) -> Dataset:
+    return Dataset.from_dict(
+        {
+            "question": [
+                f"Natalia sold clips to {i} of her friends. How many clips did "
+                "she sell?"
+                for i in range(rows)
+            ],
+            "answer": [f"She sold {i} clips. #### {i}" for i in range(rows)],
+            "answers": [
+                {
+                    "text": [f"answer {i}", "alt"] if i % 7 else [],
+                    "answer_start": [0],
+                }
+                for i in range(rows)
+            ],
+        }
+    )
+
+
+def timed(label: str, run) -> list[str]:
+    start = time.perf_counter()
+    dataset = run()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>28}: {ROWS / elapsed:>12,.0f} rows/sec ({elapsed:.2f}s)")
+    return dataset.with_format(None)["text"]
+
+
+def main():
+    corpus = build_corpus(ROWS)
+    formatter = PatternFormatter(PATTERN, COLUMNS)
+    num_proc = os.cpu_count() or 1
+
+    print(f"rows={ROWS} cores={num_proc}")
+    expected = timed(
+        "legacy per-row",
+        lambda: corpus.map(
+            legacy_format_batch,
+            batched=True,
+            remove_columns=corpus.column_names,
+            load_from_cache_file=False,
+        ),
+    )
+    vectorized = timed(
+        "column-wise",
+        lambda: corpus.with_format("arrow").map(
+            formatter,
+            batched=True,
+            batch_size=10000,
+            remove_columns=corpus.column_names,
+            load_from_cache_file=False,
+        ),
+    )
+    sharded = timed(
+        f"column-wise, num_proc={num_proc}",
+        lambda: corpus.with_format("arrow").map(
+            formatter,
+            batched=True,
+            batch_size=10000,
+            num_proc=num_proc,
+            remove_columns=corpus.column_names,
+            load_from_cache_file=False,
+        ),
+    )
+
+    assert (
+        vectorized == expected
+    ), "column-wise output differs from the legacy formatter"
+    assert (
+        sharded == expected
+    ), "sharded output differs from the legacy formatter"
+    print("outputs match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Tokens/sec of the GenerationScheduler at 1, 4 and 16 concurrent clients, against
+one model.generate call at a time.
+
+Run from the server directory:
+    python -m benchmarks.generation_throughput
+"""
+
+import threading
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from services.env import EnvService, EnvVars
+from utils.nlp.enums import Models
+from utils.nlp.scheduler import GenerationScheduler
+
+MODEL = EnvService.get(EnvVars.DEFAULT_MODEL.value, Models.GPT2.value)
+NEW_TOKENS = 32
+REQUESTS_PER_CLIENT = 4
+PROMPT = "The quickest way to understand a new codebase is"
+
+
+def run_clients(num_clients: int, work) -> float:
+    """
+    Run `work` REQUESTS_PER_CLIENT times on each of num_clients threads and
+    return tokens/sec.
+    """
+    generated = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(REQUESTS_PER_CLIENT):
+            n = work()
+            with lock:
+                generated.append(n)
+
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(generated) / (time.perf_counter() - start)
+
+
+def main():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.generation_config.do_sample = False
+    input_ids = tokenizer(PROMPT).input_ids
+
+    # Baseline: the previous behaviour, one generate() per request serialized
+    # behind a lock
+    generate_lock = threading.Lock()
+
+    def baseline():
+        with generate_lock, torch.inference_mode():
+            out = model.generate(
+                torch.tensor([input_ids]),
+                max_new_tokens=NEW_TOKENS,
+                min_new_tokens=NEW_TOKENS,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        return out.shape[1] - len(input_ids)
+
+    # Ignore EOS so every request decodes exactly NEW_TOKENS tokens, matching
+    # min_new_tokens above
+    scheduler = GenerationScheduler(model)
+    scheduler._eos_token_ids = set()
+
+    def scheduled():
+        return len(scheduler.generate(input_ids, NEW_TOKENS))
+
+    print(
+        f"model={MODEL} new_tokens={NEW_TOKENS} "
+        f"requests/client={REQUESTS_PER_CLIENT}"
+    )
+    print(f"{'clients':>8} {'baseline tok/s':>15} {'scheduler tok/s':>16}")
+    for clients in (1, 4, 16):
+        base = run_clients(clients, baseline)
+        sched = run_clients(clients, scheduled)
+        print(f"{clients:>8} {base:>15.1f} {sched:>16.1f}")
+
+    scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()
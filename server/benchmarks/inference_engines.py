@@ -0,0 +1,146 @@
+"""
+First-token latency and steady-state decode speed of the language model under
+each inference engine. Every engine is measured in a fresh process, so
+compilation and export caches in memory do not carry over; build time is
+InferenceEngine.create, including its parity check, so it is a cold start only
+when ENGINE_CACHE_DIR is empty. Single-sequence numbers are greedy decoding of
+NEW_TOKENS tokens, median of REPEATS, where tokens/s excludes the first token;
+batched tokens/s is the GenerationScheduler serving CLIENTS concurrent requests.
+Parity compares each engine's greedy tokens with eager PyTorch's.
+
+Run from the server directory:
+    python -m benchmarks.inference_engines [model]
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from utils.nlp.engines import InferenceEngine
+from utils.nlp.enums import InferenceEngines, Models
+from utils.nlp.scheduler import GenerationScheduler
+
+MODEL = (
+    sys.argv[1]
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("--")
+    else Models.GPT2.value
+)
+NEW_TOKENS = 64
+REPEATS = 3
+CLIENTS = 4
+PROMPT = "The quickest way to understand a new codebase is"
+
+
+def batched_tokens_per_second(
+    model, engine: InferenceEngine, input_ids: list[int]
+) -> float:
+    # Ignore EOS so every request decodes exactly NEW_TOKENS tokens
+    scheduler = GenerationScheduler(model, engine=engine)
+    scheduler._eos_token_ids = set()
+    threads = [
+        threading.Thread(
+            target=scheduler.generate, args=(input_ids, NEW_TOKENS)
+        )
+        for _ in range(CLIENTS)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    scheduler.shutdown()
+    return CLIENTS * NEW_TOKENS / elapsed
+
+
+def measure(engine_type: InferenceEngines) -> dict:
+    """Runs in the child process for one engine."""
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.generation_config.do_sample = False
+    input_ids = tokenizer(PROMPT).input_ids
+
+    start = time.perf_counter()
+    engine = InferenceEngine.create(model, MODEL, engine_type)
+    build_seconds = time.perf_counter() - start
+
+    first_token, steady = [], []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        tokens, first_token_seconds = engine.greedy(input_ids, NEW_TOKENS)
+        elapsed = time.perf_counter() - start
+        first_token.append(first_token_seconds)
+        steady.append((NEW_TOKENS - 1) / (elapsed - first_token_seconds))
+
+    # Run twice, so the first absorbs any compilation for batch shapes
+    batched_tokens_per_second(model, engine, input_ids)
+    return {
+        "engine": engine.engine.value,
+        "build_seconds": build_seconds,
+        "first_token_ms": statistics.median(first_token) * 1000,
+        "tokens_per_second": statistics.median(steady),
+        "batched_tokens_per_second": batched_tokens_per_second(
+            model, engine, input_ids
+        ),
+        "tokens": tokens,
+    }
+
+
+def main():
+    if "--engine" in sys.argv:
+        print(
+            json.dumps(
+                measure(
+                    InferenceEngines(sys.argv[sys.argv.index("--engine") + 1])
+                )
+            )
+        )
+        return
+
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    results = {}
+    for engine_type in InferenceEngines:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.inference_engines",
+                *args,
+                "--engine",
+                engine_type.value,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results[engine_type] = json.loads(output.strip().splitlines()[-1])
+
+    reference = results[InferenceEngines.EAGER]["tokens"]
+    print(f"model={MODEL} new_tokens={NEW_TOKENS} clients={CLIENTS}")
+    print(
+        f"{'':>8} {'served by':>9} {'build s':>8} {'first token ms':>15} "
+        f"{'tokens/s':>9} {'batched tokens/s':>17}"
+        f" {'parity':>7}"
+    )
+    for engine_type, r in results.items():
+        # An engine that failed its own parity check is served eagerly, which
+        # "served by" shows
+        parity = "yes" if r["tokens"] == reference else "no"
+        print(
+            f"{engine_type.value:>8} {r['engine']:>9} "
+            f"{r['build_seconds']:>8.1f} {r['first_token_ms']:>15.1f}"
+            f" {r['tokens_per_second']:>9.1f} "
+            f"{r['batched_tokens_per_second']:>17.1f} {parity:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
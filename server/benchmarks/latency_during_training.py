@@ -0,0 +1,74 @@
+"""
+Chat latency of a running server before and during a background training job.
+
+Start the server first (python app.py), then from the server directory:
+    python -m benchmarks.latency_during_training [base_url]
+"""
+
+import json
+import statistics
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+BASE_URL = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:1587"
+ROUTE_TTS = "/api/v1/tts"
+ROUTE_TRAINING = "/api/v1/training"
+SAMPLES = 10
+
+
+def call(method: str, route: str, data: bytes | None = None) -> dict:
+    req = urllib.request.Request(BASE_URL + route, data=data, method=method)
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def chat_latencies() -> list[float]:
+    query = urllib.parse.urlencode(
+        {
+            "mode": "question",
+            "narrateResponse": "false",
+            "sessionId": "benchmark",
+        }
+    )
+    body = urllib.parse.urlencode(
+        {"userMessage": "What is a good name for a dog?"}
+    ).encode()
+    latencies = []
+    for _ in range(SAMPLES):
+        start = time.perf_counter()
+        call("POST", f"{ROUTE_TTS}?{query}", body)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{label:>16}: p50 {statistics.median(latencies) * 1000:8.1f} ms   p95 "
+        f"{p95 * 1000:8.1f} ms"
+    )
+
+
+def main():
+    report("idle", chat_latencies())
+
+    job = call("POST", ROUTE_TRAINING)
+    print(f"submitted training job {job['id']}")
+    while call("GET", f"{ROUTE_TRAINING}/{job['id']}")["status"] == "queued":
+        time.sleep(0.5)
+    # Let the worker get past model and dataset loading into the training loop
+    while not call("GET", f"{ROUTE_TRAINING}/{job['id']}")["progress"]:
+        time.sleep(1)
+
+    report("during training", chat_latencies())
+    print(json.dumps(call("GET", f"{ROUTE_TRAINING}/{job['id']}")["progress"]))
+
+    call("DELETE", f"{ROUTE_TRAINING}/{job['id']}")
+    print("cancelled training job")
+
+
+if __name__ == "__main__":
+    main()
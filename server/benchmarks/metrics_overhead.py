@@ -0,0 +1,123 @@
+"""
+Cost of the metrics served at ROUTE_METRICS. Times a histogram observation and a
+timed block in isolation, counts how many observations one generation request
+makes, and compares requests through the GenerationScheduler with observations
+on and turned off (alternating which goes first, median of REPEATS). The
+estimated share is observations per request times their cost, over the request's
+time; the measured share is the on/off difference, which is within noise when
+the estimate is this small. Rendering the metrics for a scrape is timed last.
+
+Run from the server directory:
+    python -m benchmarks.metrics_overhead [model]
+"""
+
+import statistics
+import sys
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from utils.metrics import METRICS, STAGE_SECONDS, Histogram, HistogramSeries
+from utils.nlp.enums import Models
+from utils.nlp.scheduler import GenerationScheduler
+
+MODEL = sys.argv[1] if len(sys.argv) > 1 else Models.GPT2.value
+NEW_TOKENS = 64
+REPEATS = 15
+OPERATIONS = 200000
+PROMPT = "The quickest way to understand a new codebase is"
+
+
+def per_operation_ns(operation) -> float:
+    start = time.perf_counter()
+    for _ in range(OPERATIONS):
+        operation()
+    return (time.perf_counter() - start) / OPERATIONS * 1e9
+
+
+def observations() -> int:
+    """Observations made so far by every histogram."""
+    histograms = [
+        metric
+        for metric in METRICS._metrics.values()
+        if isinstance(metric, Histogram)
+    ]
+    return sum(
+        sum(series.snapshot()[0])
+        for histogram in histograms
+        for series in histogram._series.values()
+    )
+
+
+def main():
+    series = HistogramSeries(STAGE_SECONDS.buckets)
+    observe_ns = per_operation_ns(lambda: series.observe(0.01))
+
+    def timed_block():
+        with series.time():
+            pass
+
+    timed_ns = per_operation_ns(timed_block)
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.generation_config.do_sample = False
+    input_ids = tokenizer(PROMPT).input_ids
+    scheduler = GenerationScheduler(model)
+    # Ignore EOS so every request decodes exactly NEW_TOKENS tokens
+    scheduler._eos_token_ids = set()
+    scheduler.generate(input_ids, NEW_TOKENS)
+
+    before = observations()
+    scheduler.generate(input_ids, NEW_TOKENS)
+    per_request = observations() - before
+
+    observe = HistogramSeries.observe
+    on, off = [], []
+    for i in range(REPEATS):
+        pairs = ((True, on), (False, off))
+        # Whichever runs first in a pair tends to be slower, so the order
+        # alternates
+        for enabled, times in pairs if i % 2 else reversed(pairs):
+            HistogramSeries.observe = (
+                observe if enabled else lambda self, value: None
+            )
+            start = time.perf_counter()
+            scheduler.generate(input_ids, NEW_TOKENS)
+            times.append(time.perf_counter() - start)
+    HistogramSeries.observe = observe
+    scheduler.shutdown()
+
+    request_seconds = statistics.median(on)
+    render_start = time.perf_counter()
+    exposition = METRICS.render()
+    render_ms = (time.perf_counter() - render_start) * 1000
+
+    print(f"model={MODEL} new_tokens={NEW_TOKENS} repeats={REPEATS}")
+    print(f"{'histogram observation':>32} {observe_ns:>10.0f} ns")
+    print(f"{'timed block':>32} {timed_ns:>10.0f} ns")
+    print(f"{'observations per request':>32} {per_request:>10}")
+    print(f"{'request, metrics on':>32} {request_seconds * 1000:>10.2f} ms")
+    print(
+        f"{'request, metrics off':>32} {statistics.median(off) * 1000:>10.2f} "
+        "ms"
+    )
+    print(
+        f"{'estimated overhead':>32} "
+        f"{per_request * timed_ns / 1e9 / request_seconds:>10.4%}"
+    )
+    print(
+        f"{'measured overhead':>32} "
+        f"{request_seconds / statistics.median(off) - 1:>10.4%}"
+    )
+    print(
+        f"{'render for a scrape':>32} {render_ms:>10.3f} ms ({len(exposition)} "
+        "bytes)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Load time, memory, decode speed and perplexity drift of the language model in
+each precision mode. Every mode is measured in a fresh process, so its RSS is
+not inflated by the modes before it; RSS is the growth from loading the model
+and running it once. Tokens/s is greedy decoding of
+NEW_TOKENS tokens for one sequence; perplexity is over held-out examples of the
+active datasets in datasets.json, or over the lines of a text file when one is
+given.
+
+Run from the server directory:
+    python -m benchmarks.precision_modes [model] [texts.txt]
+"""
+
+import gc
+import json
+import statistics
+import subprocess
+import sys
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from utils.nlp.enums import Models, Precision
+from utils.nlp.precision import ModelPrecision
+from utils.nlp.registry import ModelRegistry
+
+MODEL = (
+    sys.argv[1]
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("--")
+    else Models.GPT2.value
+)
+TEXTS = (
+    sys.argv[2]
+    if len(sys.argv) > 2 and not sys.argv[2].startswith("--")
+    else None
+)
+NEW_TOKENS = 64
+REPEATS = 3
+PROMPT = "What is a good name for a dog?"
+
+
+def load_texts() -> list[str]:
+    if TEXTS is None:
+        return ModelPrecision.held_out_texts()
+    with open(TEXTS, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def measure(precision: Precision) -> dict:
+    """Runs in the child process for one mode."""
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    texts = load_texts()
+
+    rss_before = ModelRegistry.process_rss_bytes()
+    start = time.perf_counter()
+    loader = lambda dtype: AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=dtype
+    )
+    model = ModelPrecision.apply(
+        loader(ModelPrecision.load_dtype(precision)), precision
+    )
+    load_seconds = time.perf_counter() - start
+
+    input_ids = tokenizer(PROMPT, return_tensors="pt").input_ids
+    generate = lambda: model.generate(
+        input_ids,
+        max_new_tokens=NEW_TOKENS,
+        min_new_tokens=NEW_TOKENS,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    with torch.inference_mode():
+        generate()
+        # After a forward pass, so memory-mapped weights have been paged in, and
+        # once anything dropped is collected
+        gc.collect()
+        rss = ModelRegistry.process_rss_bytes() - rss_before
+        timings = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            generate()
+            timings.append(time.perf_counter() - start)
+
+    return {
+        "load_seconds": load_seconds,
+        "rss_mb": rss / 1024 / 1024,
+        "weights_mb": ModelRegistry.measure(model) / 1024 / 1024,
+        "tokens_per_second": NEW_TOKENS / statistics.median(timings),
+        "perplexity": (
+            ModelPrecision.perplexity(model, tokenizer, texts)
+            if texts
+            else float("nan")
+        ),
+        "examples": len(texts),
+    }
+
+
+def main():
+    if "--mode" in sys.argv:
+        print(
+            json.dumps(
+                measure(Precision(sys.argv[sys.argv.index("--mode") + 1]))
+            )
+        )
+        return
+
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    results = {}
+    for precision in Precision:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.precision_modes",
+                *args,
+                "--mode",
+                precision.value,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results[precision] = json.loads(output.strip().splitlines()[-1])
+
+    reference = results[Precision.FLOAT32]["perplexity"]
+    print(
+        f"model={MODEL} perplexity over "
+        f"{results[Precision.FLOAT32]['examples']} examples"
+    )
+    print(
+        f"{'':>13} {'load s':>7} {'RSS MB':>7} {'weights MB':>11} "
+        f"{'tokens/s':>9} {'perplexity':>11} {'drift':>8}"
+    )
+    for precision, r in results.items():
+        drift = (r["perplexity"] - reference) / reference * 100
+        print(
+            f"{precision.value:>13} {r['load_seconds']:>7.2f} "
+            f"{r['rss_mb']:>7.0f} {r['weights_mb']:>11.0f}"
+            f" {r['tokens_per_second']:>9.1f} {r['perplexity']:>11.3f} "
+            f"{drift:>+7.2f}%"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Memory and throughput of the production server (gunicorn with gunicorn.conf.py)
+at several worker counts. For each count, the server is started, warmed up, then
+CLIENTS threads post text prompts back-to-back for DURATION seconds. Memory is
+summed over the master and its workers as RSS, which counts the shared
+copy-on-write weights once per process, and as PSS, which splits shared pages
+between the processes sharing them and so shows what the server really uses.
+Requires gunicorn, and Linux for /proc. Uses DEFAULT_MODEL, like the server.
+
+Run from the server directory:
+    python -m benchmarks.serving_workers [workers ...]
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+WORKERS = [int(n) for n in sys.argv[1:]] or [1, max(2, os.cpu_count() or 1)]
+PORT = 15870
+CLIENTS = 8
+WARMUP_SECONDS = 10
+DURATION = 30
+READY_TIMEOUT = 600
+PROMPT = "What is a good name for a dog?"
+
+
+def url(path: str) -> str:
+    return f"http://127.0.0.1:{PORT}{path}"
+
+
+def post_prompt(session_id: str):
+    query = urllib.parse.urlencode(
+        {"mode": "question", "sessionId": session_id}
+    )
+    body = urllib.parse.urlencode({"userMessage": PROMPT}).encode("utf-8")
+    with urllib.request.urlopen(
+        url(f"/api/v1/tts?{query}"), data=body, timeout=120
+    ) as response:
+        response.read()
+
+
+def wait_until_ready(server: subprocess.Popen):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        assert server.poll() is None, "Server exited before it was ready."
+        try:
+            with urllib.request.urlopen(url("/api/v1/model"), timeout=5):
+                return
+        except OSError:
+            time.sleep(1)
+    raise TimeoutError("Server was not ready in time.")
+
+
+def load(seconds: float) -> float:
+    """Requests per second across CLIENTS threads."""
+    completed = [0] * CLIENTS
+    deadline = time.monotonic() + seconds
+
+    def client(index: int):
+        while time.monotonic() < deadline:
+            post_prompt(f"benchmark-client-{index}")
+            completed[index] += 1
+
+    threads = [
+        threading.Thread(target=client, args=(i,)) for i in range(CLIENTS)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(completed) / (time.perf_counter() - start)
+
+
+def process_tree(pid: int) -> list[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [pid] + [int(child) for child in f.read().split()]
+
+
+def memory_mb(pids: list[int]) -> tuple[float, float]:
+    """Summed (RSS, PSS) of pids in MB."""
+    rss = pss = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                field, value = line.split()[:2]
+                if field == "Rss:":
+                    rss += int(value)
+                elif field == "Pss:":
+                    pss += int(value)
+    return rss / 1024, pss / 1024
+
+
+def run(workers: int) -> tuple[float, float, float]:
+    env = dict(
+        os.environ,
+        SERVER_WORKERS=str(workers),
+        SERVER_PORT=str(PORT),
+        SERVER_HOST="127.0.0.1",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_ready(server)
+        # Long enough for every worker to finish starting and to have served
+        # requests
+        load(WARMUP_SECONDS)
+        throughput = load(DURATION)
+        rss, pss = memory_mb(process_tree(server.pid))
+        return rss, pss, throughput
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def main():
+    print(f"{CLIENTS} clients, {DURATION}s per run")
+    print(f"{'workers':>8} {'RSS MB':>9} {'PSS MB':>9} {'req/s':>8}")
+    for workers in WORKERS:
+        rss, pss, throughput = run(workers)
+        print(f"{workers:>8} {rss:>9.0f} {pss:>9.0f} {throughput:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
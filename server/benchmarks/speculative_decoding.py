@@ -0,0 +1,96 @@
+"""
+Decode speed of one request at a time through the GenerationScheduler, without
+and with speculative decoding at several draft lengths. The draft is a separate
+checkpoint sharing the model's tokenizer, or the model's own first N layers when
+given as a number. Decoding is greedy, so speculation must reproduce the plain
+replies exactly, which parity checks.
+
+Run from the server directory:
+    python -m benchmarks.speculative_decoding [model] [draft model | draft layers]
+"""
+
+import sys
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from utils.nlp.enums import Models
+from utils.nlp.scheduler import GenerationScheduler
+from utils.nlp.speculative import SpeculativeDecoder
+
+MODEL = sys.argv[1] if len(sys.argv) > 1 else Models.GPT2.value
+DRAFT = sys.argv[2] if len(sys.argv) > 2 else "distilgpt2"
+DRAFT_TOKENS = [2, 4, 6]
+NEW_TOKENS = 64
+PROMPTS = [
+    "The quickest way to understand a new codebase is",
+    "What is a good name for a dog?",
+    "Once upon a time, in a small village by the sea,",
+    "The three most important rules of writing clear code are",
+]
+
+
+def run(
+    model, input_ids: list[list[int]], speculator: SpeculativeDecoder | None
+) -> tuple[list[list[int]], float]:
+    """
+    Replies to every prompt, one after another, and the tokens per second over
+    all of them.
+    """
+    scheduler = GenerationScheduler(model, speculator=speculator)
+    # Ignore EOS so every request decodes exactly NEW_TOKENS tokens
+    scheduler._eos_token_ids = set()
+    start = time.perf_counter()
+    replies = [scheduler.generate(ids, NEW_TOKENS) for ids in input_ids]
+    elapsed = time.perf_counter() - start
+    scheduler.shutdown()
+    return replies, len(input_ids) * NEW_TOKENS / elapsed
+
+
+def main():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.generation_config.do_sample = False
+    input_ids = [tokenizer(prompt).input_ids for prompt in PROMPTS]
+    config = {"enabled": True, "min_acceptance_rate": 0}
+    config.update(
+        {"draft_layers": int(DRAFT)}
+        if DRAFT.isdigit()
+        else {"draft_model": DRAFT}
+    )
+
+    # Once untimed, so first-call allocation does not count against either
+    run(model, input_ids[:1], None)
+    reference, baseline = run(model, input_ids, None)
+
+    print(
+        f"model={MODEL} draft={DRAFT} new_tokens={NEW_TOKENS} "
+        f"prompts={len(PROMPTS)}"
+    )
+    print(
+        f"{'draft tokens':>12} {'tokens/s':>9} {'speedup':>8} "
+        f"{'acceptance':>11} {'tokens/pass':>12} {'parity':>7}"
+    )
+    print(
+        f"{'-':>12} {baseline:>9.1f} {1:>8.2f} {'-':>11} {1:>12.2f} {'yes':>7}"
+    )
+    for draft_tokens in DRAFT_TOKENS:
+        speculator = SpeculativeDecoder.create(
+            model, MODEL, {**config, "draft_tokens": draft_tokens}
+        )
+        replies, tokens_per_second = run(model, input_ids, speculator)
+        stats = speculator.to_dict()
+        print(
+            f"{draft_tokens:>12} {tokens_per_second:>9.1f} "
+            f"{tokens_per_second / baseline:>8.2f}"
+            f" {stats['acceptance_rate']:>11.1%} "
+            f"{stats['tokens_per_pass']:>12.2f}"
+            f" {'yes' if replies == reference else 'no':>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Transcription and narration throughput at several concurrency levels, with
+Synthesizer's micro-batching against one call per forward pass (max batch size
+1). Each client thread makes CALLS_PER_CLIENT back-to-back calls. Narration is
+only batched with TTS_SEED unset (-1), since a seeded, cacheable sentence is
+narrated on its own.
+Defaults to small checkpoints so it runs quickly on a CPU; any Whisper and Bark
+checkpoint or local directory works.
+
+Run from the server directory:
+    python -m benchmarks.speech_batching [stt_model] [tts_model]
+"""
+
+import numpy as np
+import sys
+import threading
+import time
+
+from services.audio import AUDIO_SAMPLE_RATE
+from utils.nlp.synthesizer import (
+    ASR_MAX_BATCH_SIZE,
+    TTS_MAX_BATCH_SIZE,
+    Synthesizer,
+)
+
+STT_MODEL = sys.argv[1] if len(sys.argv) > 1 else "openai/whisper-tiny"
+TTS_MODEL = sys.argv[2] if len(sys.argv) > 2 else "suno/bark-small"
+CONCURRENCY = [1, 2, 4, 8]
+CALLS_PER_CLIENT = 3
+RECORDING_SECONDS = 3
+SENTENCE = "Hazel is a good name for a brown dog."
+
+
+def throughput(clients: int, call) -> float:
+    """Calls per second across all clients."""
+
+    def client():
+        for _ in range(CALLS_PER_CLIENT):
+            call()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * CALLS_PER_CLIENT / (time.perf_counter() - start)
+
+
+def compare(label: str, batcher, max_batch_size: int, call):
+    call()  # Load the model and warm up before timing
+    print(f"{label} (calls/s, batched up to {max_batch_size})")
+    print(f"{'clients':>8} {'unbatched':>10} {'batched':>10}")
+    for clients in CONCURRENCY:
+        batcher.max_batch_size = 1
+        unbatched = throughput(clients, call)
+        batcher.max_batch_size = max_batch_size
+        batched = throughput(clients, call)
+        print(f"{clients:>8} {unbatched:>10.2f} {batched:>10.2f}")
+
+
+def main():
+    synthesizer = Synthesizer(STT_MODEL, TTS_MODEL, cache_speech=False)
+    t = np.arange(RECORDING_SECONDS * AUDIO_SAMPLE_RATE) / AUDIO_SAMPLE_RATE
+    recording = (
+        0.3
+        * np.sin(2 * np.pi * 220 * t)
+        * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t))
+    ).astype(np.float32)
+
+    print(f"stt={STT_MODEL} tts={TTS_MODEL}")
+    compare(
+        "transcription",
+        synthesizer.stt_batcher,
+        ASR_MAX_BATCH_SIZE,
+        lambda: synthesizer.transcribe_audio(recording),
+    )
+    compare(
+        "narration",
+        synthesizer.tts_batcher,
+        TTS_MAX_BATCH_SIZE,
+        lambda: synthesizer.synthesize(SENTENCE),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Narration time of repeated sentences from the speech cache against synthesizing
+them: a cold call that runs Bark, a hit in the memory tier, and a hit in the
+disk tier (read by a fresh cache over the same directory, as after a restart).
+Entries are written to a temporary directory. Downloads Bark on first run; any
+Bark checkpoint or local directory works.
+
+Run from the server directory:
+    python -m benchmarks.speech_cache [tts_model]
+"""
+
+import sys
+import tempfile
+import time
+
+from utils.nlp.enums import Models
+from utils.nlp.speech_cache import SpeechCache
+from utils.nlp.synthesizer import Synthesizer
+
+TTS_MODEL = sys.argv[1] if len(sys.argv) > 1 else Models.SUNO_BARK.value
+SENTENCES = [
+    "Hello! How can I help you today?",
+    "Sorry, I did not catch that.",
+    "Dogs are often named after their looks, so a brown dog might be called "
+    "Hazel or Cocoa.",
+]
+
+
+def timed(synthesizer, text: str) -> float:
+    start = time.perf_counter()
+    synthesizer.synthesize(text)
+    return time.perf_counter() - start
+
+
+def main():
+    synthesizer = Synthesizer(tts_model_name=TTS_MODEL)
+    with tempfile.TemporaryDirectory() as directory:
+        synthesizer.speech_cache = SpeechCache(directory)
+        # Load Bark and warm it up before timing
+        synthesizer.synthesize("Warming up.")
+
+        print(f"tts={TTS_MODEL} (ms)")
+        print(
+            f"{'chars':>6} {'synthesized':>12} {'memory hit':>11} "
+            f"{'disk hit':>9}"
+        )
+        for text in SENTENCES:
+            cold = timed(synthesizer, text)
+            memory = timed(synthesizer, text)
+            synthesizer.speech_cache = SpeechCache(directory)
+            disk = timed(synthesizer, text)
+            print(
+                f"{len(text):>6} {cold * 1000:>12.1f} {memory * 1000:>11.3f} "
+                f"{disk * 1000:>9.3f}"
+            )
+        print(synthesizer.speech_cache.to_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Startup time of the development server (python app.py) started in a fresh
+process: how long until it answers the liveness check, how long until it reports
+ready, the phases of its startup pipeline, and the latency of the liveness and
+readiness checks once it is up. Phases that run side by side overlap, and
+"agent" spans the tokenizer, model and scheduler phases. Models and libraries
+are read from the OS page cache after the first run, so run it twice for
+warm-start numbers.
+
+Run from the server directory:
+    python -m benchmarks.startup_time [model]
+"""
+
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from utils.nlp.enums import Models
+
+MODEL = sys.argv[1] if len(sys.argv) > 1 else Models.GPT2.value
+PROBES = 200
+TIMEOUT_SECONDS = 600
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def probe(url: str) -> tuple[int | None, dict | None]:
+    """
+    The status and JSON body of a GET, or (None, None) if nothing is listening
+    yet.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+    except (urllib.error.URLError, ConnectionError):
+        return None, None
+
+
+def wait_for(
+    url: str, status: int, process, started_at: float
+) -> tuple[float, dict]:
+    while time.perf_counter() - started_at < TIMEOUT_SECONDS:
+        assert process.poll() is None, "The server exited during startup."
+        code, body = probe(url)
+        if code == status:
+            return time.perf_counter() - started_at, body
+        time.sleep(0.01)
+    raise TimeoutError(
+        f"{url} did not answer {status} within {TIMEOUT_SECONDS} s."
+    )
+
+
+def latency_ms(url: str) -> float:
+    times = []
+    for _ in range(PROBES):
+        start = time.perf_counter()
+        probe(url)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "DEFAULT_MODEL": MODEL,
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "DEBUG": "false",
+    }
+
+    started_at = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "app.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        alive_seconds, _ = wait_for(
+            base + "/api/v1/is_alive", 200, process, started_at
+        )
+        ready_seconds, report = wait_for(
+            base + "/api/v1/is_ready", 200, process, started_at
+        )
+        alive_ms, ready_ms = latency_ms(base + "/api/v1/is_alive"), latency_ms(
+            base + "/api/v1/is_ready"
+        )
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(f"model={MODEL}")
+    print(f"{'alive after':>24} {alive_seconds:>8.2f} s")
+    print(f"{'ready after':>24} {ready_seconds:>8.2f} s")
+    for phase, seconds in sorted(
+        report["phases"].items(), key=lambda item: -item[1]
+    ):
+        print(f"{'phase ' + phase:>24} {seconds:>8.2f} s")
+    print(f"{'liveness check':>24} {alive_ms:>8.2f} ms (median of {PROBES})")
+    print(f"{'readiness check':>24} {ready_ms:>8.2f} ms (median of {PROBES})")
+
+
+if __name__ == "__main__":
+    main()
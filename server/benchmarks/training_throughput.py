@@ -0,0 +1,135 @@
+"""
+Training tokens/sec and pad ratio for each TrainingDataMode over the same
+synthetic corpus of short and long examples. Tokens/sec counts real (non-pad)
+tokens only; pad ratio is the share of every training batch spent on padding.
+
+Run from the server directory:
+    python -m benchmarks.training_throughput [steps]
+"""
+
+import random
+import sys
+import tempfile
+import time
+import torch
+
+from datasets import Dataset
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    Trainer as T,
+    TrainingArguments,
+)
+
+from services.env import EnvService, EnvVars
+from utils.nlp.enums import Models
+from utils.nlp.packing import IGNORE_INDEX
+from utils.nlp.trainer import Trainer, TrainingDataMode
+
+MODEL = EnvService.get(EnvVars.DEFAULT_MODEL.value, Models.GPT2.value)
+STEPS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+BATCH_SIZE = 4
+EXAMPLES = 2000
+WORDS = (
+    "natalia sold clips to her friends in april and then half as many clips in"
+    " may how many did she sell"
+).split()
+
+
+def build_corpus() -> Dataset:
+    """Mostly short examples with a long tail, like a QA corpus."""
+    rng = random.Random(67)
+    lengths = [
+        min(int(rng.expovariate(1 / 40)) + 8, 600) for _ in range(EXAMPLES)
+    ]
+    return Dataset.from_dict(
+        {
+            "text": [
+                " ".join(rng.choice(WORDS) for _ in range(n)) for n in lengths
+            ]
+        }
+    )
+
+
+def count_tokens(batch: dict) -> tuple[int, int]:
+    """Real and total token positions in a collated batch."""
+    total = batch["input_ids"].numel()
+    if "attention_mask" in batch:
+        return int(batch["attention_mask"].sum()), total
+
+    # Packed blocks are only padded at their tail, where every label is ignored
+    real = 0
+    for labels in batch["labels"]:
+        kept = (labels != IGNORE_INDEX).nonzero()
+        real += int(kept[-1]) + 1 if len(kept) else 0
+    return real, total
+
+
+def run(
+    mode: TrainingDataMode, corpus: Dataset, tokenizer
+) -> tuple[float, float]:
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.config.pad_token_id = tokenizer.pad_token_id
+    if mode == TrainingDataMode.PACKED:
+        model.config.use_cache = False
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = TrainingArguments(
+            output_dir=output_dir,
+            per_device_train_batch_size=BATCH_SIZE,
+            max_steps=STEPS,
+            save_strategy="no",
+            report_to=[],
+            disable_tqdm=True,
+        )
+        Trainer.configure_sampling(args, mode)
+        trainer = T(
+            model=model,
+            args=args,
+            data_collator=Trainer.data_collator(tokenizer, mode),
+            train_dataset=Trainer.tokenize_dataset(corpus, tokenizer, mode),
+        )
+
+        real, total = 0, 0
+        for step, batch in enumerate(trainer.get_train_dataloader()):
+            if step >= STEPS:
+                break
+            batch_real, batch_total = count_tokens(batch)
+            real += batch_real
+            total += batch_total
+
+        start = time.perf_counter()
+        trainer.train()
+        elapsed = time.perf_counter() - start
+
+    # The counted batches come from the same dataset, collator and sampler as
+    # the trained ones
+    return real / elapsed, 1 - real / total
+
+
+def main():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    corpus = build_corpus()
+
+    print(
+        f"model={MODEL} steps={STEPS} batch_size={BATCH_SIZE} "
+        f"max_length={Trainer.training_max_length(tokenizer)}"
+    )
+    for mode in (
+        TrainingDataMode.PADDED,
+        TrainingDataMode.DYNAMIC,
+        TrainingDataMode.PACKED,
+    ):
+        tokens_per_second, pad_ratio = run(mode, corpus, tokenizer)
+        print(
+            f"{mode.value:>8}: {tokens_per_second:>10,.0f} real tokens/sec, "
+            f"{pad_ratio:>6.1%} padding"
+        )
+
+
+if __name__ == "__main__":
+    main()
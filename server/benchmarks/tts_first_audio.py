@@ -0,0 +1,67 @@
+"""
+Time to first audio and total narration time for a multi-sentence reply:
+Synthesizer.generate_audio, which narrates the whole reply in one Bark call,
+against the first and last chunk of Synthesizer.stream_audio. Downloads Bark on
+first run.
+
+Run from the server directory:
+    python -m benchmarks.tts_first_audio
+"""
+
+import time
+
+from utils.nlp.synthesizer import Synthesizer
+
+REPLY = (
+    "Sure, here is a short answer. "
+    "Dogs are often named after their looks, so a brown dog might be called "
+    "Hazel or Cocoa. "
+    "Others are named after favourite foods, places, or characters from books "
+    "and films. "
+    "Whatever you choose, pick something short that is easy to call out across "
+    "a park."
+)
+REPEATS = 3
+
+
+def time_whole(synthesizer) -> tuple[float, float]:
+    start = time.perf_counter()
+    synthesizer.generate_audio(REPLY)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def time_streamed(synthesizer) -> tuple[float, float]:
+    start = time.perf_counter()
+    first = None
+    for _ in synthesizer.stream_audio(REPLY):
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def report(label: str, timings: list[tuple[float, float]]):
+    first = sorted(t[0] for t in timings)[len(timings) // 2]
+    total = sorted(t[1] for t in timings)[len(timings) // 2]
+    print(f"{label:>10} {first:>16.2f} {total:>12.2f}")
+
+
+def main():
+    synthesizer = Synthesizer(cache_speech=False)
+    # Load Bark and warm it up before timing
+    synthesizer.synthesize("Hello.")
+
+    whole = [time_whole(synthesizer) for _ in range(REPEATS)]
+    streamed = [time_streamed(synthesizer) for _ in range(REPEATS)]
+
+    print(
+        f"chunks={len(Synthesizer.split_sentences(REPLY))} median of {REPEATS} "
+        "runs"
+    )
+    print(f"{'':>10} {'first audio (s)':>16} {'total (s)':>12}")
+    report("whole", whole)
+    report("streamed", streamed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Per-turn latency at turns 1, 10 and 50 of one conversation, with and without
+reusing the previous turn's KV cache.
+
+Run from the server directory:
+    python -m benchmarks.turn_latency
+"""
+
+import time
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from services.env import EnvService, EnvVars
+from utils.nlp.enums import Models
+from utils.nlp.scheduler import GenerationScheduler
+
+MODEL = EnvService.get(EnvVars.DEFAULT_MODEL.value, Models.GPT2.value)
+NEW_TOKENS = 8
+TURNS = 50
+REPORT_TURNS = (1, 10, 50)
+USER_MESSAGE = "Tell me more."
+
+
+def run_conversation(scheduler, tokenizer, reuse: bool) -> dict[int, float]:
+    """
+    Plays TURNS turns of a plain-text transcript (a stand-in for a chat
+    template) and times each turn.
+    """
+    transcript = ""
+    cache = None
+    latencies = {}
+
+    for turn in range(1, TURNS + 1):
+        transcript += f"User: {USER_MESSAGE}\nAgent:"
+        prompt_ids = tokenizer(transcript).input_ids
+        cached_ids, cached_kv = cache if (reuse and cache) else (None, None)
+
+        start = time.perf_counter()
+        generation = scheduler.submit(
+            prompt_ids,
+            NEW_TOKENS,
+            prefix_ids=cached_ids,
+            prefix_cache=cached_kv,
+            keep_cache=reuse,
+        )
+        output_ids = generation.result()
+        latencies[turn] = time.perf_counter() - start
+
+        if reuse:
+            cache = (generation.cached_ids, generation.final_cache)
+        transcript += tokenizer.decode(output_ids) + "\n"
+
+    return latencies
+
+
+def main():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL, torch_dtype=torch.float32
+    )
+    model.generation_config.do_sample = False
+    scheduler = GenerationScheduler(model)
+    scheduler._eos_token_ids = set()
+
+    # Warm up allocator and kernels before timing
+    scheduler.generate(tokenizer(USER_MESSAGE).input_ids, NEW_TOKENS)
+
+    full = run_conversation(scheduler, tokenizer, reuse=False)
+    reused = run_conversation(scheduler, tokenizer, reuse=True)
+
+    print(f"model={MODEL} new_tokens={NEW_TOKENS}")
+    print(f"{'turn':>5} {'full prefill ms':>16} {'cached prefix ms':>17}")
+    for turn in REPORT_TURNS:
+        print(
+            f"{turn:>5} {full[turn] * 1000:>16.1f} {reused[turn] * 1000:>17.1f}"
+        )
+
+    scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()
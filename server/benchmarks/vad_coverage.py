@@ -0,0 +1,108 @@
+"""
+Regression check for streaming transcription's voice activity detection:
+synthetic recordings of tones standing in for speech are uploaded in pieces
+through a TranscriptionStream, and every tone must reach a transcribed segment,
+including speech that starts at the very first sample and speech over steady
+background noise. Segments are "transcribed" as the frequencies of the tones
+they hold, so no ASR model is needed. Exits non-zero if a tone is dropped.
+
+Run from the server directory:
+    python -m benchmarks.vad_coverage
+"""
+
+import numpy as np
+import sys
+
+from services.audio import AUDIO_SAMPLE_RATE
+from utils.nlp.transcription import TranscriptionStream
+
+CONTENT_TYPE = f"audio/pcm;rate={AUDIO_SAMPLE_RATE}"
+PIECE_SECONDS = 0.25
+
+# (seconds, tone amplitude or None for silence) per part of each recording; each
+# tone has its own frequency
+RECORDINGS = {
+    "speech at t=0": [(3, 0.1), (1, None), (2, 0.4), (1, None)],
+    "silence first": [(1, None), (2, 0.1), (1, None), (2, 0.4), (1, None)],
+    "quiet then loud, no gap": [(2, 0.05), (2, 0.4), (1, None)],
+    "steady noise": [(8, None), (2, 0.4), (1, None)],
+}
+NOISE = {"steady noise": 0.05}
+
+
+def frequency(part: int) -> int:
+    return 200 + 100 * part
+
+
+class ToneTranscriber:
+    """
+    Stands in for the Synthesizer, transcribing each segment as the tone
+    frequencies it holds.
+    """
+
+    def __init__(self, frequencies: list[int]):
+        self.frequencies = frequencies
+        self.durations = []
+
+    def transcribe_audio(self, data):
+        self.durations.append(len(data) / AUDIO_SAMPLE_RATE)
+        spectrum = np.abs(np.fft.rfft(data))
+        hz_per_bin = AUDIO_SAMPLE_RATE / len(data)
+        found = [
+            f
+            for f in self.frequencies
+            if spectrum[round(f / hz_per_bin)] > 20 * np.median(spectrum)
+        ]
+        return {"text": " ".join(str(f) for f in found)}
+
+
+def render(parts: list, noise: float) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    audio = []
+    for i, (seconds, amplitude) in enumerate(parts):
+        t = np.arange(int(seconds * AUDIO_SAMPLE_RATE)) / AUDIO_SAMPLE_RATE
+        audio.append(
+            amplitude * np.sin(2 * np.pi * frequency(i) * t)
+            if amplitude
+            else np.zeros_like(t)
+        )
+    audio = np.concatenate(audio)
+    return (audio + rng.normal(0, noise, len(audio))).astype(np.float32)
+
+
+def transcribe(
+    audio: np.ndarray, frequencies: list[int]
+) -> tuple[str, list[float]]:
+    transcriber = ToneTranscriber(frequencies)
+    stream = TranscriptionStream(transcriber, CONTENT_TYPE)
+    upload = (np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes()
+    piece = int(PIECE_SECONDS * AUDIO_SAMPLE_RATE) * 2
+    for offset in range(0, len(upload), piece):
+        stream.write(upload[offset : offset + piece])
+    return stream.finish(), transcriber.durations
+
+
+def main():
+    failures = 0
+    for name, parts in RECORDINGS.items():
+        tones = [
+            frequency(i) for i, (_, amplitude) in enumerate(parts) if amplitude
+        ]
+        transcript, durations = transcribe(
+            render(parts, NOISE.get(name, 0.0)), tones
+        )
+        missing = [f"{f} Hz" for f in tones if str(f) not in transcript.split()]
+        failures += bool(missing)
+
+        status = "ok" if not missing else f"MISSING {missing}"
+        segments = ", ".join(f"{seconds:.2f} s" for seconds in durations)
+        print(
+            f"{name:>24}: {len(durations)} segments ({segments}) -> "
+            f"{transcript!r} {status}"
+        )
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Per-stage and end-to-end latency of a narrated voice question: the previous
+sequential path (decode, transcribe, generate the whole reply, narrate the whole
+reply) against the overlapped one (Agent.transcribe_upload then
+Agent.narrate_reply), where narration starts on the reply's first sentence while
+the rest is still being decoded. Both decode and transcribe the complete upload
+the same way; they differ in the reply and narration stages.
+Times are milliseconds since the upload started. The question is recorded with
+Bark, so Bark and Whisper are downloaded on first run.
+
+Run from the server directory:
+    python -m benchmarks.voice_latency
+"""
+
+import io
+import numpy as np
+import statistics
+import time
+
+from services.audio import AUDIO_SAMPLE_RATE, AudioService
+from utils.nlp.agent import Agent
+
+CONTENT_TYPE = f"audio/pcm;rate={AUDIO_SAMPLE_RATE}"
+QUESTION = "What is a good name for a dog, and why?"
+REPEATS = 3
+
+
+def record(agent) -> bytes:
+    """The question spoken by Bark, as a raw 16-bit PCM upload."""
+    audio_data, sampling_rate = agent.synthesizer.synthesize(QUESTION)
+    audio_data = AudioService.to_float32_mono(audio_data, 1, sampling_rate, 1.0)
+    return (np.clip(audio_data, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+def sequential(agent, upload: bytes, session_id: str) -> dict[str, float]:
+    start = time.perf_counter()
+    audio_data = AudioService.load_audio(io.BytesIO(upload), CONTENT_TYPE)
+    decoded = time.perf_counter()
+    transcription = agent.synthesizer.transcribe_audio(audio_data).get(
+        "text", ""
+    )
+    transcribed = time.perf_counter()
+    reply = agent.generate_reply(transcription, session_id)
+    replied = time.perf_counter()
+    agent.synthesizer.generate_audio(reply)
+    narrated = time.perf_counter()
+
+    return {
+        "decode": decoded - start,
+        "transcription": transcribed - start,
+        "reply": replied - start,
+        "first_audio": narrated - start,
+        "narration": narrated - start,
+    }
+
+
+def overlapped(agent, upload: bytes, session_id: str) -> dict[str, float]:
+    start = time.perf_counter()
+    transcription = agent.transcribe_upload(io.BytesIO(upload), CONTENT_TYPE)
+    timings = {"transcription": time.perf_counter() - start}
+    _, _, stages = agent.narrate_reply(transcription, session_id)
+    timings.update({name: at - start for name, at in stages.items()})
+    return timings
+
+
+def report(label: str, runs: list[dict[str, float]]):
+    print(label)
+    for name in runs[0]:
+        median = statistics.median(run.get(name, 0.0) for run in runs)
+        print(f"{name:>16} {median * 1000:>10.0f}")
+
+
+def main():
+    agent = Agent()
+    upload = record(agent)
+    # Every run narrates afresh rather than from the speech cache
+    agent.synthesizer.speech_cache = None
+    # Load Whisper and warm up every model before timing
+    overlapped(agent, upload, "benchmark-warmup")
+
+    report(
+        "sequential (ms)",
+        [
+            sequential(agent, upload, f"benchmark-sequential-{i}")
+            for i in range(REPEATS)
+        ],
+    )
+    report(
+        "overlapped (ms)",
+        [
+            overlapped(agent, upload, f"benchmark-overlapped-{i}")
+            for i in range(REPEATS)
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Production server settings, which gunicorn loads automatically when started from
+    the server directory: gunicorn app:app
+The language model is loaded once in the master process, before the workers are
+forked, so every worker serves the same weights from copy-on-write memory rather
+than loading its own copy. The master only loads weights: forward passes start
+PyTorch's OpenMP and MKL thread pools, which a forked worker inherits in a
+broken state, so the precision guard and the warm-up run in each worker. app.py
+itself is imported in each worker after the fork, since the Agent it builds
+starts threads, and threads do not survive a fork.
+"""
+
+import gc
+import os
+
+from services.env import EnvService, EnvVars
+
+bind = "{}:{}".format(
+    EnvService.get(EnvVars.SERVER_HOST.value, "0.0.0.0"),
+    EnvService.get_int(EnvVars.SERVER_PORT.value, 1587),
+)
+workers = EnvService.get_int(EnvVars.SERVER_WORKERS.value, 2)
+# Requests in flight on one worker's threads are batched together by its
+# generation scheduler
+worker_class = "gthread"
+threads = EnvService.get_int(EnvVars.SERVER_THREADS.value, 8)
+preload_app = False
+
+
+def on_starting(server):
+    import torch
+
+    from utils.nlp.agent import Agent
+
+    # Keeps loading on the calling thread, so no intra-op pool exists yet when
+    # the workers are forked
+    torch.set_num_threads(1)
+    Agent.preload_model()
+    # The collector would otherwise write to every preloaded object it scans,
+    # copying those pages into each worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    # Split the cores between workers rather than have every worker's intra-op
+    # threads contend for all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
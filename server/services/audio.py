@@ -1,47 +1,509 @@
 import io
+import numpy as np
 import scipy.io.wavfile as wav
+import subprocess
+import threading
+import time
 
 from enum import Enum
-from pydub import AudioSegment
+from math import gcd
 
 from services.env import EnvService, EnvVars
 from utils.logger import Logger, LogLevel
+from utils.metrics import STAGE_SECONDS, ServingStages
 
 AUDIO_SAMPLE_RATE = EnvService.get_int(EnvVars.AUDIO_SAMPLE_RATE.value, 16000)
 DEBUG = EnvService.is_debug()
 
+# ffmpeg is already required by pydub; it is driven directly here to skip the
+# intermediate WAV
+FFMPEG_BINARY = "ffmpeg"
+STREAM_CHUNK_SIZE = 64 * 1024
+# Voice uploads from MediaRecorder average about 32 kbit/s of Opus, used to size
+# the decode buffer up front
+COMPRESSED_BYTES_PER_SECOND = 4000
+MAX_PREALLOCATED_SECONDS = 60
+# Opus at this bitrate is transparent for Bark's 24 kHz speech, about a
+# sixteenth the size of 16-bit WAV
+OPUS_BITRATE = "24k"
+AUDIO_DECODE_SECONDS = STAGE_SECONDS.labels(ServingStages.AUDIO_DECODE.value)
+
 
 class AudioFormat(Enum):
+    # Anything ffmpeg can read, typically webm/opus from the client's
+    # MediaRecorder
+    ENCODED = "encoded"
+    PCM = "pcm"
+    WAV = "wav"
+
+
+class AudioCodec(Enum):
     WAV = "wav"
-    WEBM = "webm"
+    OPUS = "opus"
+
+
+# Content types of encoded replies, by codec. Opus is sent in an Ogg container,
+# which browsers can seek in.
+CODEC_CONTENT_TYPES = {
+    AudioCodec.WAV: "audio/wav",
+    AudioCodec.OPUS: "audio/ogg; codecs=opus",
+}
+
+
+# Content types of raw, headerless PCM uploads and their sample layout.
+# audio/L16 is big-endian per RFC 2586.
+RAW_PCM_CONTENT_TYPES = {
+    "audio/pcm": "<i2",
+    "audio/l16": ">i2",
+}
+
+# (WAVE format tag, bits per sample) -> sample dtype, full-scale value and
+# offset
+WAV_SAMPLE_FORMATS = {
+    (1, 8): ("u1", 128.0, 128.0),
+    (1, 16): ("<i2", 32768.0, 0.0),
+    (1, 32): ("<i4", 2147483648.0, 0.0),
+    (3, 32): ("<f4", 1.0, 0.0),
+}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
 
 class AudioService:
     @staticmethod
-    def load_audio(raw_bytes):
+    def load_audio(
+        source,
+        content_type: str | None = None,
+        content_length: int | None = None,
+    ):
+        """
+        Decodes an uploaded recording into a float32 mono array at
+        AUDIO_SAMPLE_RATE, scaled to [-1, 1]. WAV and raw PCM (audio/pcm, 16-bit
+        little-endian; audio/L16, big-endian; with optional ;rate= and
+        ;channels= parameters) are converted in place without decoding. Anything
+        else, e.g. the webm/opus the client records, is decoded by ffmpeg
+        straight into a preallocated output buffer as the upload streams in.
+        (param source): The upload as bytes or a readable stream, e.g.
+            request.stream.
+        (param content_type): The upload's Content-Type header.
+        (param content_length): The upload's size in bytes, if known, used to
+            size the decode buffer.
+        """
         Logger.log(LogLevel.INFO, "Loading audio data from request...")
+        start = time.perf_counter()
 
-        if not raw_bytes or len(raw_bytes) == 0:
+        stream = (
+            io.BytesIO(source)
+            if isinstance(source, (bytes, bytearray))
+            else source
+        )
+        head = stream.read(12)
+        if not head:
             Logger.log(LogLevel.ERROR, "Received empty audio data.")
             return None
 
-        audio_buffer = io.BytesIO(raw_bytes)
-        wav_buffer = io.BytesIO()
+        mime_type, params = AudioService.parse_content_type(content_type)
+        if mime_type in RAW_PCM_CONTENT_TYPES:
+            audio_format = AudioFormat.PCM
+            audio_data = AudioService.convert_pcm(
+                head + stream.read(),
+                RAW_PCM_CONTENT_TYPES[mime_type],
+                int(params.get("rate", AUDIO_SAMPLE_RATE)),
+                int(params.get("channels", 1)),
+            )
+        elif head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+            audio_format = AudioFormat.WAV
+            data = head + stream.read()
+            audio_data = AudioService.convert_wav(data)
+            if audio_data is None:
+                # Sample formats without a direct conversion, e.g. 24-bit, still
+                # go through ffmpeg
+                audio_data = AudioService.decode(
+                    b"", io.BytesIO(data), len(data)
+                )
+        else:
+            audio_format = AudioFormat.ENCODED
+            audio_data = AudioService.decode(head, stream, content_length)
+
+        AUDIO_DECODE_SECONDS.observe(time.perf_counter() - start)
+        if DEBUG:
+            AudioService.save_debug_audio(audio_data)
 
-        audio_segment = AudioSegment.from_file(
-            audio_buffer, format=AudioFormat.WEBM.value
+        Logger.log(
+            LogLevel.INFO,
+            f"Audio data loaded successfully ({audio_format.value}, "
+            f"{len(audio_data) / AUDIO_SAMPLE_RATE:.2f}s).",
         )
-        audio_segment = audio_segment.set_frame_rate(AUDIO_SAMPLE_RATE).set_channels(1)
-        audio_segment.export(wav_buffer, format=AudioFormat.WAV.value)
-        wav_buffer.seek(0)
+        return audio_data
 
-        if DEBUG:
-            Logger.log(LogLevel.DEBUG, "Saving audio prompt to debug.wav")
-            with open("debug.wav", "wb") as f:
-                f.write(wav_buffer.getvalue())
+    @staticmethod
+    def convert_pcm(
+        data: bytes, dtype: str, sample_rate: int, channels: int
+    ) -> np.ndarray:
+        samples = np.frombuffer(
+            data, dtype=dtype, count=len(data) // np.dtype(dtype).itemsize
+        )
+        return AudioService.to_float32_mono(
+            samples, channels, sample_rate, 32768.0
+        )
+
+    @staticmethod
+    def convert_wav(data: bytes) -> np.ndarray | None:
+        """
+        Reads the samples of a WAV file in place; returns None for sample
+        formats without a direct conversion.
+        """
+        fmt, samples = None, None
+        offset = 12
+        while offset + 8 <= len(data):
+            chunk_id = data[offset : offset + 4]
+            size = int.from_bytes(data[offset + 4 : offset + 8], "little")
+            body = offset + 8
+
+            if chunk_id == b"fmt ":
+                format_tag = int.from_bytes(data[body : body + 2], "little")
+                channels = int.from_bytes(data[body + 2 : body + 4], "little")
+                sample_rate = int.from_bytes(
+                    data[body + 4 : body + 8], "little"
+                )
+                bits = int.from_bytes(data[body + 14 : body + 16], "little")
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                    # The real format tag leads the sub-format GUID
+                    format_tag = int.from_bytes(
+                        data[body + 24 : body + 26], "little"
+                    )
+                fmt = (format_tag, channels, sample_rate, bits)
+            elif chunk_id == b"data":
+                # Streaming writers leave the data size unset, in which case the
+                # samples run to the end of the file
+                end = (
+                    len(data)
+                    if size in (0, 0xFFFFFFFF)
+                    else min(body + size, len(data))
+                )
+                samples = (body, end)
+                break
+
+            offset = body + size + (size & 1)
+
+        if fmt is None or samples is None:
+            raise ValueError("Malformed WAV upload.")
+
+        format_tag, channels, sample_rate, bits = fmt
+        if (format_tag, bits) not in WAV_SAMPLE_FORMATS:
+            return None
 
-        audio_data = wav.read(wav_buffer)
-        Logger.log(LogLevel.INFO, "Audio data loaded successfully.")
+        dtype, scale, zero = WAV_SAMPLE_FORMATS[(format_tag, bits)]
+        start, end = samples
+        itemsize = np.dtype(dtype).itemsize
+        pcm = np.frombuffer(
+            data, dtype=dtype, count=(end - start) // itemsize, offset=start
+        )
+        return AudioService.to_float32_mono(
+            pcm, channels, sample_rate, scale, zero
+        )
+
+    @staticmethod
+    def to_float32_mono(
+        samples: np.ndarray,
+        channels: int,
+        sample_rate: int,
+        scale: float,
+        zero: float = 0.0,
+    ) -> np.ndarray:
+        """
+        Downmixes, scales and resamples interleaved samples into one new float32
+        array at AUDIO_SAMPLE_RATE.
+        """
+        frames = len(samples) // max(channels, 1)
+        audio_data = np.empty(frames, dtype=np.float32)
+        if channels > 1:
+            np.mean(
+                samples[: frames * channels].reshape(frames, channels),
+                axis=1,
+                dtype=np.float32,
+                out=audio_data,
+            )
+        else:
+            audio_data[:] = samples
+        if zero:
+            audio_data -= zero
+        audio_data *= 1.0 / scale
 
-        wav_buffer.close()
+        if sample_rate != AUDIO_SAMPLE_RATE:
+            # Imported on first use, since scipy.signal takes over a second to
+            # import and most audio needs no resampling
+            from scipy.signal import resample_poly
+
+            divisor = gcd(AUDIO_SAMPLE_RATE, sample_rate)
+            audio_data = resample_poly(
+                audio_data, AUDIO_SAMPLE_RATE // divisor, sample_rate // divisor
+            ).astype(np.float32, copy=False)
         return audio_data
+
+    @staticmethod
+    def decode(
+        head: bytes, stream, content_length: int | None = None
+    ) -> np.ndarray:
+        """
+        Pipes the upload through ffmpeg and reads its float32 mono output
+        directly into a numpy buffer.
+        """
+        process = AudioService.start_decoder()
+
+        # Feed the upload from another thread so ffmpeg can decode while it is
+        # still arriving
+        feeder = threading.Thread(
+            target=AudioService._feed,
+            args=(process.stdin, head, stream),
+            daemon=True,
+        )
+        feeder.start()
+
+        seconds = (content_length or 0) / COMPRESSED_BYTES_PER_SECOND
+        buffer = np.empty(
+            int(
+                min(max(seconds, 1), MAX_PREALLOCATED_SECONDS)
+                * AUDIO_SAMPLE_RATE
+            ),
+            dtype=np.float32,
+        )
+        filled = 0
+        while True:
+            if filled == buffer.nbytes:
+                grown = np.empty(len(buffer) * 2, dtype=np.float32)
+                grown[: len(buffer)] = buffer
+                buffer = grown
+            read = process.stdout.readinto(
+                memoryview(buffer).cast("B")[filled:]
+            )
+            if not read:
+                break
+            filled += read
+
+        feeder.join()
+        errors = process.stderr.read().decode("utf-8", errors="replace").strip()
+        if process.wait() != 0:
+            raise ValueError(f"Could not decode audio upload: {errors}")
+        return buffer[: filled // buffer.itemsize]
+
+    @staticmethod
+    def start_decoder() -> subprocess.Popen:
+        """
+        An ffmpeg process decoding whatever is written to its stdin into float32
+        mono PCM on its stdout.
+        """
+        return subprocess.Popen(
+            [
+                FFMPEG_BINARY,
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                "-f",
+                "f32le",
+                "-ac",
+                "1",
+                "-ar",
+                str(AUDIO_SAMPLE_RATE),
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    @staticmethod
+    def encode(
+        samples: np.ndarray,
+        sample_rate: int,
+        codec: AudioCodec = AudioCodec.WAV,
+    ) -> bytes:
+        """
+        Encodes int16 mono samples as a playable file.
+        (param codec): WAV is written directly; Opus is encoded by ffmpeg into
+            an Ogg container.
+        """
+        if codec == AudioCodec.WAV:
+            buffer = io.BytesIO()
+            wav.write(buffer, sample_rate, samples)
+            return buffer.getvalue()
+
+        result = subprocess.run(
+            [
+                FFMPEG_BINARY,
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-f",
+                "s16le",
+                "-ar",
+                str(sample_rate),
+                "-ac",
+                "1",
+                "-i",
+                "pipe:0",
+                "-c:a",
+                "libopus",
+                "-b:a",
+                OPUS_BITRATE,
+                "-application",
+                "voip",
+                "-f",
+                "ogg",
+                "pipe:1",
+            ],
+            input=np.ascontiguousarray(samples, dtype="<i2").tobytes(),
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            raise ValueError(
+                "Could not encode audio: "
+                f"{result.stderr.decode('utf-8', errors='replace').strip()}"
+            )
+        return result.stdout
+
+    @staticmethod
+    def _feed(stdin, head: bytes, stream):
+        try:
+            stdin.write(head)
+            while chunk := stream.read(STREAM_CHUNK_SIZE):
+                stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit status reports why
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    @staticmethod
+    def parse_content_type(content_type: str | None) -> tuple[str | None, dict]:
+        if not content_type:
+            return None, {}
+        mime_type, *options = content_type.split(";")
+        params = {}
+        for option in options:
+            key, _, value = option.partition("=")
+            params[key.strip().lower()] = value.strip().strip('"')
+        return mime_type.strip().lower(), params
+
+    @staticmethod
+    def save_debug_audio(audio_data: np.ndarray):
+        """Writes the decoded prompt to debug.wav off the request thread."""
+
+        def write():
+            try:
+                wav.write("debug.wav", AUDIO_SAMPLE_RATE, audio_data)
+                Logger.log(LogLevel.DEBUG, "Saved audio prompt to debug.wav")
+            except Exception as e:
+                Logger.log(LogLevel.ERROR, f"Failed to save debug.wav, {e}")
+
+        threading.Thread(
+            target=write, name="debug-audio-writer", daemon=True
+        ).start()
+
+
+class AudioStreamDecoder:
+    """
+    Decodes a recording uploaded in pieces, e.g. MediaRecorder timeslices where
+    only the first piece carries the container header, handing float32 mono
+    samples at AUDIO_SAMPLE_RATE to on_samples as soon as they are decoded. Raw
+    PCM pieces (see RAW_PCM_CONTENT_TYPES) are converted directly; everything
+    else runs through one ffmpeg process kept open for the life of the stream.
+    """
+
+    def __init__(self, on_samples, content_type: str | None = None):
+        """
+        (param on_samples): Called with each decoded numpy array, from the
+            writer's or the decoder's thread.
+        """
+        self.on_samples = on_samples
+        self.error = None
+
+        mime_type, params = AudioService.parse_content_type(content_type)
+        self._pcm_dtype = RAW_PCM_CONTENT_TYPES.get(mime_type)
+        self._pcm_rate = int(params.get("rate", AUDIO_SAMPLE_RATE))
+        self._pcm_channels = int(params.get("channels", 1))
+        self._pending = b""
+
+        self._process = None
+        self._reader = None
+        if self._pcm_dtype is None:
+            self._process = AudioService.start_decoder()
+            self._reader = threading.Thread(
+                target=self._read, name="audio-stream-decoder", daemon=True
+            )
+            self._reader.start()
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        if self._process is None:
+            # Carry partial frames over to the next piece
+            data = self._pending + data
+            frame_size = np.dtype(self._pcm_dtype).itemsize * self._pcm_channels
+            usable = len(data) - len(data) % frame_size
+            self._pending = data[usable:]
+            if usable:
+                self.on_samples(
+                    AudioService.convert_pcm(
+                        data[:usable],
+                        self._pcm_dtype,
+                        self._pcm_rate,
+                        self._pcm_channels,
+                    )
+                )
+            return
+
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            raise ValueError(f"Could not decode audio stream: {self._errors()}")
+
+    def close(self):
+        """
+        Ends the input and waits until every remaining sample has been handed to
+        on_samples.
+        """
+        if self._process is None:
+            return
+        # Only the decoding left once the last piece has arrived delays the
+        # request, so that is what is timed
+        start = time.perf_counter()
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        AUDIO_DECODE_SECONDS.observe(time.perf_counter() - start)
+        if self._process.wait() != 0:
+            raise ValueError(f"Could not decode audio stream: {self._errors()}")
+
+    def abort(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+
+    def _read(self):
+        remainder = b""
+        while chunk := self._process.stdout.read1(STREAM_CHUNK_SIZE):
+            chunk = remainder + chunk
+            usable = len(chunk) - len(chunk) % 4
+            remainder = chunk[usable:]
+            if usable:
+                try:
+                    self.on_samples(np.frombuffer(chunk[:usable], dtype="<f4"))
+                except Exception as e:
+                    self.error = e
+                    Logger.log(
+                        LogLevel.ERROR, f"Audio stream consumer failed, {e}"
+                    )
+
+    def _errors(self) -> str:
+        return (
+            self._process.stderr.read()
+            .decode("utf-8", errors="replace")
+            .strip()
+        )
@@ -7,20 +7,55 @@ load_dotenv()
 
 
 class EnvVars(Enum):
+    ASR_MAX_BATCH_SIZE = "ASR_MAX_BATCH_SIZE"
+    ASR_MAX_WAIT_MS = "ASR_MAX_WAIT_MS"
+    ASR_VAD_SILENCE_MS = "ASR_VAD_SILENCE_MS"
+    AUDIO_CLIP_TTL_SECONDS = "AUDIO_CLIP_TTL_SECONDS"
     AUDIO_SAMPLE_RATE = "AUDIO_SAMPLE_RATE"
+    DATASET_CACHE_DIR = "DATASET_CACHE_DIR"
+    DATASET_NUM_PROC = "DATASET_NUM_PROC"
     DEBUG = "DEBUG"
     DEFAULT_MODEL = "DEFAULT_MODEL"
     DEVICE_MAP = "DEVICE_MAP"
+    ENGINE_CACHE_DIR = "ENGINE_CACHE_DIR"
+    GENERATION_MAX_BATCH_SIZE = "GENERATION_MAX_BATCH_SIZE"
+    GENERATION_MAX_WAIT_MS = "GENERATION_MAX_WAIT_MS"
+    INFERENCE_ENGINE = "INFERENCE_ENGINE"
     MAX_NEW_TOKENS = "MAX_NEW_TOKENS"
+    MODEL_MEMORY_BUDGET_MB = "MODEL_MEMORY_BUDGET_MB"
+    MODEL_PRECISION = "MODEL_PRECISION"
+    PRECISION_GUARD_SAMPLES = "PRECISION_GUARD_SAMPLES"
+    PRECISION_MAX_PERPLEXITY_DRIFT = "PRECISION_MAX_PERPLEXITY_DRIFT"
     SELECTED_PRETRAINED_MODEL = "SELECTED_PRETRAINED_MODEL"
+    SESSION_PROMPT_TOKEN_BUDGET = "SESSION_PROMPT_TOKEN_BUDGET"
+    SESSION_SPILL_DIR = "SESSION_SPILL_DIR"
+    SESSION_STORE_MAX_TOKENS = "SESSION_STORE_MAX_TOKENS"
     PRETRAINED_MODEL_DIR = "PRETRAINED_MODEL_DIR"
+    RESPONSE_CACHE_SIZE = "RESPONSE_CACHE_SIZE"
     ROUTE_ASR = "ROUTE_ASR"
     ROUTE_IS_ALIVE = "ROUTE_IS_ALIVE"
+    ROUTE_IS_READY = "ROUTE_IS_READY"
+    ROUTE_METRICS = "ROUTE_METRICS"
+    ROUTE_MODEL = "ROUTE_MODEL"
     ROUTE_TTS = "ROUTE_TTS"
     ROUTE_TRAINING_INIT = "ROUTE_TRAINING_INIT"
     SERVER_PORT = "SERVER_PORT"
     SERVER_HOST = "SERVER_HOST"
+    SERVER_THREADS = "SERVER_THREADS"
+    SERVER_WORKERS = "SERVER_WORKERS"
+    SPEECH_PRECISION = "SPEECH_PRECISION"
     TRAINING_ARGS_NUM_EPOCHS = "TRAINING_ARGS_NUM_EPOCHS"
+    TRAINING_DATA_MODE = "TRAINING_DATA_MODE"
+    TRAINING_MAX_LENGTH = "TRAINING_MAX_LENGTH"
+    TRAINING_MAX_STEPS = "TRAINING_MAX_STEPS"
+    TRAINING_NUM_THREADS = "TRAINING_NUM_THREADS"
+    TTS_CACHE_DIR = "TTS_CACHE_DIR"
+    TTS_CACHE_DISK_MB = "TTS_CACHE_DISK_MB"
+    TTS_CACHE_MEMORY_MB = "TTS_CACHE_MEMORY_MB"
+    TTS_MAX_BATCH_SIZE = "TTS_MAX_BATCH_SIZE"
+    TTS_MAX_WAIT_MS = "TTS_MAX_WAIT_MS"
+    TTS_SEED = "TTS_SEED"
+    TTS_VOICE_PRESET = "TTS_VOICE_PRESET"
 
 
 _DEBUG = os.getenv(EnvVars.DEBUG.value, "false").strip()
@@ -30,7 +65,9 @@ DEBUG = _DEBUG.lower() == "true" if _DEBUG else False
 class EnvService:
     @staticmethod
     def get(key: str, default: str = None) -> str:
-        assert EnvVars(key) is not None, f"Invalid environment variable key: {key}"
+        assert (
+            EnvVars(key) is not None
+        ), f"Invalid environment variable key: {key}"
 
         value = os.getenv(key)
         if value is None or value == "":
@@ -44,7 +81,9 @@ class EnvService:
 
     @staticmethod
     def get_int(key: str, default: int = None) -> int:
-        assert EnvVars(key) is not None, f"Invalid environment variable key: {key}"
+        assert (
+            EnvVars(key) is not None
+        ), f"Invalid environment variable key: {key}"
 
         value = os.getenv(key)
         if value is None or value == "":
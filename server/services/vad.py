@@ -0,0 +1,173 @@
+import numpy as np
+
+from collections import deque
+
+from services.env import EnvService, EnvVars
+
+ASR_VAD_SILENCE_MS = EnvService.get_int(EnvVars.ASR_VAD_SILENCE_MS.value, 500)
+VAD_FRAME_MS = 30
+# Speech must last this long to open a segment, which filters out clicks and
+# pops
+VAD_MIN_SPEECH_MS = 90
+# Audio kept before the detected start of speech and after its end, so soft
+# onsets and endings are not clipped
+VAD_PADDING_MS = 200
+# Whisper attends to at most 30 seconds, so longer utterances are cut into
+# several segments
+VAD_MAX_SEGMENT_SECONDS = 20
+# Frames this many times louder than the running noise floor count as speech
+VAD_SPEECH_RATIO = 3.0
+VAD_MIN_SPEECH_RMS = 0.01
+VAD_NOISE_ADAPTATION = 0.05
+# During speech the noise floor may only rise, this slowly, towards the quietest
+# frame of the last VAD_NOISE_WINDOW_MS; pauses between words keep that low
+# while speaking, but steady background noise is learned within a few seconds
+VAD_NOISE_RISE = 0.002
+VAD_NOISE_WINDOW_MS = 1000
+
+
+class VoiceActivityDetector:
+    """
+    Energy-based voice activity detection over a stream of float32 mono samples.
+    Each frame's RMS is compared to a running estimate of the background noise,
+    which starts low so that a recording beginning mid-speech is not taken for
+    noise; a segment opens after VAD_MIN_SPEECH_MS of speech and closes after
+    ASR_VAD_SILENCE_MS of silence (or VAD_MAX_SEGMENT_SECONDS), and is returned
+    with VAD_PADDING_MS of context on either side.
+    """
+
+    def __init__(self, sample_rate: int, silence_ms: int = ASR_VAD_SILENCE_MS):
+        self.sample_rate = sample_rate
+        self.frame_size = sample_rate * VAD_FRAME_MS // 1000
+        self.min_speech_frames = max(1, VAD_MIN_SPEECH_MS // VAD_FRAME_MS)
+        self.silence_frames = max(1, silence_ms // VAD_FRAME_MS)
+        self.padding_frames = VAD_PADDING_MS // VAD_FRAME_MS
+        self.max_segment_frames = VAD_MAX_SEGMENT_SECONDS * 1000 // VAD_FRAME_MS
+
+        # Starting here puts the first frames' threshold at VAD_MIN_SPEECH_RMS
+        self.noise_floor = VAD_MIN_SPEECH_RMS / VAD_SPEECH_RATIO
+        # Sample offset at which the first segment starts, padding included,
+        # once one has opened
+        self.first_segment_start = None
+        self._frames = 0
+        self._recent_rms = deque(
+            maxlen=max(1, VAD_NOISE_WINDOW_MS // VAD_FRAME_MS)
+        )
+        self._remainder = np.empty(0, dtype=np.float32)
+        # Frames since the last segment ended, trimmed to the padding plus a
+        # pending speech onset
+        self._history = []
+        self._segment = []
+        self._speech_run = 0
+        self._silence_run = 0
+
+    def push(self, samples: np.ndarray) -> list[np.ndarray]:
+        """Feeds samples in and returns every segment they complete."""
+        samples = (
+            np.concatenate((self._remainder, samples))
+            if len(self._remainder)
+            else samples
+        )
+        usable = len(samples) - len(samples) % self.frame_size
+        self._remainder = samples[usable:].copy()
+
+        segments = []
+        for frame in samples[:usable].reshape(-1, self.frame_size):
+            segment = self._push_frame(frame)
+            if segment is not None:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> np.ndarray | None:
+        """
+        Ends the stream, returning the segment in progress if it contains
+        speech.
+        """
+        if self._segment and len(self._remainder):
+            self._segment.append(self._remainder)
+        self._remainder = np.empty(0, dtype=np.float32)
+        return self._close_segment() if self._segment else None
+
+    def is_speaking(self) -> bool:
+        return bool(self._segment)
+
+    @staticmethod
+    def has_sound(samples: np.ndarray, frame_size: int) -> bool:
+        """
+        Whether any frame of samples is loud enough to be speech, however long
+        it lasts.
+        """
+        if len(samples) == 0:
+            return False
+        usable = max(
+            len(samples) - len(samples) % frame_size,
+            min(len(samples), frame_size),
+        )
+        frames = samples[:usable].reshape(-1, min(usable, frame_size))
+        return bool(
+            np.sqrt(np.mean(np.square(frames), axis=1)).max()
+            > VAD_MIN_SPEECH_RMS
+        )
+
+    def _push_frame(self, frame: np.ndarray) -> np.ndarray | None:
+        rms = float(np.sqrt(np.mean(np.square(frame))))
+        self._frames += 1
+        self._recent_rms.append(rms)
+        speech = rms > max(
+            self.noise_floor * VAD_SPEECH_RATIO, VAD_MIN_SPEECH_RMS
+        )
+        if not speech:
+            self.noise_floor += VAD_NOISE_ADAPTATION * (rms - self.noise_floor)
+        else:
+            self.noise_floor += VAD_NOISE_RISE * max(
+                min(self._recent_rms) - self.noise_floor, 0
+            )
+
+        if not self._segment:
+            self._history.append(frame)
+            self._speech_run = self._speech_run + 1 if speech else 0
+            if self._speech_run >= self.min_speech_frames:
+                # Open a segment from the start of the speech run plus the
+                # padding before it
+                self._segment = self._history[
+                    -(self._speech_run + self.padding_frames) :
+                ]
+                self._history = []
+                if self.first_segment_start is None:
+                    self.first_segment_start = (
+                        self._frames - len(self._segment)
+                    ) * self.frame_size
+                self._silence_run = 0
+            else:
+                del self._history[
+                    : -(self.min_speech_frames + self.padding_frames)
+                ]
+            return None
+
+        self._segment.append(frame)
+        self._silence_run = 0 if speech else self._silence_run + 1
+        if (
+            self._silence_run >= self.silence_frames
+            or len(self._segment) >= self.max_segment_frames
+        ):
+            return self._close_segment()
+        return None
+
+    def _close_segment(self) -> np.ndarray:
+        # Keep only the padding of the trailing silence; the rest seeds the next
+        # segment's onset padding
+        trailing = max(self._silence_run - self.padding_frames, 0)
+        kept = (
+            self._segment[: len(self._segment) - trailing]
+            if trailing
+            else self._segment
+        )
+        self._history = (
+            self._segment[len(kept) :][-self.padding_frames :]
+            if trailing
+            else []
+        )
+        self._segment = []
+        self._speech_run = 0
+        self._silence_run = 0
+        return np.concatenate(kept)
@@ -0,0 +1,307 @@
+import bisect
+import math
+import threading
+import time
+
+from enum import Enum
+
+# Upper bounds, in seconds, of the latency histograms' buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+# Upper bounds of the token count histograms' buckets
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+# Upper bounds of the decode throughput histogram's buckets, in tokens per
+# second
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Content type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class ServingStages(Enum):
+    # Labels of myai_stage_duration_seconds, in the order a voice request passes
+    # through them
+    AUDIO_DECODE = "audio_decode"
+    ASR = "asr"
+    TOKENIZATION = "tokenization"
+    QUEUE = "queue"
+    PREFILL = "prefill"
+    DECODE_STEP = "decode_step"
+    DECODE = "decode"
+    TTS = "tts"
+    AUDIO_ENCODE = "audio_encode"
+    BASE64_ENCODE = "base64_encode"
+
+
+class HistogramSeries:
+    """The bucket counts and sum of one labelled series of a Histogram."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # One count per bucket plus one for +Inf, not cumulative until rendered
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> "Timer":
+        """Context manager observing the seconds its block takes."""
+        return Timer(self)
+
+    def snapshot(self) -> tuple[list[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Timer:
+    def __init__(self, series: HistogramSeries):
+        self.series = series
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.series.observe(time.perf_counter() - self.started_at)
+        return False
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> HistogramSeries:
+        """
+        The series for one combination of label values. Hot paths should look it
+        up once and keep it.
+        """
+        assert len(values) == len(
+            self.label_names
+        ), f"{self.name} takes labels {self.label_names}."
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(
+                    values, HistogramSeries(self.buckets)
+                )
+        return series
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for values, series in sorted(self._series.items()):
+            counts, total = series.snapshot()
+            labels = list(zip(self.label_names, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = MetricsRegistry.format_labels(
+                    labels + [("le", bound)]
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{MetricsRegistry.format_labels(labels)} "
+                f"{MetricsRegistry.number(total)}"
+            )
+            lines.append(
+                f"{self.name}_count{MetricsRegistry.format_labels(labels)} "
+                f"{cumulative}"
+            )
+        return lines
+
+
+class Gauge:
+    """
+    A value set directly, or read from callback() on collection; a labelled
+    gauge's callback returns
+    {label values: value}, and None reports nothing.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        callback=None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.callback = callback
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        self._value = value
+
+    def render(self) -> list[str]:
+        values = self.callback() if self.callback is not None else self._value
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        for label_values, value in sorted(values.items()):
+            labels = MetricsRegistry.format_labels(
+                list(zip(self.label_names, label_values))
+            )
+            lines.append(f"{self.name}{labels} {MetricsRegistry.number(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The server's metrics, rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            Histogram(name, documentation, label_names, buckets)
+        )
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        callback=None,
+    ) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names, callback))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # One failing callback, e.g. of a component that is still
+                # starting, leaves the others to be reported
+                lines.append(
+                    f"# {metric.name} unavailable: "
+                    f"{MetricsRegistry.escape(str(e))}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            assert (
+                metric.name not in self._metrics
+            ), f"Metric {metric.name} is already registered."
+            self._metrics[metric.name] = metric
+        return metric
+
+    @staticmethod
+    def format_labels(pairs: list) -> str:
+        """
+        {name="value",...} for a list of (name, value) pairs, or nothing when
+        there are none.
+        """
+        if not pairs:
+            return ""
+        labels = (
+            f'{name}="{MetricsRegistry.escape(MetricsRegistry.number(value))}"'
+            for name, value in pairs
+        )
+        return "{" + ",".join(labels) + "}"
+
+    @staticmethod
+    def number(value) -> str:
+        if isinstance(value, str):
+            return value
+        if value == math.inf:
+            return "+Inf"
+        return repr(value) if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def escape(value: str) -> str:
+        return (
+            value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+
+
+METRICS = MetricsRegistry()
+
+# Request stages, and the tokens each generation request consumed and produced
+STAGE_SECONDS = METRICS.histogram(
+    "myai_stage_duration_seconds",
+    "Time spent in each stage of serving a request.",
+    ("stage",),
+)
+PROMPT_TOKENS = METRICS.histogram(
+    "myai_prompt_tokens",
+    "Prompt tokens per generation request.",
+    buckets=TOKEN_BUCKETS,
+)
+COMPLETION_TOKENS = METRICS.histogram(
+    "myai_completion_tokens",
+    "Tokens generated per generation request.",
+    buckets=TOKEN_BUCKETS,
+)
+DECODE_TOKENS_PER_SECOND = METRICS.histogram(
+    "myai_decode_tokens_per_second",
+    "Decode speed of each generation request, after its first token.",
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+)
@@ -1,110 +1,301 @@
+import base64
 import json
+import numpy as np
 import os
+import threading
 import time
 import torch
 
 from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
 
-from services.audio import AudioService
+from services.audio import CODEC_CONTENT_TYPES, AudioCodec, AudioService
 from services.env import EnvService, EnvVars
 from services.sanitize import SanitizeService
 
 from utils.nlp.enums import (
     AudioRequestMode,
+    AudioTransport,
     ConfigType,
     DeviceMap,
     PipelineFrameworks,
     Models,
+    Precision,
     Roles,
+    Tasks,
 )
 from utils.logger import Logger, LogLevel
-from utils.nlp.synthesizer import Synthesizer
-
+from utils.metrics import STAGE_SECONDS, ServingStages
+from utils.startup import Startup
+from utils.nlp.checkpoints import CheckpointManifest
+from utils.nlp.clips import AudioClips
+from utils.nlp.conversations import ConversationStore, DEFAULT_SESSION_ID
+from utils.nlp.engines import InferenceEngine
+from utils.nlp.precision import MODEL_PRECISION, ModelPrecision
+from utils.nlp.registry import MODEL_REGISTRY, ModelRegistry
+from utils.nlp.response_cache import ResponseCache
+from utils.nlp.scheduler import GenerationScheduler
+from utils.nlp.speculative import SPECULATIVE_CONFIG_KEY, SpeculativeDecoder
+from utils.nlp.stages import Stage
+from utils.nlp.synthesizer import SentenceSplitter, Synthesizer
+from utils.nlp.transcription import TranscriptionStreams
 
 AGENT_MODEL = EnvService.get(EnvVars.DEFAULT_MODEL.value, Models.GPT2.value)
 CURRENT_WORKING_DIRECTORY = os.getcwd()
 DEVICE_MAP = EnvService.get(EnvVars.DEVICE_MAP.value, DeviceMap.AUTO.value)
 MAX_NEW_TOKENS = EnvService.get_int(EnvVars.MAX_NEW_TOKENS.value, 32)
-PRETRAINED_MODEL_DIR = EnvService.get(EnvVars.PRETRAINED_MODEL_DIR.value, CURRENT_WORKING_DIRECTORY + "/.models/pretrained")
+PRETRAINED_MODEL_DIR = EnvService.get(
+    EnvVars.PRETRAINED_MODEL_DIR.value,
+    CURRENT_WORKING_DIRECTORY + "/.models/pretrained",
+)
+# Where checkpoints trained from AGENT_MODEL are saved and registered
+AGENT_MODEL_DIR = PRETRAINED_MODEL_DIR + "/results/" + AGENT_MODEL
+# Complete sentences a narrated reply may be decoded ahead of its narration
+VOICE_SENTENCE_QUEUE_SIZE = 8
+
+TOKENIZATION_SECONDS = STAGE_SECONDS.labels(ServingStages.TOKENIZATION.value)
+BASE64_ENCODE_SECONDS = STAGE_SECONDS.labels(ServingStages.BASE64_ENCODE.value)
 
 
 class Agent:
     """
     The base model which interacts with the user via the web client.
-    Long-term, Agent will be able to parse user input, determine if the input is a general text generation request
-    (i.e. a question or ongoing conversation), or a task request. If the request is a task, Agent will leverage the base
-    model to determine the steps required to complete this task, leverage any pipelines in the .nlp package, and return
-    a response to the user via the web client.
+    Long-term, Agent will be able to parse user input, determine if the input is
+    a general text generation request (i.e. a question or ongoing conversation),
+    or a task request. If the request is a task, Agent will leverage the base
+    model to determine the steps required to complete this task, leverage any
+    pipelines in the .nlp package, and return a response to the user via the web
+    client.
     """
 
-    def __init__(self, debug: bool = False):
-        self.conversation_history = []
+    def __init__(self, debug: bool = False, startup: Startup | None = None):
+        """
+        (param startup): The server's startup pipeline, which times the phases
+            of loading the agent.
+        """
         self.DEBUG = debug
-        self.agent_config = None
+        self.startup = startup or Startup()
+        self.agent_config = (
+            Agent.load_config(ConfigType.AGENT.value, self.DEBUG) or {}
+        )
         self.model_config = None
         self.model = None
         self.tokenizer = None
+        self.scheduler = None
+        self.conversations = None
+        self.model_path = None
+        self.reload_lock = threading.Lock()
+        self.reload_status = {"state": "serving", "path": None, "error": None}
 
         Agent.check_and_build_model_dirs()
-        pretrained_model_dir = (
-            PRETRAINED_MODEL_DIR
-            + "/results/"
-            + AGENT_MODEL
-        )
 
+        self.synthesizer = Synthesizer()
         try:
-            self.synthesizer = Synthesizer()
-            self.tokenizer = Agent.get_tokenizer_from_pretrained()
-            self.init_model(pretrained_model_dir)
+            # The tokenizer and the model load side by side, since neither needs
+            # the other
+            loaded = self.startup.parallel(
+                {
+                    "tokenizer": Agent.get_tokenizer_from_pretrained,
+                    "model": lambda: self.init_model(AGENT_MODEL_DIR),
+                }
+            )
+            self.tokenizer = loaded["tokenizer"]
         except Exception as e:
             Logger.log(
                 LogLevel.ERROR,
                 "Failed to load agent providers from path: {}. Providers will be loaded using default pretrained model. Error: {}".format(
-                    pretrained_model_dir, e
+                    AGENT_MODEL_DIR, e
                 ),
             )
 
         if self.model is None or self.tokenizer is None:
             self.init_default_providers()
+        self.match_model_to_tokenizer()
+
+        with self.startup.phase("scheduler"):
+            self.init_scheduler()
+        self.conversations = ConversationStore(self.tokenizer)
+        self.transcription_streams = TranscriptionStreams(self.synthesizer)
+        self.audio_clips = AudioClips()
+        self.response_cache = ResponseCache()
+        if (
+            self.response_cache.enabled
+            and self.model.generation_config.do_sample
+        ):
+            Logger.log(
+                LogLevel.AGENT,
+                "Response cache is enabled but unused, since config/model.json "
+                "samples (do_sample) rather than decoding greedily.",
+            )
 
     def __del__(self):
-        Logger.save_log(LogLevel.AGENT, self.conversation_history)
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        if self.conversations is not None:
+            self.conversations.flush()
         Logger.log(LogLevel.AGENT, "Agent instance destroyed.")
 
-    def generate_reply(self, user_input: str):
-        self.record_interaction_to_history(Roles.USER, user_input)
+    def generate_reply(
+        self, user_input: str, session_id: str = DEFAULT_SESSION_ID
+    ):
+        with self.conversations.session(session_id) as session:
+            self.record_interaction_to_history(Roles.USER, user_input, session)
+
+            prompt = self.build_prompt(session)
+            response = self.get_cached_response(prompt)
+            if response is None:
+                # Queue the prompt with the scheduler, which batches it with any
+                # other in-flight requests
+                generation = self.submit_prompt(session, prompt)
+                output_ids = generation.result()
+                self.save_prompt_cache(session, generation)
+                response = self.decode_reply(output_ids)
+                self.cache_response(prompt, generation, response)
+
+            self.record_interaction_to_history(Roles.AGENT, response, session)
+            return response
+
+    def stream_reply(
+        self, user_input: str, session_id: str = DEFAULT_SESSION_ID
+    ):
+        """
+        Generator variant of generate_reply which yields the reply text in
+        pieces as tokens are decoded. The full reply is recorded to the
+        conversation history once the stream ends.
+        """
+        with self.conversations.session(session_id) as session:
+            self.record_interaction_to_history(Roles.USER, user_input, session)
+
+            prompt = self.build_prompt(session)
+            response = self.get_cached_response(prompt)
+            if response is not None:
+                if response:
+                    yield response
+                self.record_interaction_to_history(
+                    Roles.AGENT, response, session
+                )
+                return response
+
+            generation = self.submit_prompt(session, prompt)
+            output_ids, response = [], ""
+            for token_id in generation.stream():
+                output_ids.append(token_id)
+                # Re-decode the whole reply so multi-byte characters and cleanup
+                # rules match generate_reply
+                decoded = self.decode_reply(output_ids)
+                if decoded.startswith(response) and len(decoded) > len(
+                    response
+                ):
+                    yield decoded[len(response) :]
+                    response = decoded
+
+            self.save_prompt_cache(session, generation)
+            response = self.decode_reply(output_ids)
+            self.cache_response(prompt, generation, response)
+            self.record_interaction_to_history(Roles.AGENT, response, session)
+            return response
+
+    def submit_prompt(self, session, prompt: str | None = None):
+        prompt_ids = self.build_prompt_ids(session, prompt)
+        cached = session.prompt_cache or (None, None, None)
+        cached_ids, cached_kv, cached_version = cached
+
+        # Only templated prompts contain the earlier turns, so the cache is only
+        # worth keeping for them
+        return self.scheduler.submit(
+            prompt_ids,
+            MAX_NEW_TOKENS,
+            prefix_ids=cached_ids,
+            prefix_cache=cached_kv,
+            keep_cache=self.tokenizer.chat_template is not None,
+            prefix_model_version=cached_version,
+        )
+
+    def save_prompt_cache(self, session, generation):
+        if generation.final_cache is None:
+            return
+        self.conversations.set_prompt_cache(
+            session,
+            (
+                generation.cached_ids,
+                generation.final_cache,
+                generation.model_version,
+            ),
+        )
+        if self.DEBUG:
+            Logger.log(
+                LogLevel.DEBUG,
+                "Reused "
+                f"{generation.reused_tokens}/{len(generation.input_ids)} "
+                "cached prompt tokens.",
+            )
+
+    def get_cached_response(self, prompt: str) -> str | None:
+        key = self.get_response_cache_key(prompt)
+        return self.response_cache.get(key) if key is not None else None
+
+    def cache_response(self, prompt: str, generation, response: str):
+        # Keyed by the model version that actually decoded the reply, which a
+        # hot swap may have changed mid-request
+        key = self.get_response_cache_key(prompt, generation.model_version)
+        if key is not None:
+            self.response_cache.put(key, response)
+
+    def get_response_cache_key(
+        self, prompt: str, model_version: int | None = None
+    ) -> str | None:
+        """
+        None when replies cannot be cached: the cache is disabled, or decoding
+        samples rather than being greedy.
+        """
+        if (
+            not self.response_cache.enabled
+            or self.model.generation_config.do_sample
+        ):
+            return None
+        return ResponseCache.key(
+            prompt,
+            self.model_config,
+            self.model_path,
+            (
+                self.scheduler.model_version
+                if model_version is None
+                else model_version
+            ),
+            self.agent_config.get("seed"),
+        )
+
+    def build_prompt(self, session) -> str:
+        # Only the most recent turns that fit the prompt token budget are sent
+        # to the model
+        history = self.conversations.window(session)
 
         if self.tokenizer.chat_template is not None:
             Logger.log(
                 LogLevel.AGENT,
                 "Using tokenizer's built-in chat template for tokenization.",
             )
-            to_tokenize = self.tokenizer.apply_chat_template(
-                self.conversation_history,
+            return self.tokenizer.apply_chat_template(
+                history,
                 tokenize=False,
                 add_generation_prompt=True,
             )
-        else:
-            to_tokenize = self.conversation_history[-1].get("content")
+        return history[-1].get("content")
 
-        model_inputs = self.tokenizer(
-            [to_tokenize], return_tensors=PipelineFrameworks.PYTORCH.value
-        ).to(self.model.device)
+    def build_prompt_ids(self, session, prompt: str | None = None) -> list[int]:
+        to_tokenize = self.build_prompt(session) if prompt is None else prompt
+        with TOKENIZATION_SECONDS.time():
+            model_inputs = self.tokenizer(
+                [to_tokenize], return_tensors=PipelineFrameworks.PYTORCH.value
+            )
+            return model_inputs.input_ids[0].tolist()
 
-        generated_ids = self.model.generate(
-            **model_inputs,
-            max_new_tokens=MAX_NEW_TOKENS,
-        )
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
-        response = self.tokenizer.decode(
+    def decode_reply(self, output_ids: list[int]) -> str:
+        return self.tokenizer.decode(
             output_ids,
             skip_special_tokens=True,
             clean_up_tokenization_spaces=True,
         )
 
-        self.record_interaction_to_history(Roles.AGENT, response)
-        return response
-
     def handle_audio_prompt(self, request):
         headers = SanitizeService.decode_headers(request.query_string)
         if self.DEBUG:
@@ -114,60 +305,285 @@ class Agent:
             )
             Logger.log(LogLevel.DEBUG, f"Request headers: {headers}")
 
-        assert headers.get("mode") is not None, "Request mode must be specified."
-        assert AudioRequestMode(headers.get("mode")), "Invalid request mode specified."
+        assert (
+            headers.get("mode") is not None
+        ), "Request mode must be specified."
+        assert AudioRequestMode(
+            headers.get("mode")
+        ), "Invalid request mode specified."
+
+        started_at = time.perf_counter()
+        transcription = self.transcribe_upload(
+            request.stream, request.content_type, request.content_length
+        )
+        return self.respond_to_transcription(headers, transcription, started_at)
+
+    def transcribe_upload(
+        self,
+        source,
+        content_type: str | None = None,
+        content_length: int | None = None,
+    ) -> str:
+        """
+        Decodes and transcribes a complete uploaded recording in one pass.
+        (param source): The upload as bytes or a readable stream, e.g.
+            request.stream.
+        """
+        audio_data = AudioService.load_audio(
+            source, content_type, content_length
+        )
+        assert audio_data is not None, "Request contained no audio data."
+        return self.synthesizer.transcribe_audio(audio_data).get("text", "")
+
+    def handle_audio_stream_open(self, request):
+        """
+        Opens a streaming transcription for an audio prompt uploaded in pieces.
+        The request takes the same options as handle_audio_prompt, applied when
+        the stream ends, and may carry the first piece of audio.
+        """
+        headers = SanitizeService.decode_headers(request.query_string)
+        assert (
+            headers.get("mode") is not None
+        ), "Request mode must be specified."
+        assert AudioRequestMode(
+            headers.get("mode")
+        ), "Invalid request mode specified."
+
+        if self.DEBUG:
+            Logger.log(LogLevel.DEBUG, f"Request headers: {headers}")
+
+        # Load Whisper now rather than when the first segment is ready
+        self.synthesizer.get_stt_pipeline()
 
-        reply, audio, transcription = None, None, None
+        stream = self.transcription_streams.open(request.content_type, headers)
+        stream.write(request.get_data(cache=False))
+        return stream.to_dict()
 
-        raw_audio = request.get_data(cache=False)
-        audio_data = AudioService.load_audio(raw_audio)
+    def handle_audio_stream_chunk(self, request, stream_id: str):
+        """
+        Appends the next piece of audio to a transcription stream and returns
+        its partial transcript. When the request's "final" option is "true" the
+        stream ends, and the response is that of handle_audio_prompt.
+        """
+        stream = self.transcription_streams.get(stream_id)
+        if stream is None:
+            return None
 
-        if self.synthesizer.stt_pipeline is None:
-            self.synthesizer.init_stt_pipeline()
+        stream.write(request.get_data(cache=False))
+        if request.args.get("final", "false").lower() != "true":
+            return stream.to_dict()
 
-        request_transcription = self.synthesizer.transcribe_audio(audio_data)
+        self.transcription_streams.close(stream_id)
+        return self.respond_to_transcription(stream.options, stream.finish())
 
-        # If the request is a question, generate a reply from the model using the input transcription as a prompt
-        if headers.get("mode") == AudioRequestMode.QUESTION.value:
-            reply = self.generate_reply(request_transcription.get("text", ""))
+    def handle_audio_stream_cancel(self, stream_id: str):
+        stream = self.transcription_streams.close(stream_id)
+        if stream is not None:
+            stream.abort()
+        return stream
 
-        if headers.get("narrateResponse").lower() == "true":
-            audio = self.synthesizer.generate_audio(reply)
+    def respond_to_transcription(
+        self, headers: dict, transcription: str, started_at: float | None = None
+    ):
+        """
+        (param started_at): perf_counter() time the request arrived, from which
+            stage timings are logged in debug.
+        """
+        reply, audio = None, None
+        question = headers.get("mode") == AudioRequestMode.QUESTION.value
+        narrate = headers.get("narrateResponse", "false").lower() == "true"
+        transport, codec = Agent.get_audio_options(headers)
+        timings = (
+            {"transcription": time.perf_counter() - started_at}
+            if started_at is not None
+            else {}
+        )
+
+        if question and narrate:
+            reply, audio, stages = self.narrate_reply(
+                transcription, headers.get("sessionId"), codec
+            )
+            if started_at is not None:
+                timings.update(
+                    {name: at - started_at for name, at in stages.items()}
+                )
+        else:
+            # If the request is a question, generate a reply from the model
+            # using the input transcription as a prompt
+            if question:
+                reply = self.generate_reply(
+                    transcription, headers.get("sessionId")
+                )
+            if narrate:
+                audio = self.synthesizer.generate_audio(reply, codec)
+
+        if self.DEBUG and timings:
+            Logger.log(
+                LogLevel.DEBUG,
+                "Voice request timings: "
+                + ", ".join(
+                    f"{name} {t * 1000:.0f} ms" for name, t in timings.items()
+                ),
+            )
 
         return {
             "reply": reply,
-            "audio": audio,
-            "transcription": request_transcription.get("text", ""),
+            **self.package_audio(audio, transport, codec),
+            "transcription": transcription,
         }
 
+    def narrate_reply(
+        self,
+        user_input: str,
+        session_id: str = DEFAULT_SESSION_ID,
+        codec: AudioCodec = AudioCodec.WAV,
+    ):
+        """
+        Generates a reply and narrates each sentence while the rest is still
+        decoding.
+        Returns (reply, encoded narration, perf_counter() times of the first
+        sentence, reply, first audio and end).
+        """
+        sentences = Stage(
+            SentenceSplitter().sentences(
+                self.stream_reply(user_input, session_id)
+            ),
+            "voice-reply",
+            VOICE_SENTENCE_QUEUE_SIZE,
+        )
+
+        chunks, sampling_rate, first_audio_at = [], None, None
+        for audio_data, sampling_rate in self.synthesizer.synthesize_stream(
+            sentences
+        ):
+            first_audio_at = first_audio_at or time.perf_counter()
+            chunks.append(audio_data)
+
+        audio = (
+            Synthesizer.encode_audio(
+                np.concatenate(chunks), sampling_rate, codec=codec
+            )
+            if chunks
+            else None
+        )
+        timings = {
+            "first_sentence": sentences.first_item_at,
+            "reply": sentences.finished_at,
+            "first_audio": first_audio_at,
+            "narration": time.perf_counter(),
+        }
+        return (
+            sentences.result,
+            audio,
+            {name: at for name, at in timings.items() if at is not None},
+        )
+
     def handle_text_prompt(self, request):
         headers = SanitizeService.decode_headers(request.query_string)
         assert (
             request.form.get("userMessage") is not None
         ), "User message must be provided."
-        assert headers.get("mode") is not None, "Request mode must be specified."
-        assert AudioRequestMode(headers.get("mode")), "Invalid request mode specified."
+        assert (
+            headers.get("mode") is not None
+        ), "Request mode must be specified."
+        assert AudioRequestMode(
+            headers.get("mode")
+        ), "Invalid request mode specified."
 
         if self.DEBUG:
             Logger.log(LogLevel.DEBUG, f"Request headers: {headers}")
 
+        transport, codec = Agent.get_audio_options(headers)
+
         # Generate the reply and save it to the response
-        reply = self.generate_reply(request.form.get("userMessage"))
+        reply = self.generate_reply(
+            request.form.get("userMessage"), headers.get("sessionId")
+        )
         # Return no audio data unless requested
-        audio_base64 = None
+        audio = None
 
         # If the user requested an STT response
         if headers.get("narrateResponse") == "true":
-            audio_base64 = self.synthesizer.generate_audio(reply)
+            audio = self.synthesizer.generate_audio(reply, codec)
+
+        return {"reply": reply, **self.package_audio(audio, transport, codec)}
+
+    def handle_text_prompt_stream(self, request):
+        """
+        Streaming variant of handle_text_prompt: yields {"token": str} events,
+        then one {"audio_chunk": str, "index": int} event per narrated sentence,
+        then a final {"reply": str, "audio": None} event.
+        """
+        headers = SanitizeService.decode_headers(request.query_string)
+        user_message = request.form.get("userMessage")
+        assert user_message is not None, "User message must be provided."
+        assert (
+            headers.get("mode") is not None
+        ), "Request mode must be specified."
+        assert AudioRequestMode(
+            headers.get("mode")
+        ), "Invalid request mode specified."
+
+        if self.DEBUG:
+            Logger.log(LogLevel.DEBUG, f"Request headers: {headers}")
+        transport, codec = Agent.get_audio_options(headers)
+
+        def events():
+            stream = self.stream_reply(user_message, headers.get("sessionId"))
+            while True:
+                try:
+                    token = next(stream)
+                except StopIteration as end:
+                    reply = end.value
+                    break
+                yield {"token": token}
+
+            if headers.get("narrateResponse") == "true":
+                for index, chunk in enumerate(
+                    self.synthesizer.stream_audio(reply, codec)
+                ):
+                    yield {
+                        **self.package_audio(
+                            chunk, transport, codec, "audio_chunk"
+                        ),
+                        "index": index,
+                    }
+
+            yield {"reply": reply, "audio": None}
+
+        return events()
+
+    def package_audio(
+        self,
+        audio: bytes | None,
+        transport: AudioTransport,
+        codec: AudioCodec,
+        key: str = "audio",
+    ) -> dict:
+        """
+        The response fields carrying encoded audio: inline as base64 under key,
+        or, for AudioTransport.URL, the id of an AudioClip to download instead
+        (key is then None). Either way "audio_type" gives the audio's content
+        type.
+        """
+        if audio is None:
+            return {key: None}
 
-        return {"reply": reply, "audio": audio_base64}
+        content_type = CODEC_CONTENT_TYPES[codec]
+        if transport == AudioTransport.URL:
+            clip = self.audio_clips.add(audio, content_type)
+            return {key: None, "audio_id": clip.id, "audio_type": content_type}
+        with BASE64_ENCODE_SECONDS.time():
+            encoded = base64.b64encode(audio).decode("utf-8")
+        return {key: encoded, "audio_type": content_type}
 
     def init_default_providers(self):
         if self.model is None:
             if self.DEBUG:
                 Logger.log(
                     LogLevel.AGENT,
-                    f"Model is not initialized, defaulting to model '{AGENT_MODEL}'.",
+                    "Model is not initialized, defaulting to model "
+                    f"'{AGENT_MODEL}'.",
                 )
             self.init_model(None)
 
@@ -175,7 +591,8 @@ class Agent:
             if self.DEBUG:
                 Logger.log(
                     LogLevel.AGENT,
-                    f"Tokenizer is not initialized, defaulting to tokenizer '{AGENT_MODEL}.",
+                    "Tokenizer is not initialized, defaulting to tokenizer "
+                    f"'{AGENT_MODEL}.",
                 )
             self.tokenizer = Agent.get_tokenizer_from_pretrained()
 
@@ -183,33 +600,242 @@ class Agent:
         Logger.log(LogLevel.AGENT, "Agent initialized using default providers.")
 
     def init_model(self, model_dir: str | None):
+        path = Agent.get_model_path(model_dir)
+        self.model_config = Agent.load_config(
+            ConfigType.MODEL.value, self.DEBUG
+        )
+        self.model = Agent.get_registered_model(path, self.model_config)
+        if self.model.precision_report.get("guard") == "pending":
+            self.model = Agent.guard_preloaded_model(path, self.model)
+        self.model_path = path
+
+    @staticmethod
+    def preload_model() -> str:
+        """
+        Registers the model an Agent would serve, without running a forward
+        pass, and returns its path. Called before forking workers, which share
+        the weights and each run the precision guard.
+        """
+        path = Agent.get_model_path(AGENT_MODEL_DIR)
+        Agent.get_registered_model(
+            path, Agent.load_config(ConfigType.MODEL.value), guarded=False
+        )
+        return path
+
+    @staticmethod
+    def guard_preloaded_model(path: str, model):
+        """
+        Runs the precision guard preload_model skipped, registering the float32
+        model instead if it rejects model.
+        """
+        guarded = ModelPrecision.guard(
+            model,
+            Agent.checkpoint_loader(path),
+            MODEL_PRECISION,
+            Agent.get_tokenizer_from_pretrained(),
+        )
+        if guarded is not model:
+            key = ModelRegistry.key(Tasks.TEXT_GENERATION.value, path)
+            MODEL_REGISTRY.register(key, guarded, Tasks.TEXT_GENERATION.value)
+        guarded.precision_report.pop("guard", None)
+        return guarded
+
+    @staticmethod
+    def get_model_path(model_dir: str | None) -> str:
         path = Agent.load_most_recently_trained_model(model_dir)
         if path is not None:
             Logger.log(
                 LogLevel.AGENT,
                 f"Using most recently trained model: {path}",
             )
+            Agent.get_checkpoint_manifest().set_current(path)
         else:
             path = AGENT_MODEL
             Logger.log(LogLevel.AGENT, f"Using default model: {path}")
+        return path
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            path,
-            use_safetensors=True,
-            torch_dtype=torch.float32,
-            device_map=DEVICE_MAP,
+    @staticmethod
+    def get_registered_model(
+        path: str, model_config: dict | None, guarded: bool = True
+    ):
+        # Pinned, since the scheduler serves it for as long as it is current
+        return MODEL_REGISTRY.get(
+            ModelRegistry.key(Tasks.TEXT_GENERATION.value, path),
+            lambda: Agent.load_model(path, model_config, guarded),
+            Tasks.TEXT_GENERATION.value,
+            pinned=True,
+        )
+
+    @staticmethod
+    def load_model(path: str, model_config: dict | None, guarded: bool = True):
+        """
+        Loads a causal LM in MODEL_PRECISION with the generation settings from
+        config/model.json applied.
+        (param guarded): False leaves the precision guard pending in the model's
+            precision_report.
+        """
+        guarded = guarded and MODEL_PRECISION != Precision.FLOAT32
+        tokenizer = Agent.get_tokenizer_from_pretrained() if guarded else None
+        model = ModelPrecision.load(
+            Agent.checkpoint_loader(path), MODEL_PRECISION, tokenizer
         )
+        if not guarded and MODEL_PRECISION != Precision.FLOAT32:
+            model.precision_report["guard"] = "pending"
+
+        for k, v in (model_config or {}).items():
+            if k != SPECULATIVE_CONFIG_KEY:
+                setattr(model.generation_config, k, v)
+        return model
+
+    @staticmethod
+    def checkpoint_loader(path: str):
+        """Returns a function loading the causal LM at path in a given dtype."""
+
+        def load(dtype: torch.dtype):
+            # Safetensors checkpoints are memory-mapped by from_pretrained
+            # rather than read into a buffer first
+            return AutoModelForCausalLM.from_pretrained(
+                path,
+                use_safetensors=True,
+                torch_dtype=dtype,
+                device_map=DEVICE_MAP,
+            )
+
+        return load
+
+    def reload_model(self, path: str | None = None) -> bool:
+        """
+        Loads a checkpoint (the latest by default) in the background and swaps
+        it in between requests. Returns False if a reload is already in
+        progress.
+        """
+        with self.reload_lock:
+            if self.reload_status.get("state") == "loading":
+                return False
+            path = path or Agent.get_checkpoint_manifest().latest()
+            assert path is not None, "No trained checkpoint is registered."
+            self.reload_status = {
+                "state": "loading",
+                "path": path,
+                "error": None,
+            }
+
+        threading.Thread(
+            target=self._reload_model,
+            args=(path,),
+            name="model-reload",
+            daemon=True,
+        ).start()
+        return True
+
+    def rollback_model(self) -> bool:
+        """Reloads the checkpoint that was served before the current one."""
+        previous = Agent.get_checkpoint_manifest().previous()
+        return self.reload_model(previous or AGENT_MODEL)
+
+    def _reload_model(self, path: str):
+        try:
+            Logger.log(LogLevel.AGENT, f"Loading model for hot swap: {path}")
+            model_config = Agent.load_config(ConfigType.MODEL.value, self.DEBUG)
+            model = Agent.load_model(path, model_config)
+            if model.config.pad_token_id is None:
+                model.config.pad_token_id = model.config.eos_token_id
+            if model.get_input_embeddings().weight.shape[0] != len(
+                self.tokenizer
+            ):
+                model.resize_token_embeddings(len(self.tokenizer))
+
+            # Run one short prompt so first-call allocation happens before live
+            # traffic reaches the new weights
+            with torch.inference_mode():
+                warmup_ids = self.tokenizer(
+                    "Hello", return_tensors=PipelineFrameworks.PYTORCH.value
+                )
+                model(**warmup_ids.to(model.device))
+            # Built and checked against eager decoding before it takes any
+            # traffic
+            engine = InferenceEngine.create(model, path)
+            speculator = SpeculativeDecoder.create(
+                model, path, (model_config or {}).get(SPECULATIVE_CONFIG_KEY)
+            )
+
+            self.scheduler.swap_model(model, engine, speculator).wait()
+            MODEL_REGISTRY.release(
+                ModelRegistry.key(Tasks.TEXT_GENERATION.value, self.model_path)
+            )
+            MODEL_REGISTRY.register(
+                ModelRegistry.key(Tasks.TEXT_GENERATION.value, path),
+                model,
+                Tasks.TEXT_GENERATION.value,
+            )
+            self.model = model
+            self.model_config = model_config
+            self.model_path = path
+            self.conversations.clear_prompt_caches()
+            self.response_cache.clear()
+            Agent.get_checkpoint_manifest().set_current(
+                None if path == AGENT_MODEL else path
+            )
 
-        self.model_config = self.load_config(ConfigType.MODEL.value)
-        for k, v in self.model_config.items():
-            setattr(self.model.generation_config, k, v)
+            self.reload_status = {
+                "state": "serving",
+                "path": path,
+                "error": None,
+            }
+            Logger.log(LogLevel.AGENT, f"Now serving model: {path}")
+        except Exception as e:
+            Logger.log(LogLevel.ERROR, f"Failed to hot swap model {path}, {e}")
+            self.reload_status = {
+                "state": "failed",
+                "path": path,
+                "error": str(e),
+            }
 
-    def load_config(self, config_type: str):
+    def get_model_status(self) -> dict:
+        manifest = Agent.get_checkpoint_manifest()
+        return {
+            "path": self.model_path,
+            "model_version": self.scheduler.model_version,
+            "precision": getattr(self.model, "precision_report", None),
+            "engine": self.scheduler.engine.report,
+            "ignored_generation_options": self.scheduler.ignored_options,
+            "speculative": (
+                self.scheduler.speculator.to_dict()
+                if self.scheduler.speculator is not None
+                else None
+            ),
+            "response_cache": self.response_cache.to_dict(),
+            "reload": self.reload_status,
+            "latest": manifest.latest(),
+            "previous": manifest.previous(),
+        }
+
+    def init_scheduler(self):
+        self.scheduler = GenerationScheduler(
+            self.model,
+            eos_token_id=self.tokenizer.eos_token_id,
+            engine=InferenceEngine.create(self.model, self.model_path),
+            speculator=SpeculativeDecoder.create(
+                self.model,
+                self.model_path,
+                (self.model_config or {}).get(SPECULATIVE_CONFIG_KEY),
+            ),
+        )
+        if self.DEBUG:
+            Logger.log(
+                LogLevel.AGENT,
+                "Generation scheduler started (max batch size: "
+                f"{self.scheduler.max_batch_size}, engine:"
+                f" {self.scheduler.engine.engine.value}).",
+            )
+
+    @staticmethod
+    def load_config(config_type: str, debug: bool = False):
         config_path = os.path.join(
             os.path.abspath(os.path.join(__file__, "../../../config")),
             f"{config_type}.json",
         )
-        if self.DEBUG:
+        if debug:
             Logger.log(
                 LogLevel.DEBUG,
                 f"Loading {config_type} config from: {config_path}",
@@ -217,8 +843,10 @@ class Agent:
         try:
             with open(config_path, "r", encoding="utf-8") as f:
                 config = json.load(f)
-            if self.DEBUG:
-                Logger.log(LogLevel.DEBUG, f"{config_type} config loaded: {config}")
+            if debug:
+                Logger.log(
+                    LogLevel.DEBUG, f"{config_type} config loaded: {config}"
+                )
             return config
         except FileNotFoundError:
             Logger.log(
@@ -227,55 +855,77 @@ class Agent:
             )
             return None
 
-    def record_interaction_to_history(self, role: Roles, content: str | set):
-        self.conversation_history.append(
-            {
-                "timestamp": int(time.time()),
-                "role": role.value,
-                "content": content,
-            }
-        )
+    def record_interaction_to_history(
+        self, role: Roles, content: str | set, session
+    ):
+        interaction = {
+            "timestamp": int(time.time()),
+            "role": role.value,
+            "content": content,
+        }
+        self.conversations.append(session, interaction)
         if self.DEBUG:
             Logger.log(
                 LogLevel.AGENT,
-                f"Interaction saved: {self.conversation_history[-1]}",
+                f"Interaction saved to session '{session.session_id}': "
+                f"{interaction}",
             )
 
     def set_token_padding(self):
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model.config.pad_token_id = self.model.config.eos_token_id
 
-    def wake_agent(self):
+    def match_model_to_tokenizer(self):
         """
-        A bootstrapping method to instantiate the agent with the default model and tokenizer and a user-defined config.
+        Pads with the EOS token if the tokenizer has no padding token, and sizes
+        the embeddings to its vocabulary.
         """
-        try:
-            self.agent_config = self.load_config(ConfigType.AGENT.value)
-            startup_prompt = self.agent_config.get("startup_prompt", "")
-
-            if (
-                self.tokenizer.pad_token is None
-                and self.tokenizer.eos_token is not None
-            ):
-                self.set_token_padding()
-
-            emb_rows = self.model.get_input_embeddings().weight.shape[0]
-            if emb_rows != len(self.tokenizer):
-                self.model.resize_token_embeddings(len(self.tokenizer))
-
-            set_seed(self.agent_config.get("seed", 67))
+        if (
+            self.tokenizer.pad_token is None
+            and self.tokenizer.eos_token is not None
+        ):
+            self.set_token_padding()
 
-            startup_msg = self.generate_reply(startup_prompt)
-            self.record_interaction_to_history(Roles.AGENT, startup_msg)
-
-            return startup_msg
+        emb_rows = self.model.get_input_embeddings().weight.shape[0]
+        if emb_rows != len(self.tokenizer):
+            self.model.resize_token_embeddings(len(self.tokenizer))
 
+    def warm_up(self) -> str | None:
+        """
+        Seeds generation and decodes the startup prompt once, unrecorded, and
+        returns the reply.
+        """
+        set_seed(self.agent_config.get("seed", 67))
+        self.scheduler.seed(self.agent_config.get("seed", 67))
+        try:
+            startup_prompt = (
+                self.agent_config.get("startup_prompt")
+                or self.tokenizer.eos_token
+            )
+            output_ids = self.scheduler.generate(
+                self.tokenizer(startup_prompt).input_ids, MAX_NEW_TOKENS
+            )
+            return self.decode_reply(output_ids)
         except Exception as e:
             Logger.log(
                 LogLevel.ERROR,
-                f"Failed to initialize agent. Initial prompts may take longer than expected. Error: {e}",
+                "Failed to warm up agent. Initial prompts may take longer "
+                f"than expected. Error: {e}",
             )
 
+    @staticmethod
+    def get_audio_options(headers: dict) -> tuple[AudioTransport, AudioCodec]:
+        """
+        Reads the audioTransport ("base64" or "url") and audioCodec ("wav" or
+        "opus") request options.
+        """
+        return (
+            AudioTransport(
+                headers.get("audioTransport", AudioTransport.BASE64.value)
+            ),
+            AudioCodec(headers.get("audioCodec", AudioCodec.WAV.value)),
+        )
+
     @staticmethod
     def check_and_build_model_dirs():
         os.makedirs(PRETRAINED_MODEL_DIR, exist_ok=True)
@@ -286,19 +936,22 @@ class Agent:
     def get_tokenizer_from_pretrained(model: str = AGENT_MODEL):
         return AutoTokenizer.from_pretrained(model)
 
+    @staticmethod
+    def get_checkpoint_manifest() -> CheckpointManifest:
+        return CheckpointManifest(
+            PRETRAINED_MODEL_DIR + "/results/" + AGENT_MODEL
+        )
+
     @staticmethod
     def load_most_recently_trained_model(directory):
         """
-        Loads the most recent model from the specified directory.
-        Assumes that the models are saved to folders which follow a regular naming convention
-        which ends in a timestamp.
+        Returns the checkpoint to serve from the specified directory's manifest:
+        the one last marked as current (so rollbacks survive restarts),
+        otherwise the most recently registered one.
         """
-        os.makedirs(PRETRAINED_MODEL_DIR + "/results/" + AGENT_MODEL, exist_ok=True)
+        os.makedirs(AGENT_MODEL_DIR, exist_ok=True)
+        if directory is None:
+            return None
 
-        folders = [
-            f
-            for f in os.listdir(directory)
-            if os.path.isdir(os.path.join(directory, f))
-        ]
-        # Return the alphabetically last folder name
-        return directory + "/" + max(folders) if folders else None
+        manifest = CheckpointManifest(directory)
+        return manifest.current() or manifest.latest()
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+from utils.logger import Logger, LogLevel
+
+
+class MicroBatcher:
+    """
+    Batches concurrent calls to a model for one forward pass.
+    Calls from any thread are queued; a worker thread takes the first, lingers
+    up to max_wait_ms for more to arrive (up to max_batch_size in all), runs
+    run_batch over their inputs in order and hands each caller its own result.
+    An exception from run_batch is raised to every caller in that batch.
+    """
+
+    def __init__(
+        self, run_batch, name: str, max_batch_size: int, max_wait_ms: int
+    ):
+        """
+        (param run_batch): Called with a list of inputs, returns a list of their
+            results in the same order.
+        """
+        assert max_batch_size > 0, "max_batch_size must be greater than 0."
+
+        self.run_batch = run_batch
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0) / 1000.0
+
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True
+        )
+        self._thread.start()
+
+    def __call__(self, item, timeout: float | None = None):
+        """
+        Runs item in the next batch and returns its result, raising TimeoutError
+        after timeout seconds.
+        """
+        return self.submit(item).result(timeout)
+
+    def submit(self, item) -> Future:
+        assert not self._stopped, f"{self.name} has been shut down."
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def shutdown(self):
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        while (batch := self._collect()) is not None:
+            items = [item for item, _ in batch]
+            try:
+                results = self.run_batch(items)
+                assert len(results) == len(items), (
+                    f"{self.name} returned {len(results)} results for"
+                    f" {len(items)} inputs."
+                )
+            except Exception as e:
+                Logger.log(
+                    LogLevel.ERROR,
+                    f"{self.name} batch of {len(items)} failed, {e}",
+                )
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending is not None:
+                pending[1].set_exception(
+                    RuntimeError(f"{self.name} shut down.")
+                )
+
+    def _collect(self) -> list | None:
+        # Block for the first call, then linger briefly so a burst shares one
+        # batch
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
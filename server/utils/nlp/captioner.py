@@ -3,9 +3,12 @@ import numpy as np
 from PIL import Image
 from transformers import BlipProcessor, BlipForConditionalGeneration
 
-from utils.nlp.enums import PipelineFrameworks
+from utils.nlp.enums import PipelineFrameworks, Tasks
+from utils.nlp.registry import MODEL_REGISTRY, ModelRegistry
 from utils.logger import Logger, LogLevel
 
+CAPTION_MODEL = "Salesforce/blip-image-captioning-base"
+
 log_level: LogLevel = LogLevel.CAPTION
 
 conversation_history: list
@@ -17,13 +20,9 @@ class Captioner:
     def __init__(self):
         self.conversation_history = []
 
-        # Initialize the processor and model from Hugging Face
-        self.processor = BlipProcessor.from_pretrained(
-            "Salesforce/blip-image-captioning-base"
-        )
-        self.model = BlipForConditionalGeneration.from_pretrained(
-            "Salesforce/blip-image-captioning-base"
-        )
+        # Initialize the processor from Hugging Face; the model is loaded
+        # through the registry on first use
+        self.processor = BlipProcessor.from_pretrained(CAPTION_MODEL)
 
     def __del__(self):
         Logger.save_log(log_level, self.conversation_history)
@@ -31,8 +30,10 @@ class Captioner:
 
     def analyze_img(self, image: np.ndarray):
         # unconditional image captioning
-        inputs = processor(image, return_tensors=PipelineFrameworks.PYTORCH.value)
-        out = self.model.generate(**inputs)
+        inputs = self.processor(
+            image, return_tensors=PipelineFrameworks.PYTORCH.value
+        )
+        out = self.get_model().generate(**inputs)
         to_return = self.processor.decode(out[0], skip_special_tokens=False)
         Logger.log(log_level, to_return)
         self.conversation_history.append("[analyze_img] ::" + to_return)
@@ -47,9 +48,16 @@ class Captioner:
             image, text, return_tensors=PipelineFrameworks.PYTORCH.value
         )
 
-        out = self.model.generate(**inputs)
+        out = self.get_model().generate(**inputs)
         toReturn = self.processor.decode(out[0], skip_special_tokens=False)
         Logger.log(log_level, toReturn)
         self.conversation_history.append("[caption_img] ::" + toReturn)
 
         return toReturn
+
+    def get_model(self) -> BlipForConditionalGeneration:
+        return MODEL_REGISTRY.get(
+            ModelRegistry.key(Tasks.IMAGE_TO_TEXT.value, CAPTION_MODEL),
+            lambda: BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL),
+            Tasks.IMAGE_TO_TEXT.value,
+        )
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+
+from utils.logger import Logger, LogLevel
+
+MANIFEST_FILE_NAME = "manifest.json"
+MODEL_WEIGHTS_FILE_NAMES = ("model.safetensors", "model.safetensors.index.json")
+
+
+class CheckpointManifest:
+    """
+    Tracks the trained checkpoints of a model in <results dir>/manifest.json,
+    which records every registered checkpoint in the order it was produced along
+    with the one currently being served and the one served before it. "Latest"
+    and rollback targets are read from the manifest rather than inferred from
+    folder names.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE_NAME)
+
+    def register(self, checkpoint_dir: str, **metadata) -> dict:
+        """Records a newly saved checkpoint as the latest one."""
+        with CheckpointManifest._lock:
+            manifest = self._read()
+            entry = {
+                "path": os.path.abspath(checkpoint_dir),
+                "created_at": time.time(),
+                **metadata,
+            }
+            manifest["checkpoints"].append(entry)
+            self._write(manifest)
+        Logger.log(LogLevel.TRAINER, f"Registered checkpoint: {entry['path']}")
+        return entry
+
+    def contains(self, checkpoint_dir: str) -> bool:
+        path = os.path.abspath(checkpoint_dir)
+        return any(c["path"] == path for c in self._read()["checkpoints"])
+
+    def latest(self) -> str | None:
+        checkpoints = self._read()["checkpoints"]
+        return checkpoints[-1]["path"] if checkpoints else None
+
+    def current(self) -> str | None:
+        return self._read().get("current")
+
+    def previous(self) -> str | None:
+        return self._read().get("previous")
+
+    def set_current(self, checkpoint_dir: str | None):
+        """
+        Marks a checkpoint as the one being served, remembering the outgoing one
+        as the rollback target.
+        """
+        with CheckpointManifest._lock:
+            manifest = self._read()
+            checkpoint_dir = (
+                os.path.abspath(checkpoint_dir) if checkpoint_dir else None
+            )
+            if manifest.get("current") != checkpoint_dir:
+                manifest["previous"] = manifest.get("current")
+                manifest["current"] = checkpoint_dir
+                self._write(manifest)
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return self._discover()
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, manifest: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file and rename it so readers never see a
+        # partially written manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _discover(self) -> dict:
+        """
+        Builds an initial manifest from checkpoints saved before manifests
+        existed, ordered by modification time.
+        """
+        checkpoints = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if any(
+                    os.path.exists(os.path.join(path, f))
+                    for f in MODEL_WEIGHTS_FILE_NAMES
+                ):
+                    checkpoints.append(
+                        {
+                            "path": os.path.abspath(path),
+                            "created_at": os.path.getmtime(path),
+                        }
+                    )
+        checkpoints.sort(key=lambda c: c["created_at"])
+        return {"checkpoints": checkpoints, "current": None, "previous": None}
@@ -0,0 +1,72 @@
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+AUDIO_CLIP_TTL_SECONDS = EnvService.get_int(
+    EnvVars.AUDIO_CLIP_TTL_SECONDS.value, 300
+)
+# Oldest clips are dropped early once the store holds this much audio
+AUDIO_CLIP_MAX_BYTES = 64 * 1024 * 1024
+
+
+class AudioClip:
+    def __init__(self, data: bytes, content_type: str, ttl_seconds: int):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.content_type = content_type
+        self.expires_at = time.monotonic() + ttl_seconds
+
+
+class AudioClips:
+    """
+    Narration served as short-lived audio resources rather than base64 in the
+    JSON reply, so clients can fetch it as binary (with range requests) once
+    they are ready to play it. Clips expire after ttl_seconds.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = AUDIO_CLIP_TTL_SECONDS,
+        max_bytes: int = AUDIO_CLIP_MAX_BYTES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._clips = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, data: bytes, content_type: str) -> AudioClip:
+        clip = AudioClip(data, content_type, self.ttl_seconds)
+        with self._lock:
+            self._clips[clip.id] = clip
+            self._bytes += len(data)
+            self._evict()
+        return clip
+
+    def get(self, clip_id: str) -> AudioClip | None:
+        with self._lock:
+            self._evict()
+            return self._clips.get(clip_id)
+
+    def _evict(self):
+        # Clips are kept in creation order, and so also in expiry order
+        now = time.monotonic()
+        while self._clips:
+            clip = next(iter(self._clips.values()))
+            if clip.expires_at > now and (
+                self._bytes <= self.max_bytes or len(self._clips) == 1
+            ):
+                break
+            del self._clips[clip.id]
+            self._bytes -= len(clip.data)
+            if clip.expires_at > now:
+                Logger.log(
+                    LogLevel.INFO,
+                    f"Audio clip store full, dropped clip {clip.id} before it "
+                    "expired.",
+                )
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+DEFAULT_SESSION_ID = "default"
+SESSION_PROMPT_TOKEN_BUDGET = EnvService.get_int(
+    EnvVars.SESSION_PROMPT_TOKEN_BUDGET.value, 768
+)
+SESSION_SPILL_DIR = EnvService.get(
+    EnvVars.SESSION_SPILL_DIR.value, "prompts/sessions"
+)
+SESSION_STORE_MAX_TOKENS = EnvService.get_int(
+    EnvVars.SESSION_STORE_MAX_TOKENS.value, 200000
+)
+
+
+class Session:
+    """
+    One client's conversation: its message history, the token count of each
+    message, and the KV cache of its last turn. The store counts both history
+    and cached tokens against its cap.
+    """
+
+    def __init__(self, session_id: str, history: list | None = None):
+        self.session_id = session_id
+        self.history = history or []
+        self.token_counts = []
+        self.prompt_cache = None
+        self.in_use = 0
+
+    def tokens(self) -> int:
+        cached = (
+            len(self.prompt_cache[0]) if self.prompt_cache is not None else 0
+        )
+        return sum(self.token_counts) + cached
+
+
+class ConversationStore:
+    """
+    In-memory, session-keyed conversation histories bounded by a total token
+    cap.
+    When the cap is exceeded the least recently used idle sessions are spilled
+    to disk as JSON and dropped from memory; they are transparently reloaded the
+    next time their session id is used.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        max_tokens: int = SESSION_STORE_MAX_TOKENS,
+        prompt_token_budget: int = SESSION_PROMPT_TOKEN_BUDGET,
+        spill_dir: str = SESSION_SPILL_DIR,
+    ):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.prompt_token_budget = prompt_token_budget
+        self.spill_dir = spill_dir
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self, session_id: str | None):
+        """
+        Checks out a session for the duration of a turn so it cannot be evicted
+        mid-generation.
+        """
+        session = self._acquire(session_id or DEFAULT_SESSION_ID)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.in_use -= 1
+                self._evict()
+
+    def append(self, session: Session, entry: dict):
+        token_count = len(
+            self.tokenizer(str(entry.get("content", ""))).input_ids
+        )
+        with self._lock:
+            session.history.append(entry)
+            session.token_counts.append(token_count)
+            self._evict()
+
+    def set_prompt_cache(self, session: Session, prompt_cache: tuple | None):
+        with self._lock:
+            session.prompt_cache = prompt_cache
+            self._evict()
+
+    def clear_prompt_caches(self):
+        """
+        Drops every session's KV cache, e.g. once the weights they were computed
+        with are no longer served.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.prompt_cache = None
+
+    def window(self, session: Session) -> list[dict]:
+        """
+        The most recent messages of a session that fit within the prompt token
+        budget.
+        The latest message is always included so a single long prompt is still
+        answered.
+        """
+        with self._lock:
+            total, start = 0, len(session.history)
+            for i in range(len(session.history) - 1, -1, -1):
+                total += session.token_counts[i]
+                if total > self.prompt_token_budget and start < len(
+                    session.history
+                ):
+                    break
+                start = i
+            return session.history[start:]
+
+    def total_tokens(self) -> int:
+        return sum(s.tokens() for s in self._sessions.values())
+
+    def flush(self):
+        """Spills every in-memory session to disk."""
+        with self._lock:
+            for session in self._sessions.values():
+                self._spill(session)
+
+    def _acquire(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._load(session_id)
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session.in_use += 1
+            return session
+
+    def _evict(self):
+        """
+        Spill least recently used idle sessions until the store is back under
+        its token cap.
+        """
+        total = self.total_tokens()
+        for session_id in list(self._sessions.keys()):
+            if total <= self.max_tokens:
+                break
+            session = self._sessions[session_id]
+            if session.in_use > 0:
+                continue
+            total -= session.tokens()
+            self._spill(session)
+            del self._sessions[session_id]
+            Logger.log(
+                LogLevel.AGENT, f"Evicted session '{session_id}' to disk."
+            )
+
+    def _spill(self, session: Session):
+        if not session.history:
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(
+                self._spill_path(session.session_id), "w", encoding="utf-8"
+            ) as f:
+                json.dump(session.history, f, indent=2)
+        except OSError as e:
+            Logger.log(
+                LogLevel.ERROR,
+                f"Failed to spill session '{session.session_id}', {e}",
+            )
+
+    def _load(self, session_id: str) -> Session:
+        session = Session(session_id)
+        path = self._spill_path(session_id)
+        if not os.path.exists(path):
+            return session
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                session.history = json.load(f)
+            session.token_counts = [
+                len(self.tokenizer(str(entry.get("content", ""))).input_ids)
+                for entry in session.history
+            ]
+            Logger.log(
+                LogLevel.AGENT, f"Restored session '{session_id}' from disk."
+            )
+        except (OSError, ValueError) as e:
+            Logger.log(
+                LogLevel.ERROR, f"Failed to restore session '{session_id}', {e}"
+            )
+            session.history = []
+        return session
+
+    def _spill_path(self, session_id: str) -> str:
+        # Session ids come from clients, so anything that is not a plain
+        # identifier is hashed into one
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", session_id):
+            session_id = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, session_id + ".json")
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+DATASET_CACHE_DIR = EnvService.get(
+    EnvVars.DATASET_CACHE_DIR.value, os.getcwd() + "/.models/datasets"
+)
+# datasets.json, the datasets to train on
+DATASET_CONFIGS_PATH = os.path.join(
+    os.path.abspath(os.path.join(__file__, "../../..")), "datasets.json"
+)
+# Bump when formatting, splitting or tokenization logic changes so stale cache
+# entries are not reused
+DATASET_CACHE_VERSION = 2
+
+# datasets.json keys which change the processed rows; the rest, like name,
+# active, streaming and weight, only describe the dataset or how a run uses it
+_PROCESSING_CONFIG_KEYS = (
+    "hf_id",
+    "config_type",
+    "split",
+    "pattern",
+    "columns",
+)
+
+
+class DatasetCache:
+    """
+    On-disk cache of formatted and tokenized datasets, stored as Arrow with
+    save_to_disk() and memory-mapped back with load_from_disk(), and of small
+    lists of example texts, stored as JSON. Entries are keyed by a fingerprint
+    of everything that affects their contents, so a changed datasets.json entry,
+    tokenizer or max length produces a new key rather than a stale hit. The
+    datasets library is only imported to read or write datasets, so text entries
+    are cheap to read while serving.
+    """
+
+    def __init__(self, directory: str = DATASET_CACHE_DIR):
+        self.directory = directory
+
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        """
+        Hashes JSON-serializable parts; tokenizers are hashed by their
+        vocabulary and settings.
+        """
+        hasher = hashlib.sha256(str(DATASET_CACHE_VERSION).encode("utf-8"))
+        for part in parts:
+            if hasattr(part, "get_vocab"):
+                from datasets.fingerprint import Hasher
+
+                part = Hasher.hash(part)
+            hasher.update(
+                json.dumps(part, sort_keys=True, default=str).encode("utf-8")
+            )
+        return hasher.hexdigest()[:32]
+
+    @staticmethod
+    def dataset_fingerprint(
+        config: dict, tokenizer, max_length: int | None, **options
+    ) -> str:
+        processing_config = {k: config.get(k) for k in _PROCESSING_CONFIG_KEYS}
+        return DatasetCache.fingerprint(
+            processing_config, tokenizer, max_length, options
+        )
+
+    @staticmethod
+    def load_configs() -> list[dict]:
+        with open(DATASET_CONFIGS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, key: str):
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return None
+        from datasets import load_from_disk
+
+        try:
+            dataset = load_from_disk(path)
+            Logger.log(LogLevel.DATA, f"Loaded cached dataset {key}.")
+            return dataset
+        except Exception as e:
+            Logger.log(
+                LogLevel.ERROR,
+                f"Discarding unreadable cached dataset {key}, {e}",
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+    def save(self, key: str, dataset):
+        """
+        Writes to a temporary directory first so an interrupted run never leaves
+        a partial entry behind.
+        """
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+        dataset.save_to_disk(tmp_path)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        Logger.log(LogLevel.DATA, f"Cached dataset {key}.")
+
+    def load_texts(self, key: str) -> list[str] | None:
+        path = self._path(key) + ".json"
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            # Overwritten by the next save_texts
+            Logger.log(
+                LogLevel.ERROR, f"Ignoring unreadable cached texts {key}, {e}"
+            )
+            return None
+
+    def save_texts(self, key: str, texts: list[str]):
+        path = self._path(key) + ".json"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(texts, f)
+        os.replace(path + ".tmp", path)
+        Logger.log(LogLevel.DATA, f"Cached {len(texts)} texts as {key}.")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
@@ -0,0 +1,565 @@
+import hashlib
+import json
+import math
+import numpy as np
+import os
+import shutil
+import time
+import torch
+import torch.nn.functional as F
+import transformers
+
+from transformers import DynamicCache, StaticCache
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+from utils.nlp.enums import InferenceEngines
+from utils.nlp.registry import ModelRegistry
+
+INFERENCE_ENGINE = InferenceEngines(
+    EnvService.get(EnvVars.INFERENCE_ENGINE.value, InferenceEngines.EAGER.value)
+)
+ENGINE_CACHE_DIR = EnvService.get(
+    EnvVars.ENGINE_CACHE_DIR.value, os.getcwd() + "/.models/engines"
+)
+# Static KV caches grow a whole block of positions at a time, so compiled decode
+# steps rarely see a new cache length
+STATIC_CACHE_BLOCK = 256
+# Tokens a new engine must decode exactly as eager PyTorch does, from a fixed
+# prompt, before it is served
+PARITY_TOKENS = 16
+PARITY_PROMPT_LENGTH = 8
+
+
+class InferenceEngine:
+    """
+    Runs a causal LM's forward passes for the GenerationScheduler; this base
+    class runs them in eager PyTorch. KV caches cross the interface as per-layer
+    (key, value) tuples, which the scheduler slices, pads and stacks across
+    requests. Between decode steps an engine may keep a batch's cache in a form
+    of its own, which batch_cache() turns back into tuples.
+    """
+
+    engine = InferenceEngines.EAGER
+
+    def __init__(self, model):
+        self.model = model
+        self.report = {"engine": self.engine.value}
+
+    @staticmethod
+    def create(
+        model, model_path: str, engine: InferenceEngines = INFERENCE_ENGINE
+    ) -> "InferenceEngine":
+        """
+        Builds and warms up engine for model. Unless it is eager, it must then
+        greedily decode a fixed prompt token for token as eager PyTorch does; if
+        it does not, or cannot be built at all, the model is served eagerly
+        instead.
+        """
+        eager = InferenceEngine(model)
+        if engine == InferenceEngines.EAGER:
+            return eager
+
+        start = time.perf_counter()
+        try:
+            candidate = (
+                CompiledEngine(model)
+                if engine == InferenceEngines.COMPILE
+                else OnnxEngine(model, model_path)
+            )
+            prompt_ids = InferenceEngine.parity_prompt_ids(model)
+            expected, _ = eager.greedy(prompt_ids, PARITY_TOKENS)
+            actual, _ = candidate.greedy(prompt_ids, PARITY_TOKENS)
+            candidate.warmup()
+        except Exception as e:
+            # Export and compile errors run to pages of advice; the first line
+            # names the problem
+            error = str(e).strip().split("\n")[0]
+            Logger.log(
+                LogLevel.ERROR,
+                f"Failed to build the {engine.value} inference engine, serving "
+                f"eagerly instead. {error}",
+            )
+            eager.report.update({"requested": engine.value, "error": error})
+            return eager
+
+        if actual != expected:
+            matched = next(
+                (i for i, (a, b) in enumerate(zip(actual, expected)) if a != b),
+                len(expected),
+            )
+            Logger.log(
+                LogLevel.ERROR,
+                f"The {engine.value} inference engine diverged from eager "
+                f"decoding after {matched} of {PARITY_TOKENS}"
+                " tokens, serving eagerly instead.",
+            )
+            eager.report.update(
+                {
+                    "requested": engine.value,
+                    "error": f"Diverged after {matched} tokens.",
+                }
+            )
+            return eager
+
+        build_seconds = time.perf_counter() - start
+        candidate.report.update(
+            {
+                "parity_tokens": PARITY_TOKENS,
+                "build_seconds": round(build_seconds, 3),
+            }
+        )
+        Logger.log(
+            LogLevel.AGENT,
+            f"{engine.value} inference engine ready in {build_seconds:.1f}s, "
+            "matching eager decoding.",
+        )
+        return candidate
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+        position_ids: torch.Tensor | None = None,
+        past: tuple | None = None,
+    ) -> tuple[torch.Tensor, tuple]:
+        """
+        Runs input_ids after past, if given, returning the logits and the
+        per-layer cache of past and input_ids.
+        """
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=(
+                InferenceEngine.dynamic_cache(past)
+                if past is not None
+                else None
+            ),
+            use_cache=True,
+        )
+        return outputs.logits, InferenceEngine.legacy_cache(
+            outputs.past_key_values
+        )
+
+    def decode(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        cache,
+    ):
+        """
+        Runs one token for every sequence of a left-padded batch, returning the
+        logits and the batch's cache.
+        (param attention_mask): Covers the cached positions followed by the new
+            tokens.
+        (param cache): Per-layer tuples, or the cache the previous decode()
+            returned.
+        """
+        return self.prefill(
+            input_ids, attention_mask, position_ids, self.batch_cache(cache)
+        )
+
+    def batch_cache(self, cache) -> tuple:
+        """The per-layer (key, value) tuples of a cache decode() returned."""
+        return cache
+
+    def warmup(self):
+        """
+        Runs whatever first-call work greedy() has not already done, before live
+        traffic reaches the engine.
+        """
+
+    def greedy(
+        self, input_ids: list[int], max_new_tokens: int
+    ) -> tuple[list[int], float]:
+        """
+        Greedily decodes max_new_tokens tokens after input_ids as one sequence,
+        end of sequence tokens included. Returns the tokens and the seconds
+        until the first of them.
+        """
+        device = self.model.device
+        start = time.perf_counter()
+        with torch.inference_mode():
+            logits, cache = self.prefill(
+                torch.tensor([input_ids], device=device)
+            )
+            tokens = [int(logits[0, -1].argmax())]
+            first_token_seconds = time.perf_counter() - start
+
+            attention_mask = torch.ones(
+                (1, len(input_ids)), dtype=torch.long, device=device
+            )
+            while len(tokens) < max_new_tokens:
+                attention_mask = F.pad(attention_mask, (0, 1), value=1)
+                logits, cache = self.decode(
+                    torch.tensor([[tokens[-1]]], device=device),
+                    attention_mask,
+                    torch.tensor(
+                        [[attention_mask.shape[1] - 1]], device=device
+                    ),
+                    cache,
+                )
+                tokens.append(int(logits[0, -1].argmax()))
+        return tokens, first_token_seconds
+
+    @staticmethod
+    def parity_prompt_ids(model) -> list[int]:
+        generator = torch.Generator().manual_seed(0)
+        return torch.randint(
+            model.config.vocab_size,
+            (PARITY_PROMPT_LENGTH,),
+            generator=generator,
+        ).tolist()
+
+    @staticmethod
+    def legacy_cache(past_key_values) -> tuple:
+        """
+        Per-layer (key, value) tuples, which can be padded, sliced and
+        concatenated across requests.
+        """
+        if hasattr(past_key_values, "to_legacy_cache"):
+            return past_key_values.to_legacy_cache()
+        if hasattr(past_key_values, "layers"):
+            # transformers 5 removed to_legacy_cache()
+            return tuple(
+                (layer.keys, layer.values) for layer in past_key_values.layers
+            )
+        return past_key_values
+
+    @staticmethod
+    def dynamic_cache(legacy_cache: tuple):
+        if hasattr(DynamicCache, "from_legacy_cache"):
+            return DynamicCache.from_legacy_cache(legacy_cache)
+        return DynamicCache(legacy_cache)
+
+
+class StaticBatchCache:
+    """
+    A batch's KV cache in preallocated buffers, of which the first length
+    positions are filled.
+    """
+
+    def __init__(self, cache: StaticCache, length: int):
+        self.cache = cache
+        self.length = length
+
+    @property
+    def capacity(self) -> int:
+        return self.cache.get_max_length()
+
+
+class CompiledEngine(InferenceEngine):
+    """
+    Runs decode steps through torch.compile against a static KV cache: each step
+    writes its keys and values into preallocated buffers, grown
+    STATIC_CACHE_BLOCK positions at a time, rather than concatenating them onto
+    the cache, so the compiled graph sees the same shapes step after step. Batch
+    size and cache length are compiled as symbolic sizes, so requests joining or
+    leaving the batch do not recompile. Prefill, whose length differs with every
+    prompt, stays eager. Tracing and compiling take tens of seconds on every
+    start; torch caches only the generated kernels.
+    """
+
+    engine = InferenceEngines.COMPILE
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.step = torch.compile(model.forward, dynamic=True, fullgraph=True)
+
+    def decode(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        cache,
+    ):
+        if (
+            not isinstance(cache, StaticBatchCache)
+            or cache.length >= cache.capacity
+        ):
+            cache = self.static_cache(self.batch_cache(cache))
+
+        outputs = self.step(
+            input_ids=input_ids,
+            attention_mask=F.pad(
+                attention_mask, (0, cache.capacity - attention_mask.shape[1])
+            ),
+            position_ids=position_ids,
+            past_key_values=cache.cache,
+            cache_position=torch.tensor(
+                [cache.length], device=input_ids.device
+            ),
+            use_cache=True,
+        )
+        cache.length += 1
+        return outputs.logits, cache
+
+    def batch_cache(self, cache) -> tuple:
+        if not isinstance(cache, StaticBatchCache):
+            return cache
+        return tuple(
+            (
+                layer.keys[:, :, : cache.length, :],
+                layer.values[:, :, : cache.length, :],
+            )
+            for layer in cache.cache.layers
+        )
+
+    def static_cache(self, legacy_cache: tuple) -> StaticBatchCache:
+        length = legacy_cache[0][0].shape[2]
+        capacity = (
+            math.ceil((length + 1) / STATIC_CACHE_BLOCK) * STATIC_CACHE_BLOCK
+        )
+        cache = StaticCache(self.model.config, max_cache_len=capacity)
+        for layer, (keys, values) in zip(cache.layers, legacy_cache):
+            layer.lazy_initialization(keys, values)
+            layer.keys[:, :, :length, :] = keys
+            layer.values[:, :, :length, :] = values
+            layer.cumulative_length.fill_(length)
+        return StaticBatchCache(cache, length)
+
+    def warmup(self):
+        # greedy() compiled the graph for a single sequence; sizes of 1 are
+        # specialized, so batches need their own
+        device = self.model.device
+        with torch.inference_mode():
+            input_ids = torch.tensor(
+                [InferenceEngine.parity_prompt_ids(self.model)] * 2,
+                device=device,
+            )
+            logits, cache = self.prefill(input_ids)
+            attention_mask = torch.ones(
+                (2, input_ids.shape[1] + 1), dtype=torch.long, device=device
+            )
+            position_ids = torch.full((2, 1), input_ids.shape[1], device=device)
+            self.decode(
+                logits[:, -1].argmax(-1, keepdim=True),
+                attention_mask,
+                position_ids,
+                cache,
+            )
+
+
+class OnnxEngine(InferenceEngine):
+    """
+    Runs prefill and decode steps with ONNX Runtime on the CPU, from an export
+    of the model that takes the token ids, attention mask, position ids and each
+    layer's past keys and values, and returns the logits and each layer's
+    present keys and values, so one graph serves both. The export and the graph
+    ONNX Runtime optimizes from it are cached under ENGINE_CACHE_DIR, keyed by
+    the checkpoint's revision, its precision and the library versions, so only
+    the first start with a checkpoint pays for them.
+    """
+
+    engine = InferenceEngines.ONNX
+
+    def __init__(self, model, model_path: str):
+        super().__init__(model)
+        # Imported here so that the other engines run without onnxruntime
+        # installed
+        import onnxruntime
+
+        directory = OnnxEngine.cache_directory(
+            model, model_path, onnxruntime.__version__
+        )
+        optimized_path = os.path.join(directory, "model.optimized.onnx")
+        options = onnxruntime.SessionOptions()
+        # As many threads as torch uses, which a multi-worker server splits
+        # between its workers
+        options.intra_op_num_threads = torch.get_num_threads()
+        if os.path.exists(optimized_path):
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            )
+            self.session = onnxruntime.InferenceSession(
+                optimized_path, options, providers=["CPUExecutionProvider"]
+            )
+        else:
+            # Extended rather than all optimizations, which would tie the saved
+            # graph to this machine's CPU
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            )
+            # Written under a temporary name, so another worker never loads a
+            # partly written graph
+            options.optimized_model_filepath = (
+                f"{optimized_path}.{os.getpid()}.tmp"
+            )
+            self.session = onnxruntime.InferenceSession(
+                OnnxEngine.export(model, directory),
+                options,
+                providers=["CPUExecutionProvider"],
+            )
+            os.replace(options.optimized_model_filepath, optimized_path)
+
+        # The past inputs are (batch, heads, past, head dim), with every
+        # dimension but the batch and past fixed
+        past_input = self.session.get_inputs()[3]
+        self.past_shape = tuple(past_input.shape[i] for i in (1, 3))
+        self.past_dtype = (
+            np.float16 if past_input.type == "tensor(float16)" else np.float32
+        )
+        self.num_layers = (len(self.session.get_inputs()) - 3) // 2
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+        position_ids: torch.Tensor | None = None,
+        past: tuple | None = None,
+    ) -> tuple[torch.Tensor, tuple]:
+        batch_size, length = input_ids.shape
+        past_length = past[0][0].shape[2] if past is not None else 0
+        if attention_mask is None:
+            attention_mask = torch.ones(
+                (batch_size, past_length + length), dtype=torch.long
+            )
+        if position_ids is None:
+            position_ids = (
+                torch.arange(past_length, past_length + length)
+                .unsqueeze(0)
+                .expand(batch_size, -1)
+            )
+
+        feed = {
+            "input_ids": OnnxEngine.to_numpy(input_ids, np.int64),
+            "attention_mask": OnnxEngine.to_numpy(attention_mask, np.int64),
+            "position_ids": OnnxEngine.to_numpy(position_ids, np.int64),
+        }
+        for layer in range(self.num_layers):
+            if past is None:
+                keys = values = np.zeros(
+                    (batch_size, self.past_shape[0], 0, self.past_shape[1]),
+                    dtype=self.past_dtype,
+                )
+            else:
+                keys, values = (
+                    OnnxEngine.to_numpy(t, self.past_dtype) for t in past[layer]
+                )
+            feed[f"past.{layer}.key"] = keys
+            feed[f"past.{layer}.value"] = values
+
+        outputs = [
+            torch.from_numpy(output).to(self.model.device)
+            for output in self.session.run(None, feed)
+        ]
+        return outputs[0], tuple(
+            (outputs[i], outputs[i + 1]) for i in range(1, len(outputs), 2)
+        )
+
+    @staticmethod
+    def to_numpy(tensor: torch.Tensor, dtype) -> np.ndarray:
+        return np.ascontiguousarray(tensor.detach().cpu().numpy(), dtype=dtype)
+
+    @staticmethod
+    def cache_directory(
+        model, model_path: str, onnxruntime_version: str
+    ) -> str:
+        parts = [
+            model_path,
+            ModelRegistry.model_revision(model_path),
+            str(model.dtype),
+            (getattr(model, "precision_report", None) or {}).get("precision"),
+            torch.__version__,
+            transformers.__version__,
+            onnxruntime_version,
+        ]
+        key = hashlib.sha256(
+            json.dumps(parts, default=str).encode("utf-8")
+        ).hexdigest()[:32]
+        return os.path.join(ENGINE_CACHE_DIR, "onnx", key)
+
+    @staticmethod
+    def export(model, directory: str) -> str:
+        """
+        Exports model to directory/model.onnx, unless an earlier start already
+        has, and returns the path.
+        """
+        path = os.path.join(directory, "model.onnx")
+        if os.path.exists(path):
+            return path
+
+        Logger.log(LogLevel.AGENT, "Exporting the model to ONNX...")
+        start = time.perf_counter()
+        step = OnnxStep(model).eval()
+        batch, sequence, past, total = (
+            torch.export.Dim(name)
+            for name in ("batch", "sequence", "past", "total")
+        )
+        with torch.no_grad():
+            _, sample_past = InferenceEngine(model).prefill(
+                torch.zeros((2, 3), dtype=torch.long, device=model.device)
+            )
+        sample_past = tuple(t for layer in sample_past for t in layer)
+        args = (
+            torch.zeros((2, 2), dtype=torch.long),
+            torch.ones((2, 5), dtype=torch.long),
+            torch.tensor([[3, 4], [3, 4]]),
+            *sample_past,
+        )
+        names = [
+            f"{layer}.{kind}"
+            for layer in range(step.num_layers)
+            for kind in ("key", "value")
+        ]
+        program = torch.onnx.export(
+            step,
+            tuple(arg.to(model.device) for arg in args),
+            input_names=[
+                "input_ids",
+                "attention_mask",
+                "position_ids",
+                *[f"past.{name}" for name in names],
+            ],
+            output_names=["logits", *[f"present.{name}" for name in names]],
+            dynamic_shapes=(
+                {0: batch, 1: sequence},
+                {0: batch, 1: total},
+                {0: batch, 1: sequence},
+                tuple({0: batch, 2: past} for _ in sample_past),
+            ),
+            dynamo=True,
+        )
+
+        # Exported beside the cache and moved into place whole, in case another
+        # worker is exporting the same model
+        staging = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(staging, exist_ok=True)
+        program.save(os.path.join(staging, "model.onnx"))
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        Logger.log(
+            LogLevel.AGENT,
+            "Exported the model to ONNX in "
+            f"{time.perf_counter() - start:.1f}s.",
+        )
+        return path
+
+
+class OnnxStep(torch.nn.Module):
+    """
+    A forward pass with the cache flattened into tensors, the form
+    torch.onnx.export takes inputs and outputs in.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.num_layers = model.config.num_hidden_layers
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache(
+                [(past[2 * i], past[2 * i + 1]) for i in range(self.num_layers)]
+            ),
+            use_cache=True,
+        )
+        present = InferenceEngine.legacy_cache(outputs.past_key_values)
+        return outputs.logits, *[t for layer in present for t in layer]
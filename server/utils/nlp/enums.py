@@ -6,6 +6,13 @@ class AudioRequestMode(Enum):
     TRANSCRIBE = "transcribe"
 
 
+# How narration is returned: inline as base64, or as a short-lived audio
+# resource to fetch separately
+class AudioTransport(Enum):
+    BASE64 = "base64"
+    URL = "url"
+
+
 class ConfigType(Enum):
     AGENT = "agent"
     MODEL = "model"
@@ -17,8 +24,16 @@ class DeviceMap(Enum):
     CUDA = "cuda"
 
 
-# Huggingface model documentation can be found by appending the model name to https://huggingface.co/
-# Ex. https://huggingface.co/openai/whisper-large-v3-turbo
+# Backend running the language model's forward passes, see InferenceEngine
+class InferenceEngines(Enum):
+    EAGER = "eager"
+    COMPILE = "compile"
+    ONNX = "onnx"
+
+
+# Huggingface model documentation can be found by appending the model name to
+# https://huggingface.co/ Ex.
+# https://huggingface.co/openai/whisper-large-v3-turbo
 class Models(Enum):
     GPT2 = "gpt2"
     QWEN3 = "Qwen/Qwen3-235B-A22B-Thinking-2507-FP8"
@@ -30,6 +45,15 @@ class PipelineFrameworks(Enum):
     PYTORCH = "pt"
 
 
+# Inference precision of a model's weights, see ModelPrecision
+class Precision(Enum):
+    FLOAT32 = "float32"
+    BFLOAT16 = "bfloat16"
+    INT8_DYNAMIC = "int8-dynamic"
+    INT8_WEIGHT = "int8-weight"
+    INT4_WEIGHT = "int4-weight"
+
+
 class Roles(Enum):
     AGENT = "agent"
     USER = "user"
@@ -37,5 +61,6 @@ class Roles(Enum):
 
 class Tasks(Enum):
     ASR = "automatic-speech-recognition"
+    IMAGE_TO_TEXT = "image-to-text"
     TEXT_GENERATION = "text-generation"
     TTS = "text-to-speech"
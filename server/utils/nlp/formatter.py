@@ -0,0 +1,101 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class PatternFormatter:
+    """
+    Formats datasets.json rows into a single 'text' column column-wise over
+    Arrow batches.
+    The pattern is split on its "{}" placeholders and joined element-wise with
+    the columns in one Arrow kernel, so no Python code runs per row. Columns of
+    {"text": [...]} structs (e.g. SQuAD-style answers) contribute their first
+    text, or "" when empty, matching the original per-row formatter.
+    Use with dataset.with_format("arrow").map(formatter, batched=True).
+    """
+
+    def __init__(self, pattern: str, columns: list[str]):
+        self.pattern = pattern
+        self.columns = columns
+        self.segments = pattern.split("{}")
+        # Only plain positional "{}" placeholders can be joined column-wise;
+        # anything else goes through str.format
+        self.vectorized = len(self.segments) == len(columns) + 1 and not any(
+            "{" in s or "}" in s for s in self.segments
+        )
+
+    def __call__(self, batch: pa.Table) -> pa.Table:
+        if not self.vectorized:
+            return self._format_rows(batch)
+
+        parts = []
+        for literal, column in zip(self.segments, self.columns):
+            parts.append(pa.scalar(literal))
+            parts.append(PatternFormatter.to_text(batch.column(column)))
+        parts.append(pa.scalar(self.segments[-1]))
+
+        # binary_join_element_wise takes the separator as its last argument
+        return pa.table({"text": pc.binary_join_element_wise(*parts, "")})
+
+    def _format_rows(self, batch: pa.Table) -> pa.Table:
+        columns = [
+            PatternFormatter.to_text(batch.column(c)).to_pylist()
+            for c in self.columns
+        ]
+        return pa.table(
+            {"text": [self.pattern.format(*values) for values in zip(*columns)]}
+        )
+
+    @staticmethod
+    def to_text(column) -> pa.Array:
+        """
+        Converts one column to strings the way str() / the {"text": [...]} rule
+        would.
+        """
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        column_type = column.type
+
+        if (
+            pa.types.is_struct(column_type)
+            and column_type.get_field_index("text") >= 0
+        ):
+            texts = pc.struct_field(column, "text")
+            if not (
+                pa.types.is_list(texts.type)
+                or pa.types.is_large_list(texts.type)
+            ):
+                return pa.array([""] * len(column), type=pa.string())
+            return PatternFormatter.first_list_element(texts)
+
+        if pa.types.is_string(column_type) or pa.types.is_large_string(
+            column_type
+        ):
+            return pc.fill_null(column.cast(pa.string()), "None")
+
+        if pa.types.is_integer(column_type):
+            return pc.fill_null(column.cast(pa.string()), "None")
+
+        # Floats, booleans and nested values must match Python's str() exactly,
+        # so convert them in one pass
+        return pa.array([str(v) for v in column.to_pylist()], type=pa.string())
+
+    @staticmethod
+    def first_list_element(lists: pa.Array) -> pa.Array:
+        """
+        The first element of each list as a string, or "" for null and empty
+        lists.
+        """
+        if isinstance(lists, pa.ChunkedArray):
+            lists = lists.combine_chunks()
+
+        # Offsets index directly into the child values, so the first element of
+        # each non-empty list is values[start]
+        starts = lists.offsets[:-1]
+        has_values = pc.fill_null(
+            pc.greater(pc.list_value_length(lists), 0), False
+        )
+        indices = pc.if_else(
+            has_values, starts, pa.scalar(None, type=starts.type)
+        )
+        firsts = pc.take(lists.values, indices)
+        return pc.fill_null(firsts.cast(pa.string()), "")
@@ -0,0 +1,369 @@
+import atexit
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from collections import OrderedDict, deque
+from enum import Enum
+from transformers import TrainerCallback
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+# Lines the worker prints with this prefix are job events; everything else is
+# its ordinary log output
+JOB_EVENT_PREFIX = "[MyAI-JOB] :: "
+SERVER_DIRECTORY = os.path.abspath(os.path.join(__file__, "../../.."))
+TRAINING_CANCEL_GRACE_SECONDS = 30
+TRAINING_NICENESS = 10
+TRAINING_NUM_THREADS = EnvService.get_int(
+    EnvVars.TRAINING_NUM_THREADS.value, max(1, (os.cpu_count() or 2) // 2)
+)
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class TrainingJob:
+    """
+    The serving process's record of a training job; progress is reported back by
+    the worker process.
+    """
+
+    def __init__(self, options: dict):
+        self.id = uuid.uuid4().hex
+        self.options = {
+            k.value if isinstance(k, Enum) else k: v for k, v in options.items()
+        }
+        self.status = JobStatus.QUEUED
+        self.progress = {}
+        self.output_dir = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        Blocks until the job completes, fails or is cancelled; False if timeout
+        passes first.
+        """
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "options": self.options,
+            "progress": self.progress,
+            "output_dir": self.output_dir,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class TrainingJobRunner:
+    """
+    Runs training jobs one at a time in a separate worker process with its own
+    copy of the model, so the model serving chat traffic is never trained in
+    place and Flask workers are never blocked. The worker runs at a lower
+    priority with a capped thread count (TRAINING_NUM_THREADS) to keep inference
+    latency flat while a job runs.
+    """
+
+    def __init__(self, on_complete=None):
+        """
+        (param on_complete): Called with each job that completes successfully,
+            from the monitor thread.
+        """
+        self.on_complete = on_complete
+        self._jobs = OrderedDict()
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+        self._current = None
+        self._process = None
+        self._cancel_requested_at = None
+
+        self._monitor = threading.Thread(
+            target=self._run_monitor, name="training-job-monitor", daemon=True
+        )
+        self._monitor.start()
+        atexit.register(self.shutdown)
+
+    def submit(self, options: dict) -> TrainingJob:
+        job = TrainingJob(options)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._pending.append(job)
+        self._wake.set()
+        Logger.log(LogLevel.TRAINER, f"Training job {job.id} queued.")
+        return job
+
+    def get(self, job_id: str) -> TrainingJob | None:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[TrainingJob]:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> TrainingJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+
+            if job.status == JobStatus.QUEUED:
+                self._pending.remove(job)
+                self._finish(job, JobStatus.CANCELLED)
+            elif job is self._current and self._cancel_requested_at is None:
+                # The worker stops at the next step boundary; it is killed if it
+                # does not within the grace period
+                self._process.send_signal(signal.SIGTERM)
+                self._cancel_requested_at = time.monotonic()
+                Logger.log(
+                    LogLevel.TRAINER, f"Cancelling training job {job.id}..."
+                )
+            return job
+
+    def shutdown(self):
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait(timeout=5)
+
+    ### Monitor thread
+    ################################################################################################
+    def _run_monitor(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    job = self._pending.popleft()
+                    self._start(job)
+
+                try:
+                    self._follow(job)
+                except Exception as e:
+                    Logger.log(
+                        LogLevel.ERROR, f"Training job monitor error, {e}"
+                    )
+                finally:
+                    with self._lock:
+                        self._reap(job)
+
+                if (
+                    job.status == JobStatus.COMPLETED
+                    and self.on_complete is not None
+                ):
+                    try:
+                        self.on_complete(job)
+                    except Exception as e:
+                        Logger.log(
+                            LogLevel.ERROR,
+                            f"Training job completion handler failed, {e}",
+                        )
+
+    def _start(self, job: TrainingJob):
+        self._cancel_requested_at = None
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "utils.nlp.jobs", json.dumps(job.options)],
+            cwd=SERVER_DIRECTORY,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self._current = job
+        job.status = JobStatus.RUNNING
+        job.started_at = time.time()
+        Logger.log(
+            LogLevel.TRAINER,
+            f"Training job {job.id} started (pid {self._process.pid}).",
+        )
+
+        watchdog = threading.Thread(
+            target=self._watch_cancel, args=(self._process,), daemon=True
+        )
+        watchdog.start()
+
+    def _follow(self, job: TrainingJob):
+        """Applies the worker's events to the job until its output closes."""
+        for line in self._process.stdout:
+            if not line.startswith(JOB_EVENT_PREFIX):
+                if line.strip():
+                    Logger.log(
+                        LogLevel.TRAINER, f"[job {job.id}] {line.rstrip()}"
+                    )
+                continue
+
+            event = json.loads(line[len(JOB_EVENT_PREFIX) :])
+            kind = event.pop("type")
+            with self._lock:
+                if kind == "progress":
+                    job.progress = event
+                elif kind == "completed":
+                    job.output_dir = event.get("output_dir")
+                    self._finish(job, JobStatus.COMPLETED)
+                elif kind == "cancelled":
+                    self._finish(job, JobStatus.CANCELLED)
+                elif kind == "failed":
+                    job.error = event.get("error")
+                    self._finish(job, JobStatus.FAILED)
+
+    def _watch_cancel(self, process):
+        while process.poll() is None:
+            time.sleep(1)
+            requested_at = self._cancel_requested_at
+            if (
+                requested_at is not None
+                and time.monotonic() - requested_at
+                > TRAINING_CANCEL_GRACE_SECONDS
+            ):
+                Logger.log(
+                    LogLevel.TRAINER,
+                    "Training worker did not stop, killing it.",
+                )
+                process.kill()
+                return
+
+    def _reap(self, job: TrainingJob):
+        exit_code = self._process.wait()
+        if job.finished_at is None and self._cancel_requested_at is not None:
+            self._finish(job, JobStatus.CANCELLED)
+        elif job.finished_at is None:
+            job.error = f"Training worker exited with code {exit_code}."
+            self._finish(job, JobStatus.FAILED)
+
+        self._current = None
+        self._process = None
+
+    def _finish(self, job: TrainingJob, status: JobStatus):
+        job.status = status
+        job.finished_at = time.time()
+        job._done.set()
+        Logger.log(LogLevel.TRAINER, f"Training job {job.id} {status.value}.")
+
+
+class JobProgressCallback(TrainerCallback):
+    """
+    Reports step, loss, throughput and ETA to the serving process and stops
+    training when the job is cancelled.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.loss = None
+        self._started_at = None
+        self._start_step = 0
+
+    def cancel(self, *_):
+        self.cancelled = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._started_at = time.monotonic()
+        self._start_step = state.global_step
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.cancelled:
+            control.should_training_stop = True
+        self._report(args, state)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs and "loss" in logs:
+            self.loss = logs["loss"]
+            self._report(args, state)
+
+    def _report(self, args, state):
+        elapsed = time.monotonic() - self._started_at
+        steps = state.global_step - self._start_step
+        steps_per_second = steps / elapsed if elapsed > 0 else 0.0
+        samples_per_second = (
+            steps_per_second
+            * args.train_batch_size
+            * args.gradient_accumulation_steps
+            * args.world_size
+        )
+        remaining = max(state.max_steps - state.global_step, 0)
+
+        emit_job_event(
+            "progress",
+            step=state.global_step,
+            max_steps=state.max_steps,
+            epoch=state.epoch,
+            loss=self.loss,
+            steps_per_second=round(steps_per_second, 4),
+            samples_per_second=round(samples_per_second, 4),
+            eta_seconds=(
+                round(remaining / steps_per_second, 1)
+                if steps_per_second
+                else None
+            ),
+        )
+
+
+def emit_job_event(kind: str, **fields):
+    print(JOB_EVENT_PREFIX + json.dumps({"type": kind, **fields}), flush=True)
+
+
+def run_training_job(options: dict):
+    """Entry point of the training worker process."""
+    import torch
+
+    from utils.nlp.trainer import Trainer, TrainingRequestOpts
+
+    torch.set_num_threads(TRAINING_NUM_THREADS)
+    try:
+        os.nice(TRAINING_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+    callback = JobProgressCallback()
+    signal.signal(signal.SIGTERM, callback.cancel)
+    opts = {TrainingRequestOpts(k): v for k, v in options.items()}
+
+    try:
+        model, tokenizer = Trainer.load_providers()
+        trainer = Trainer(model=model, tokenizer=tokenizer)
+
+        trainer.init_trainer(
+            callbacks=[callback],
+            streaming=opts.get(TrainingRequestOpts.STREAMING),
+            max_steps=opts.get(TrainingRequestOpts.MAX_STEPS),
+        )
+        trainer.trainer.train(
+            resume_from_checkpoint=opts.get(
+                TrainingRequestOpts.RESUME_FROM_CHECKPOINT
+            )
+        )
+
+        if callback.cancelled:
+            emit_job_event("cancelled")
+            return
+
+        emit_job_event("completed", output_dir=trainer.handle_training_end())
+    except Exception as e:
+        Logger.log(LogLevel.ERROR, f"Error during training: {e}")
+        emit_job_event(
+            "cancelled" if callback.cancelled else "failed", error=str(e)
+        )
+
+
+if __name__ == "__main__":
+    run_training_job(json.loads(sys.argv[1]))
@@ -0,0 +1,81 @@
+from itertools import chain
+
+# Label value ignored by the loss of transformers models
+IGNORE_INDEX = -100
+
+
+class SequencePacker:
+    """
+    Packs tokenized examples end to end into fixed-length blocks so training
+    batches carry no padding. Each example is followed by an EOS token and its
+    position_ids restart at 0, which transformers uses to detect the packed
+    sequences and build a block-diagonal causal mask, so no token attends across
+    an example boundary. The label of the first token of every example is
+    ignored, since it would otherwise be predicted from the previous example.
+    Examples longer than a block continue in the next one. Only the last block
+    of each map() batch is padded. Use with dataset.map(packer, batched=True,
+    remove_columns=dataset.column_names).
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        eos_token_id: int,
+        pad_token_id: int | None = None,
+    ):
+        self.block_size = block_size
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = (
+            eos_token_id if pad_token_id is None else pad_token_id
+        )
+
+    def __call__(self, batch: dict) -> dict:
+        examples = [
+            ids + [self.eos_token_id] for ids in batch["input_ids"] if ids
+        ]
+        input_ids = list(chain.from_iterable(examples))
+        position_ids = list(
+            chain.from_iterable(range(len(ids)) for ids in examples)
+        )
+        labels = list(input_ids)
+        for i, position in enumerate(position_ids):
+            if position == 0:
+                labels[i] = IGNORE_INDEX
+
+        blocks = {"input_ids": [], "position_ids": [], "labels": []}
+        for start in range(0, len(input_ids), self.block_size):
+            end = start + self.block_size
+            block_positions = position_ids[start:end]
+            if block_positions and block_positions[0] != 0:
+                # An example split across blocks continues from position 0 in
+                # its new block
+                block_positions = SequencePacker._restart_first_segment(
+                    block_positions
+                )
+            blocks["input_ids"].append(input_ids[start:end])
+            blocks["position_ids"].append(block_positions)
+            blocks["labels"].append(labels[start:end])
+
+        if blocks["input_ids"]:
+            pad = self.block_size - len(blocks["input_ids"][-1])
+            if pad:
+                # Padding forms its own segment with ignored labels, so it
+                # neither attends to nor affects real tokens
+                blocks["input_ids"][-1] += [self.pad_token_id] * pad
+                blocks["position_ids"][-1] += list(range(pad))
+                blocks["labels"][-1] += [IGNORE_INDEX] * pad
+        return blocks
+
+    @staticmethod
+    def _restart_first_segment(positions: list[int]) -> list[int]:
+        """
+        Renumbers the leading, continued segment of a block from 0, leaving
+        later segments untouched.
+        """
+        restarted = list(positions)
+        offset = positions[0]
+        for i, position in enumerate(positions):
+            if i > 0 and position == 0:
+                break
+            restarted[i] = position - offset
+        return restarted
@@ -0,0 +1,374 @@
+import math
+import time
+import torch
+import torch.nn.functional as F
+
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+from utils.nlp.dataset_cache import DatasetCache
+from utils.nlp.enums import Precision
+from utils.nlp.registry import ModelRegistry
+
+MODEL_PRECISION = Precision(
+    EnvService.get(EnvVars.MODEL_PRECISION.value, Precision.FLOAT32.value)
+)
+SPEECH_PRECISION = Precision(
+    EnvService.get(EnvVars.SPEECH_PRECISION.value, Precision.FLOAT32.value)
+)
+# Perplexity increase over float32, in percent, beyond which a reduced precision
+# model is replaced by a float32 one; 0 skips the check
+PRECISION_MAX_PERPLEXITY_DRIFT = float(
+    EnvService.get(EnvVars.PRECISION_MAX_PERPLEXITY_DRIFT.value, "5")
+)
+PRECISION_GUARD_SAMPLES = EnvService.get_int(
+    EnvVars.PRECISION_GUARD_SAMPLES.value, 32
+)
+PRECISION_GUARD_MAX_LENGTH = 256
+# Input features sharing one int4 scale
+INT4_GROUP_SIZE = 32
+
+
+class WeightOnlyLinear(nn.Module):
+    """
+    A linear layer whose weight is stored as int8, or as int4 packed two to a
+    byte, with a float scale per output row (int8) or per INT4_GROUP_SIZE inputs
+    of each row (int4). The weight is dequantized on every forward, so it saves
+    memory rather than compute.
+    """
+
+    def __init__(self, linear: nn.Linear, bits: int):
+        super().__init__()
+        assert bits in (4, 8), "Only 8 and 4 bit weights are supported."
+        self.bits = bits
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+        weight = linear.weight.detach().float()
+        if bits == 8:
+            scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+            self.register_buffer(
+                "qweight", torch.round(weight / scale).to(torch.int8)
+            )
+        else:
+            # Pad the inputs to whole groups (and an even count for packing)
+            # with zeros, which dequantize to zero
+            padded = (
+                math.ceil(self.in_features / INT4_GROUP_SIZE) * INT4_GROUP_SIZE
+            )
+            weight = F.pad(weight, (0, padded - self.in_features)).view(
+                self.out_features, -1, INT4_GROUP_SIZE
+            )
+            scale = weight.abs().amax(dim=2, keepdim=True).clamp(min=1e-8) / 7
+            quantized = (
+                (torch.round(weight / scale).clamp(-8, 7) + 8)
+                .to(torch.uint8)
+                .view(self.out_features, -1)
+            )
+            self.register_buffer(
+                "qweight", quantized[:, 0::2] | (quantized[:, 1::2] << 4)
+            )
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def dequantize(self, dtype: torch.dtype) -> torch.Tensor:
+        if self.bits == 8:
+            return self.qweight.to(dtype) * self.scale.to(dtype)
+
+        low = (self.qweight & 0x0F).to(torch.int8) - 8
+        high = (self.qweight >> 4).to(torch.int8) - 8
+        quantized = torch.stack((low, high), dim=2).view(
+            self.out_features, -1, INT4_GROUP_SIZE
+        )
+        weight = (quantized.to(dtype) * self.scale.to(dtype)).view(
+            self.out_features, -1
+        )
+        return weight[:, : self.in_features]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x, self.dequantize(x.dtype), self.bias)
+
+
+class ModelPrecision:
+    """
+    Inference precision modes for models loaded in float32: bfloat16, int8
+    dynamic quantization of linear layers (int8 weights, activations quantized
+    on the fly) and weight-only int8 or int4. Output embeddings, which are
+    usually tied to the input embeddings and decide every token's logit, are
+    left as they are.
+    """
+
+    @staticmethod
+    def load_dtype(precision: Precision) -> torch.dtype:
+        """
+        The dtype to load a model in for precision; quantized modes start from
+        float32.
+        """
+        return (
+            torch.bfloat16 if precision == Precision.BFLOAT16 else torch.float32
+        )
+
+    @staticmethod
+    def apply(model: nn.Module, precision: Precision) -> nn.Module:
+        """
+        Converts a float32 (or for BFLOAT16, already bfloat16) model in place
+        and returns it.
+        """
+        if precision == Precision.FLOAT32:
+            return model
+        if precision == Precision.BFLOAT16:
+            return model.to(torch.bfloat16)
+
+        ModelPrecision.convert_conv1d(model)
+        skip = ModelPrecision.output_embeddings(model)
+        # Names rather than modules, so the float32 layers are freed as soon as
+        # they are replaced
+        names = [
+            name
+            for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and module is not skip
+        ]
+
+        if precision == Precision.INT8_DYNAMIC:
+            qconfig = torch.ao.quantization.default_dynamic_qconfig
+            torch.ao.quantization.quantize_dynamic(
+                model,
+                {name: qconfig for name in names},
+                dtype=torch.qint8,
+                inplace=True,
+            )
+        else:
+            bits = 8 if precision == Precision.INT8_WEIGHT else 4
+            for name in names:
+                ModelPrecision.set_submodule(
+                    model,
+                    name,
+                    WeightOnlyLinear(model.get_submodule(name), bits),
+                )
+
+        ModelPrecision.detach_from_checkpoint(model)
+        return model
+
+    @staticmethod
+    def load(
+        loader,
+        precision: Precision,
+        tokenizer=None,
+        texts: list[str] | None = None,
+    ):
+        """
+        Loads a causal LM with loader(dtype) and converts it to precision. Given
+        a tokenizer, the conversion is guarded, see ModelPrecision.guard.
+        """
+        model = ModelPrecision.apply(
+            loader(ModelPrecision.load_dtype(precision)), precision
+        )
+        model.precision_report = {"precision": precision.value}
+        if tokenizer is not None:
+            model = ModelPrecision.guard(
+                model, loader, precision, tokenizer, texts
+            )
+        return model
+
+    @staticmethod
+    def guard(
+        model,
+        loader,
+        precision: Precision,
+        tokenizer,
+        texts: list[str] | None = None,
+    ):
+        """
+        Measures the perplexity of model, converted to precision, on held-out
+        training examples (or texts) against a float32 copy from loader(dtype),
+        logs it and keeps it on the model as precision_report. Returns model, or
+        the float32 copy if perplexity rose by more than
+        PRECISION_MAX_PERPLEXITY_DRIFT percent.
+        """
+        if (
+            precision == Precision.FLOAT32
+            or PRECISION_MAX_PERPLEXITY_DRIFT <= 0
+        ):
+            return model
+        if texts is None:
+            texts = ModelPrecision.held_out_texts()
+        if not texts:
+            Logger.log(
+                LogLevel.INFO,
+                "No held-out training examples, so the precision guard is "
+                "skipped.",
+            )
+            return model
+
+        perplexity = ModelPrecision.perplexity(model, tokenizer, texts)
+        reference_model = loader(torch.float32)
+        reference = ModelPrecision.perplexity(reference_model, tokenizer, texts)
+        drift = (perplexity - reference) / reference * 100
+        report = {
+            "precision": precision.value,
+            "perplexity": round(perplexity, 4),
+            "float32_perplexity": round(reference, 4),
+            "drift_percent": round(drift, 2),
+            "examples": len(texts),
+        }
+        Logger.log(
+            LogLevel.INFO,
+            f"{precision.value} perplexity {perplexity:.3f} against "
+            f"{reference:.3f} in float32 ({drift:+.2f}%) on"
+            f" {len(texts)} held-out examples.",
+        )
+
+        if drift > PRECISION_MAX_PERPLEXITY_DRIFT:
+            Logger.log(
+                LogLevel.ERROR,
+                f"{precision.value} perplexity drift exceeds "
+                f"{PRECISION_MAX_PERPLEXITY_DRIFT}%, serving float32 instead.",
+            )
+            model = reference_model
+            report["precision"] = Precision.FLOAT32.value
+            report["rejected"] = precision.value
+        del reference_model
+        model.precision_report = report
+        return model
+
+    @staticmethod
+    def perplexity(
+        model,
+        tokenizer,
+        texts: list[str],
+        max_length: int = PRECISION_GUARD_MAX_LENGTH,
+    ) -> float:
+        """
+        Token-weighted perplexity of texts, each truncated to max_length tokens.
+        """
+        total_loss, total_tokens = 0.0, 0
+        with torch.inference_mode():
+            for text in texts:
+                input_ids = tokenizer(
+                    text,
+                    truncation=True,
+                    max_length=max_length,
+                    return_tensors="pt",
+                ).input_ids
+                if input_ids.shape[1] < 2:
+                    continue
+                input_ids = input_ids.to(model.device)
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+                total_loss += float(loss) * (input_ids.shape[1] - 1)
+                total_tokens += input_ids.shape[1] - 1
+        return (
+            math.exp(total_loss / total_tokens)
+            if total_tokens
+            else float("nan")
+        )
+
+    @staticmethod
+    def held_out_texts(count: int = PRECISION_GUARD_SAMPLES) -> list[str]:
+        """
+        The first count evaluation examples of the active datasets in
+        datasets.json, held out from training by Trainer.is_eval_example, the
+        rule both prepared and streamed training runs split by. They are read by
+        streaming the first time, so nothing is downloaded in full, and from the
+        dataset cache on later startups and hot swaps.
+        """
+        if count <= 0:
+            return []
+
+        cache = DatasetCache()
+        start = time.perf_counter()
+        try:
+            active = [
+                config
+                for config in DatasetCache.load_configs()
+                if config.get("active") is True
+            ]
+            key = DatasetCache.fingerprint(
+                "held_out",
+                [
+                    DatasetCache.dataset_fingerprint(config, None, None)
+                    for config in active
+                ],
+                count,
+            )
+            texts = cache.load_texts(key)
+            if texts is None:
+                texts = ModelPrecision.stream_held_out_texts(active, count)
+                cache.save_texts(key, texts)
+        except Exception as e:
+            Logger.log(
+                LogLevel.ERROR,
+                "Failed to read held-out examples for the precision guard, "
+                f"{e}",
+            )
+            return []
+        Logger.log(
+            LogLevel.INFO,
+            f"Read {len(texts)} held-out examples in "
+            f"{time.perf_counter() - start:.1f}s.",
+        )
+        return texts
+
+    @staticmethod
+    def stream_held_out_texts(configs: list[dict], count: int) -> list[str]:
+        # Imported here so that serving without the guard, or with its texts
+        # cached, does not pay for the training stack
+        from utils.nlp.trainer import Trainer
+
+        texts = []
+        for config in configs:
+            for example in Trainer.format_dataset(
+                config, streaming=True
+            ).filter(Trainer.is_eval_example):
+                texts.append(example["text"])
+                if len(texts) >= count:
+                    return texts
+        return texts
+
+    @staticmethod
+    def convert_conv1d(model: nn.Module):
+        """
+        Replaces GPT-2 style Conv1D layers, which are linear layers with a
+        transposed weight, with nn.Linear.
+        """
+        for name, module in list(model.named_modules()):
+            if isinstance(module, Conv1D):
+                in_features, out_features = module.weight.shape
+                linear = nn.Linear(
+                    in_features,
+                    out_features,
+                    device=module.weight.device,
+                    dtype=module.weight.dtype,
+                )
+                linear.weight = nn.Parameter(
+                    module.weight.detach().t().contiguous()
+                )
+                # Copied, since dynamic quantization packs the bias where
+                # detach_from_checkpoint cannot reach it
+                linear.bias = nn.Parameter(module.bias.detach().clone())
+                ModelPrecision.set_submodule(model, name, linear)
+
+    @staticmethod
+    def detach_from_checkpoint(model: nn.Module):
+        """
+        Copies the tensors left unquantized out of the checkpoint's memory map.
+        The map is private, so every page read while quantizing stays resident
+        for as long as any tensor still points into it.
+        """
+        with torch.no_grad():
+            for tensor in list(model.parameters()) + list(model.buffers()):
+                tensor.data = tensor.data.clone()
+        ModelRegistry.free_memory()
+
+    @staticmethod
+    def output_embeddings(model: nn.Module) -> nn.Module | None:
+        try:
+            return model.get_output_embeddings()
+        except (AttributeError, NotImplementedError):
+            return None
+
+    @staticmethod
+    def set_submodule(model: nn.Module, name: str, module: nn.Module):
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child_name, module)
@@ -0,0 +1,292 @@
+import ctypes
+import ctypes.util
+import gc
+import hashlib
+import os
+import threading
+import time
+import torch
+
+from huggingface_hub import try_to_load_from_cache
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+# Total parameter and buffer memory the registry keeps loaded before evicting
+# idle models; 0 disables eviction
+MODEL_MEMORY_BUDGET_MB = EnvService.get_int(
+    EnvVars.MODEL_MEMORY_BUDGET_MB.value, 0
+)
+
+# glibc keeps freed memory for reuse; malloc_trim returns it to the system (only
+# available with glibc)
+_LIBC_PATH = ctypes.util.find_library("c")
+_LIBC = ctypes.CDLL(_LIBC_PATH) if _LIBC_PATH else None
+if _LIBC is not None and not hasattr(_LIBC, "malloc_trim"):
+    _LIBC = None
+
+
+class RegisteredModel:
+    def __init__(
+        self,
+        key: str,
+        kind: str,
+        value,
+        size_bytes: int,
+        load_seconds: float,
+        pinned: bool,
+    ):
+        self.key = key
+        self.kind = kind
+        self.value = value
+        self.size_bytes = size_bytes
+        self.load_seconds = load_seconds
+        self.pinned = pinned
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+    def to_dict(self) -> dict:
+        return {
+            "key": self.key,
+            "kind": self.kind,
+            "size_bytes": self.size_bytes,
+            "load_seconds": round(self.load_seconds, 3),
+            "pinned": self.pinned,
+            "loaded_at": self.loaded_at,
+            "idle_seconds": round(time.monotonic() - self.last_used, 3),
+        }
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and shares them: every get() of the same key
+    returns the same instance, and concurrent first calls wait for a single
+    load. Each model's parameter and buffer memory is tracked, and once the
+    total exceeds the budget the least recently used models that are not pinned
+    are released.
+    Holders should get() a model each time they use it rather than keep it, so
+    that eviction actually frees it; models that must stay resident, such as the
+    one the generation scheduler serves, are registered pinned.
+    """
+
+    def __init__(self, budget_mb: int = MODEL_MEMORY_BUDGET_MB):
+        self.budget_bytes = max(budget_mb, 0) * 1024 * 1024
+        self._models = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, key: str, loader, kind: str, pinned: bool = False):
+        """
+        Returns the model registered under key, calling loader() to load it on
+        first use.
+        (param key): Identifies the checkpoint and what it is loaded as, see
+            ModelRegistry.key.
+        (param pinned): Never evict the model; it stays loaded until released.
+        """
+        entry = self._touch(key)
+        if entry is not None:
+            return entry.value
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            # Another caller may have finished loading while this one waited
+            entry = self._touch(key)
+            if entry is not None:
+                return entry.value
+
+            Logger.log(LogLevel.INFO, f"Loading model {key}...")
+            start = time.perf_counter()
+            value = loader()
+            entry = RegisteredModel(
+                key,
+                kind,
+                value,
+                ModelRegistry.measure(value),
+                time.perf_counter() - start,
+                pinned,
+            )
+            with self._lock:
+                self._models[key] = entry
+            Logger.log(
+                LogLevel.INFO,
+                f"Loaded model {key} ({entry.size_bytes / 1024 / 1024:.0f} MB) "
+                f"in {entry.load_seconds:.1f}s.",
+            )
+
+        self._evict(keep=key)
+        return value
+
+    @staticmethod
+    def key(kind: str, name: str) -> str:
+        return f"{kind}:{name}"
+
+    def register(self, key: str, value, kind: str, pinned: bool = True):
+        """
+        Adds a model loaded elsewhere, replacing any model already registered
+        under key.
+        """
+        self.release(key)
+        self.get(key, lambda: value, kind, pinned)
+
+    def release(self, key: str) -> bool:
+        with self._lock:
+            entry = self._models.pop(key, None)
+        if entry is None:
+            return False
+        Logger.log(LogLevel.INFO, f"Released model {key}.")
+        ModelRegistry.free_memory()
+        return True
+
+    def contains(self, key: str) -> bool:
+        return key in self._models
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._models.values())
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            models = sorted(
+                self._models.values(),
+                key=lambda entry: entry.last_used,
+                reverse=True,
+            )
+            return {
+                "budget_bytes": self.budget_bytes,
+                "total_bytes": sum(entry.size_bytes for entry in models),
+                "process_rss_bytes": ModelRegistry.process_rss_bytes(),
+                "models": [entry.to_dict() for entry in models],
+            }
+
+    def _touch(self, key: str) -> RegisteredModel | None:
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                entry.last_used = time.monotonic()
+            return entry
+
+    def _evict(self, keep: str):
+        if not self.budget_bytes:
+            return
+
+        evicted = []
+        with self._lock:
+            total = sum(entry.size_bytes for entry in self._models.values())
+            candidates = sorted(
+                (
+                    entry
+                    for entry in self._models.values()
+                    if not entry.pinned and entry.key != keep
+                ),
+                key=lambda entry: entry.last_used,
+            )
+            for entry in candidates:
+                if total <= self.budget_bytes:
+                    break
+                del self._models[entry.key]
+                total -= entry.size_bytes
+                evicted.append(entry.key)
+
+        for key in evicted:
+            Logger.log(
+                LogLevel.INFO,
+                f"Evicted least recently used model {key} to stay within the "
+                "memory budget.",
+            )
+        if evicted:
+            ModelRegistry.free_memory()
+        if total > self.budget_bytes:
+            Logger.log(
+                LogLevel.INFO,
+                f"Loaded models use {total / 1024 / 1024:.0f} MB, over the "
+                f"{self.budget_bytes / 1024 / 1024:.0f} MB"
+                " budget, and none left can be evicted.",
+            )
+
+    @staticmethod
+    def model_revision(name: str) -> str | None:
+        """
+        Identifies the version of a checkpoint without loading it: the snapshot
+        commit of a Hugging Face Hub model in the local cache, or for a local
+        directory a hash of its files' names, sizes and modification times. None
+        if a Hub model has not been downloaded yet.
+        """
+        if os.path.isdir(name):
+            hasher = hashlib.sha256()
+            for entry in sorted(os.scandir(name), key=lambda entry: entry.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    fingerprint = (
+                        f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}"
+                    )
+                    hasher.update(fingerprint.encode("utf-8"))
+            return hasher.hexdigest()[:16]
+
+        config_path = try_to_load_from_cache(name, "config.json")
+        if isinstance(config_path, str):
+            # Cached files live under snapshots/<commit hash>/
+            return os.path.basename(os.path.dirname(config_path))
+        return None
+
+    @staticmethod
+    def measure(value) -> int:
+        """
+        Bytes of parameters and buffers in value: a torch module, or a pipeline
+        or object holding modules.
+        """
+        modules = []
+        if isinstance(value, torch.nn.Module):
+            modules.append(value)
+        else:
+            for attr in ("model", "vocoder"):
+                module = getattr(value, attr, None)
+                if isinstance(module, torch.nn.Module):
+                    modules.append(module)
+
+        # Tied weights share storage and are only counted once
+        storages = {}
+        packed_bytes = 0
+        for module in modules:
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                storage = tensor.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+            # Dynamically quantized layers keep their weights in packed params,
+            # which are neither parameters nor buffers
+            for submodule in module.modules():
+                packed = getattr(submodule, "_packed_params", None)
+                if packed is not None and not isinstance(
+                    packed, torch.nn.Module
+                ):
+                    packed_bytes += sum(
+                        tensor.numel() * tensor.element_size()
+                        for tensor in submodule._weight_bias()
+                        if tensor is not None
+                    )
+        return sum(storages.values()) + packed_bytes
+
+    @staticmethod
+    def process_rss_bytes() -> int | None:
+        """The process's resident memory, where /proc is available."""
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def free_memory():
+        """
+        Collects released models and hands their memory back to the system
+        rather than the allocator's free lists.
+        """
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if _LIBC is not None:
+            _LIBC.malloc_trim(0)
+
+
+# Shared by every component in the process so that the same checkpoint is only
+# ever loaded once
+MODEL_REGISTRY = ModelRegistry()
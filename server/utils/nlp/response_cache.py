@@ -0,0 +1,88 @@
+import hashlib
+import json
+import threading
+
+from collections import OrderedDict
+
+from services.env import EnvService, EnvVars
+
+# Replies kept for repeated prompts; 0 disables the cache
+RESPONSE_CACHE_SIZE = EnvService.get_int(EnvVars.RESPONSE_CACHE_SIZE.value, 0)
+
+
+class ResponseCache:
+    """
+    Replies to prompts seen before, least recently used first out once
+    max_entries is reached. Only valid while decoding is deterministic: callers
+    key entries with ResponseCache.key on everything that determines the reply,
+    and clear() the cache when the model changes.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE):
+        self.max_entries = max(max_entries, 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(
+        prompt: str,
+        generation_config: dict | None,
+        model: str,
+        model_version: int,
+        seed: int | None,
+    ) -> str:
+        """
+        (param prompt): The templated prompt, history window included;
+            whitespace differences are ignored.
+        """
+        parts = [
+            " ".join(prompt.split()),
+            generation_config,
+            model,
+            model_version,
+            seed,
+        ]
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            response = self._entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
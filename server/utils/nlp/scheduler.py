@@ -0,0 +1,763 @@
+import queue
+import threading
+import time
+import torch
+import torch.nn.functional as F
+
+from transformers import (
+    LogitsProcessorList,
+    MinPLogitsWarper,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+from utils.metrics import (
+    COMPLETION_TOKENS,
+    DECODE_TOKENS_PER_SECOND,
+    PROMPT_TOKENS,
+    STAGE_SECONDS,
+    ServingStages,
+)
+from utils.nlp.engines import InferenceEngine
+from utils.nlp.speculative import SpeculativeDecoder
+
+GENERATION_MAX_BATCH_SIZE = EnvService.get_int(
+    EnvVars.GENERATION_MAX_BATCH_SIZE.value, 8
+)
+GENERATION_MAX_WAIT_MS = EnvService.get_int(
+    EnvVars.GENERATION_MAX_WAIT_MS.value, 10
+)
+
+# Latency of the generation stages: waiting to be admitted, prefill up to the
+# first token, each batched decode step, and each request's decode after its
+# first token
+QUEUE_SECONDS = STAGE_SECONDS.labels(ServingStages.QUEUE.value)
+PREFILL_SECONDS = STAGE_SECONDS.labels(ServingStages.PREFILL.value)
+DECODE_STEP_SECONDS = STAGE_SECONDS.labels(ServingStages.DECODE_STEP.value)
+DECODE_SECONDS = STAGE_SECONDS.labels(ServingStages.DECODE.value)
+
+
+# Generation settings the scheduler's decoding loop does not apply, and the
+# values at which they would change the output
+_UNSUPPORTED_GENERATION_OPTIONS = {
+    "num_beams": lambda v: v is not None and v > 1,
+    "num_beam_groups": lambda v: v is not None and v > 1,
+    "repetition_penalty": lambda v: v is not None and v != 1.0,
+    "no_repeat_ngram_size": lambda v: bool(v),
+    "bad_words_ids": lambda v: bool(v),
+}
+
+# Queue marker used to wake an idle scheduler for a model swap
+_SWAP = object()
+
+
+class GenerationRequest:
+    """
+    A single sequence submitted to the GenerationScheduler.
+    Callers either block on result() or iterate stream() while the scheduler
+    thread fills output_ids.
+    """
+
+    def __init__(
+        self,
+        input_ids: list[int],
+        max_new_tokens: int,
+        prefix_ids: list[int] | None = None,
+        prefix_cache: tuple | None = None,
+        keep_cache: bool = False,
+        prefix_model_version: int | None = None,
+    ):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.output_ids = []
+        self.error = None
+
+        # KV cache of an earlier sequence whose tokens may prefix input_ids, and
+        # whether to hand back our own
+        self.prefix_ids = prefix_ids
+        self.prefix_cache = prefix_cache
+        self.prefix_model_version = prefix_model_version
+        self.keep_cache = keep_cache
+        self.model_version = None
+        self.cached_ids = None
+        self.final_cache = None
+        self.reused_tokens = 0
+
+        # Per-sequence decoding state, owned by the scheduler thread
+        self.cache = None
+        self.length = 0
+        self.stopped = False
+        # The speculative draft model's cache, covering the first draft_length
+        # tokens of input_ids + output_ids
+        self.draft_cache = None
+        self.draft_length = 0
+
+        # perf_counter() times the request was queued and its first token
+        # sampled
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+
+        self._done = threading.Event()
+        self._tokens = queue.Queue()
+
+    def append(self, token_id: int):
+        self.output_ids.append(token_id)
+        self._tokens.put(token_id)
+
+    def finish(self, error: Exception | None = None):
+        self.error = error
+        self.cache = None
+        self.prefix_cache = None
+        self.draft_cache = None
+        self._done.set()
+        self._tokens.put(None)
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout: float | None = None) -> list[int]:
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation request timed out.")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def stream(self, timeout: float | None = None):
+        """Yields token ids as soon as the scheduler decodes them."""
+        while True:
+            try:
+                token_id = self._tokens.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("Generation request timed out.")
+            if token_id is None:
+                break
+            yield token_id
+
+        if self.error is not None:
+            raise self.error
+
+
+class ModelSwap:
+    """
+    A model scheduled to replace the GenerationScheduler's current one. Callers
+    block on wait().
+    """
+
+    def __init__(
+        self,
+        model,
+        engine: InferenceEngine,
+        speculator: SpeculativeDecoder | None,
+    ):
+        self.model = model
+        self.engine = engine
+        self.speculator = speculator
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, error: Exception | None = None):
+        self.error = error
+        self._done.set()
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float | None = None):
+        """
+        Returns once the new model has taken over, and raises if it could not.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Model swap timed out.")
+        if self.error is not None:
+            raise self.error
+
+
+class GenerationScheduler:
+    """
+    Continuous-batching front end for a causal LM, decoding queued requests
+    together one token per step. Each request decodes a single hypothesis; see
+    _UNSUPPORTED_GENERATION_OPTIONS.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = GENERATION_MAX_BATCH_SIZE,
+        max_wait_ms: int = GENERATION_MAX_WAIT_MS,
+        eos_token_id: int | list[int] | None = None,
+        engine: InferenceEngine | None = None,
+        speculator: SpeculativeDecoder | None = None,
+    ):
+        assert max_batch_size > 0, "max_batch_size must be greater than 0."
+
+        self.model = model
+        self.engine = engine or InferenceEngine(model)
+        self.speculator = speculator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0) / 1000.0
+
+        self._queue = queue.Queue()
+        self._active = []
+        self._batch_cache = None
+        self._batch_mask = None
+        self._stopped = False
+        # Sampling draws from its own generator, so other users of torch's
+        # global RNG (Bark's seeding) never shift it
+        self._generator = torch.Generator()
+        self._generator.seed()
+        # The ModelSwap waiting for the batch to drain, replaced only under
+        # _swap_lock
+        self._pending_model = None
+        self._swap_lock = threading.Lock()
+        self.model_version = 0
+
+        self._extra_eos_token_id = eos_token_id
+        self._configure_decoding(eos_token_id)
+
+        self._thread = threading.Thread(
+            target=self._run, name="generation-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        input_ids: list[int],
+        max_new_tokens: int,
+        prefix_ids: list[int] | None = None,
+        prefix_cache: tuple | None = None,
+        keep_cache: bool = False,
+        prefix_model_version: int | None = None,
+    ) -> GenerationRequest:
+        """
+        Queues a sequence for generation.
+        (param prefix_ids, prefix_cache): An earlier sequence whose common
+            prefix with input_ids is reused.
+        (param keep_cache): Keep the finished sequence's KV cache on the request
+            for the next turn.
+        (param prefix_model_version): The model_version of prefix_cache; caches
+            from swapped-out models are ignored.
+        """
+        assert not self._stopped, "Generation scheduler has been shut down."
+        request = GenerationRequest(
+            input_ids,
+            max_new_tokens,
+            prefix_ids,
+            prefix_cache,
+            keep_cache,
+            prefix_model_version,
+        )
+        if max_new_tokens <= 0 or not request.input_ids:
+            request.finish()
+            return request
+        self._queue.put(request)
+        return request
+
+    def generate(self, input_ids: list[int], max_new_tokens: int) -> list[int]:
+        return self.submit(input_ids, max_new_tokens).result()
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def active_count(self) -> int:
+        """Requests currently being decoded."""
+        return len(self._active)
+
+    def swap_model(
+        self,
+        model,
+        engine: InferenceEngine | None = None,
+        speculator: SpeculativeDecoder | None = None,
+    ) -> ModelSwap:
+        """
+        Replaces the model once in-flight requests finish; a later swap
+        supersedes a pending one.
+        """
+        swap = ModelSwap(model, engine or InferenceEngine(model), speculator)
+        with self._swap_lock:
+            superseded, self._pending_model = self._pending_model, swap
+        if superseded is not None:
+            superseded.finish(
+                RuntimeError("Model swap was superseded by a later one.")
+            )
+        # Wake an idle scheduler so the swap happens immediately rather than on
+        # the next request
+        self._queue.put(_SWAP)
+        return swap
+
+    def shutdown(self):
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    ### Scheduler thread
+    ################################################################################################
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                admitted = self._admit()
+                if admitted is None:
+                    break
+
+                try:
+                    self._step(admitted)
+                except Exception as e:
+                    Logger.log(
+                        LogLevel.ERROR, f"Generation scheduler step failed, {e}"
+                    )
+                    for request in self._active + admitted:
+                        if not request.is_done():
+                            request.finish(e)
+                    self._active = []
+                    self._batch_cache = None
+                    self._batch_mask = None
+
+        for request in self._active:
+            request.finish(RuntimeError("Generation scheduler shut down."))
+        # Requests still queued, including any submitted while shutting down,
+        # would otherwise wait forever
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, GenerationRequest):
+                item.finish(RuntimeError("Generation scheduler shut down."))
+        with self._swap_lock:
+            swap, self._pending_model = self._pending_model, None
+        if swap is not None:
+            swap.finish(RuntimeError("Generation scheduler shut down."))
+
+    def _admit(self) -> list[GenerationRequest] | None:
+        if self._pending_model is not None:
+            if self._active:
+                # Hold new requests back so the current batch drains on the old
+                # weights
+                return []
+            self._apply_swap()
+
+        capacity = self.max_batch_size - len(self._active)
+        admitted = []
+
+        if not self._active:
+            # Idle: block for the first request, then linger briefly so a burst
+            # shares its first batch
+            first = self._queue.get()
+            if first is None:
+                return None
+            if first is _SWAP:
+                return []
+            admitted.append(first)
+            deadline = time.monotonic() + self.max_wait
+            while len(admitted) < capacity:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                if item is not _SWAP:
+                    admitted.append(item)
+        else:
+            while len(admitted) < capacity:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                if item is not _SWAP:
+                    admitted.append(item)
+
+        return admitted
+
+    def _apply_swap(self):
+        with self._swap_lock:
+            swap, self._pending_model = self._pending_model, None
+        if swap is None:
+            return
+
+        previous = (self.model, self.engine, self.speculator)
+        try:
+            self.model, self.engine, self.speculator = (
+                swap.model,
+                swap.engine,
+                swap.speculator,
+            )
+            self._configure_decoding(self._extra_eos_token_id)
+        except Exception as e:
+            # Keep serving the current model; the caller waiting on the swap
+            # gets the error
+            Logger.log(
+                LogLevel.ERROR,
+                f"Generation scheduler failed to switch models, {e}",
+            )
+            self.model, self.engine, self.speculator = previous
+            self._configure_decoding(self._extra_eos_token_id)
+            swap.finish(e)
+            return
+
+        self.model_version += 1
+        swap.finish()
+        Logger.log(
+            LogLevel.AGENT,
+            "Generation scheduler switched to model version "
+            f"{self.model_version}.",
+        )
+
+    def _step(self, admitted: list[GenerationRequest]):
+        joining = []
+        for request in admitted:
+            try:
+                self._prefill(request)
+                if request.stopped:
+                    self._complete(request)
+                else:
+                    joining.append(request)
+            except Exception as e:
+                # A bad input or an out-of-memory prefill only fails its own
+                # request, not the batch decoding alongside it
+                Logger.log(
+                    LogLevel.ERROR, f"Generation request prefill failed, {e}"
+                )
+                if not request.is_done():
+                    request.finish(e)
+
+        if joining:
+            self._unpack_batch()
+            self._active.extend(joining)
+            self._rebuild_batch()
+
+        if not self._active:
+            return
+
+        with DECODE_STEP_SECONDS.time():
+            if self.speculator is not None and len(self._active) == 1:
+                self._decode_alone(self._active[0])
+            else:
+                self._decode()
+
+        finished = [r for r in self._active if r.stopped]
+        if finished:
+            self._unpack_batch()
+            for request in finished:
+                self._complete(request)
+            self._active = [r for r in self._active if not r.stopped]
+            self._rebuild_batch()
+
+    def _prefill(self, request: GenerationRequest):
+        started_at = time.perf_counter()
+        QUEUE_SECONDS.observe(started_at - request.submitted_at)
+        device = self.model.device
+        reused = self._reusable_prefix_length(request)
+
+        if reused > 0:
+            # Only run the suffix the cached turn has not already seen
+            past = tuple(
+                (k[:, :, :reused, :], v[:, :, :reused, :])
+                for k, v in request.prefix_cache
+            )
+            input_ids = torch.tensor(
+                [request.input_ids[reused:]], device=device
+            )
+            logits, cache = self.engine.prefill(
+                input_ids,
+                attention_mask=torch.ones(
+                    (1, len(request.input_ids)), dtype=torch.long, device=device
+                ),
+                position_ids=torch.arange(
+                    reused, len(request.input_ids), device=device
+                ).unsqueeze(0),
+                past=past,
+            )
+        else:
+            input_ids = torch.tensor([request.input_ids], device=device)
+            logits, cache = self.engine.prefill(input_ids)
+
+        request.prefix_cache = None
+        request.model_version = self.model_version
+        request.reused_tokens = reused
+        request.cache = cache
+        request.length = len(request.input_ids)
+        self._accept_token(
+            request, int(self._sample(logits[:, -1, :], input_ids)[0])
+        )
+        request.first_token_at = time.perf_counter()
+        PREFILL_SECONDS.observe(request.first_token_at - started_at)
+
+    def _complete(self, request: GenerationRequest):
+        PROMPT_TOKENS.observe(len(request.input_ids))
+        COMPLETION_TOKENS.observe(len(request.output_ids))
+        if len(request.output_ids) > 1:
+            decode_seconds = time.perf_counter() - request.first_token_at
+            DECODE_SECONDS.observe(decode_seconds)
+            DECODE_TOKENS_PER_SECOND.observe(
+                (len(request.output_ids) - 1) / decode_seconds
+            )
+
+        if request.keep_cache:
+            # Every token except the last sampled one has been run through the
+            # model
+            request.cached_ids = (request.input_ids + request.output_ids)[
+                : request.length
+            ]
+            request.final_cache = request.cache
+        request.finish()
+
+    def _decode(self):
+        device = self.model.device
+        batch_size = len(self._active)
+
+        input_ids = torch.tensor(
+            [[r.output_ids[-1]] for r in self._active], device=device
+        )
+        position_ids = torch.tensor(
+            [[r.length] for r in self._active], device=device
+        )
+        attention_mask = torch.cat(
+            [
+                self._batch_mask,
+                torch.ones(
+                    (batch_size, 1), dtype=self._batch_mask.dtype, device=device
+                ),
+            ],
+            dim=1,
+        )
+
+        logits, self._batch_cache = self.engine.decode(
+            input_ids, attention_mask, position_ids, self._batch_cache
+        )
+        self._batch_mask = attention_mask
+
+        tokens = self._sample(logits[:, -1, :], input_ids).tolist()
+        for request, token in zip(self._active, tokens):
+            request.length += 1
+            self._accept_token(request, int(token))
+
+    def _decode_alone(self, request: GenerationRequest):
+        """
+        Decodes the only active request, speculatively unless the speculator
+        holds off, and times the step.
+        """
+        start = time.perf_counter()
+        produced = len(request.output_ids)
+        speculative = self.speculator.should_speculate()
+        if speculative:
+            self._speculate(request)
+        else:
+            self._decode()
+        self.speculator.record_timing(
+            len(request.output_ids) - produced,
+            time.perf_counter() - start,
+            speculative,
+        )
+
+    def _speculate(self, request: GenerationRequest):
+        """
+        Runs the request's last token and the draft model's proposals after it
+        through the model in one pass.
+        """
+        device = self.model.device
+        sequence = request.input_ids + request.output_ids
+        probabilities = self._probabilities if self._do_sample else None
+        count = min(
+            self.speculator.draft_tokens,
+            request.max_new_tokens - len(request.output_ids),
+        )
+        draft_ids, distributions = self.speculator.propose(
+            request, sequence, count, probabilities, self._generator
+        )
+
+        input_ids = torch.tensor([[sequence[-1]] + draft_ids], device=device)
+        logits, cache = self.engine.prefill(
+            input_ids,
+            attention_mask=torch.ones(
+                (1, request.length + input_ids.shape[1]),
+                dtype=torch.long,
+                device=device,
+            ),
+            position_ids=torch.arange(
+                request.length,
+                request.length + input_ids.shape[1],
+                device=device,
+            ).unsqueeze(0),
+            past=self.engine.batch_cache(self._batch_cache),
+        )
+        tokens = self.speculator.verify(
+            request,
+            len(sequence),
+            logits,
+            draft_ids,
+            distributions,
+            probabilities,
+            self._generator,
+        )
+
+        consumed = 0
+        for token in tokens:
+            consumed += 1
+            self._accept_token(request, token)
+            if request.stopped:
+                break
+
+        # The cache keeps the last sequence token and the accepted tokens run
+        # after it, but not the rejected ones
+        request.length += consumed
+        self._batch_cache = SpeculativeDecoder.crop(cache, request.length)
+        self._batch_mask = torch.ones(
+            (1, request.length), dtype=torch.long, device=device
+        )
+
+    def _unpack_batch(self):
+        """
+        Split the shared batch cache back into per-request caches without their
+        left padding.
+        """
+        if self._batch_cache is None:
+            return
+        batch_cache = self.engine.batch_cache(self._batch_cache)
+        for i, request in enumerate(self._active):
+            request.cache = tuple(
+                (
+                    k[i : i + 1, :, -request.length :, :],
+                    v[i : i + 1, :, -request.length :, :],
+                )
+                for k, v in batch_cache
+            )
+        self._batch_cache = None
+        self._batch_mask = None
+
+    def _rebuild_batch(self):
+        """
+        Left-pad every active request's cache to a common length and stack them
+        into one batch.
+        """
+        if not self._active:
+            return
+
+        max_len = max(r.length for r in self._active)
+        num_layers = len(self._active[0].cache)
+        layers = []
+        for layer in range(num_layers):
+            keys, values = [], []
+            for request in self._active:
+                k, v = request.cache[layer]
+                pad = max_len - request.length
+                if pad:
+                    k = F.pad(k, (0, 0, pad, 0))
+                    v = F.pad(v, (0, 0, pad, 0))
+                keys.append(k)
+                values.append(v)
+            layers.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+
+        self._batch_cache = tuple(layers)
+        self._batch_mask = torch.tensor(
+            [[0] * (max_len - r.length) + [1] * r.length for r in self._active],
+            dtype=torch.long,
+            device=self.model.device,
+        )
+        for request in self._active:
+            request.cache = None
+
+    def _accept_token(self, request: GenerationRequest, token_id: int):
+        if token_id in self._eos_token_ids:
+            request.stopped = True
+            return
+        request.append(token_id)
+        if len(request.output_ids) >= request.max_new_tokens:
+            request.stopped = True
+
+    ### Decoding configuration
+    ################################################################################################
+    def _configure_decoding(self, eos_token_id):
+        generation_config = self.model.generation_config
+        self.ignored_options = {
+            name: getattr(generation_config, name, None)
+            for name, applies in _UNSUPPORTED_GENERATION_OPTIONS.items()
+            if applies(getattr(generation_config, name, None))
+        }
+        if self.ignored_options:
+            Logger.log(
+                LogLevel.AGENT,
+                "Generation scheduler decodes one hypothesis per request "
+                "without these generation settings: "
+                + ", ".join(
+                    f"{name}={value}"
+                    for name, value in self.ignored_options.items()
+                ),
+            )
+        self._eos_token_ids = set()
+        for ids in (
+            eos_token_id,
+            generation_config.eos_token_id,
+            self.model.config.eos_token_id,
+        ):
+            if isinstance(ids, int):
+                ids = [ids]
+            self._eos_token_ids.update(ids or [])
+
+        self._do_sample = bool(generation_config.do_sample)
+        self._warpers = LogitsProcessorList()
+        if not self._do_sample:
+            return
+
+        temperature = generation_config.temperature
+        if temperature is not None and temperature != 1.0:
+            self._warpers.append(TemperatureLogitsWarper(temperature))
+        if generation_config.top_k:
+            self._warpers.append(
+                TopKLogitsWarper(top_k=generation_config.top_k)
+            )
+        if (
+            generation_config.top_p is not None
+            and generation_config.top_p < 1.0
+        ):
+            self._warpers.append(
+                TopPLogitsWarper(top_p=generation_config.top_p)
+            )
+        if generation_config.min_p:
+            self._warpers.append(
+                MinPLogitsWarper(min_p=generation_config.min_p)
+            )
+
+    def _probabilities(self, logits):
+        """
+        The distribution tokens are sampled from, after temperature and top-k,
+        top-p and min-p filtering.
+        """
+        return F.softmax(self._warpers(None, logits.float()), dim=-1)
+
+    def seed(self, seed: int):
+        """Seeds the generator sampled tokens are drawn from."""
+        self._generator.manual_seed(seed)
+
+    def _sample(self, logits, input_ids):
+        scores = self._warpers(input_ids, logits.float())
+        if self._do_sample:
+            probs = F.softmax(scores, dim=-1).cpu()
+            return torch.multinomial(
+                probs, num_samples=1, generator=self._generator
+            ).squeeze(1)
+        return torch.argmax(scores, dim=-1)
+
+    def _reusable_prefix_length(self, request: GenerationRequest) -> int:
+        if request.prefix_cache is None or not request.prefix_ids:
+            return 0
+        if request.prefix_model_version not in (None, self.model_version):
+            return 0
+
+        reused = 0
+        for cached, new in zip(request.prefix_ids, request.input_ids):
+            if cached != new:
+                break
+            reused += 1
+
+        # At least one new token must be run to produce the next-token logits
+        return min(reused, len(request.input_ids) - 1)
@@ -0,0 +1,363 @@
+import copy
+import threading
+import torch
+
+from collections import deque
+
+from transformers import AutoModelForCausalLM
+
+from utils.logger import Logger, LogLevel
+from utils.nlp.engines import InferenceEngine
+from utils.nlp.enums import Tasks
+from utils.nlp.registry import MODEL_REGISTRY, ModelRegistry
+
+# The "speculative" section of config/model.json, which is not a generation
+# setting
+SPECULATIVE_CONFIG_KEY = "speculative"
+# Verification passes the acceptance rate is measured over before it can trigger
+# a fallback
+SPECULATION_WINDOW = 32
+# Decode steps without speculation after a fallback, before speculating is tried
+# again
+SPECULATION_RETRY_STEPS = 256
+# Every this many steps of a lone request decode one token without speculation,
+# timing the model alone for comparison
+SPECULATION_CONTROL_INTERVAL = 16
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding for the GenerationScheduler: a small draft model
+    proposes the next few tokens of a sequence and the served model checks them
+    all in a single forward pass, keeping the longest prefix it agrees with plus
+    one token of its own. Greedy decoding keeps the draft tokens the model would
+    have picked itself; sampling accepts each with probability min(1, p/q) and
+    otherwise resamples from the leftover distribution, so replies follow the
+    model's own distribution either way. When the acceptance rate over the last
+    SPECULATION_WINDOW passes falls below min_acceptance_rate, decoding falls
+    back to one token per pass for SPECULATION_RETRY_STEPS steps.
+    """
+
+    def __init__(
+        self,
+        draft_model,
+        draft_name: str,
+        draft_tokens: int = 4,
+        min_acceptance_rate: float = 0.5,
+    ):
+        assert draft_tokens > 0, "draft_tokens must be greater than 0."
+
+        self.draft = InferenceEngine(draft_model)
+        self.draft_name = draft_name
+        self.draft_tokens = draft_tokens
+        self.min_acceptance_rate = min_acceptance_rate
+
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=SPECULATION_WINDOW)
+        self._paused_steps = 0
+        self._steps = 0
+        self.passes = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.fallbacks = 0
+        self.speculative_tokens = 0
+        self.speculative_seconds = 0.0
+        self.control_tokens = 0
+        self.control_seconds = 0.0
+
+    @staticmethod
+    def create(
+        model, model_path: str, config: dict | None
+    ) -> "SpeculativeDecoder | None":
+        """
+        The decoder described by the "speculative" section of config/model.json,
+            or None if it is absent or disabled: enabled: Whether to decode
+            speculatively. draft_model: A checkpoint sharing the model's
+            tokenizer, such as "distilgpt2" for "gpt2". When null, the draft is
+            the model's own first draft_layers layers, which share the model's
+            weights and memory. draft_layers: Layers kept in a truncated draft.
+            draft_tokens: Tokens the draft proposes per verification pass.
+            min_acceptance_rate: Fraction of proposed tokens accepted below
+            which speculation is paused.
+        """
+        config = config or {}
+        if not config.get("enabled", False):
+            return None
+
+        try:
+            draft_name = config.get("draft_model")
+            if draft_name:
+                draft_model = MODEL_REGISTRY.get(
+                    ModelRegistry.key(Tasks.TEXT_GENERATION.value, draft_name),
+                    lambda: AutoModelForCausalLM.from_pretrained(
+                        draft_name, use_safetensors=True
+                    ).eval(),
+                    Tasks.TEXT_GENERATION.value,
+                    pinned=True,
+                )
+            else:
+                draft_layers = config.get("draft_layers", 2)
+                draft_name = f"{model_path} (first {draft_layers} layers)"
+                draft_model = SpeculativeDecoder.truncated_copy(
+                    model, draft_layers
+                )
+            draft_model.to(model.device)
+
+            assert draft_model.config.vocab_size == model.config.vocab_size, (
+                f"Draft model {draft_name} has a vocabulary of "
+                f"{draft_model.config.vocab_size} tokens rather than"
+                f" {model.config.vocab_size}."
+            )
+        except Exception as e:
+            Logger.log(
+                LogLevel.ERROR,
+                "Failed to load the draft model, decoding without "
+                f"speculation. {e}",
+            )
+            return None
+
+        Logger.log(
+            LogLevel.AGENT,
+            f"Speculative decoding with draft model {draft_name}.",
+        )
+        return SpeculativeDecoder(
+            draft_model,
+            draft_name,
+            config.get("draft_tokens", 4),
+            config.get("min_acceptance_rate", 0.5),
+        )
+
+    @staticmethod
+    def truncated_copy(model, num_layers: int):
+        """
+        The model with only its first num_layers layers, sharing its weights
+        rather than copying them.
+        """
+        layers = model.config.num_hidden_layers
+        assert (
+            0 < num_layers < layers
+        ), f"draft_layers must be between 1 and {layers - 1}."
+        config = copy.deepcopy(model.config)
+        config.num_hidden_layers = num_layers
+        # Built without allocating weights, then pointed at the model's own
+        # tensors
+        with torch.device("meta"):
+            draft_model = AutoModelForCausalLM.from_config(config)
+        draft_model.load_state_dict(
+            model.state_dict(), strict=False, assign=True
+        )
+        draft_model.tie_weights()
+        return draft_model.eval()
+
+    def should_speculate(self) -> bool:
+        """
+        Called once per decode step of a lone request; False while paused and
+        for control steps.
+        """
+        with self._lock:
+            self._steps += 1
+            if self._paused_steps > 0:
+                self._paused_steps -= 1
+                return False
+            return self._steps % SPECULATION_CONTROL_INTERVAL != 0
+
+    def propose(
+        self,
+        request,
+        sequence: list[int],
+        count: int,
+        probabilities=None,
+        generator: torch.Generator | None = None,
+    ) -> tuple[list[int], list]:
+        """
+        Decodes count draft tokens after sequence, the request's tokens so far,
+        first running the draft over whatever part of sequence it has not seen.
+        Returns the tokens and, when sampling, the distributions they were drawn
+        from.
+        (param probabilities): Turns logits into the sampling distribution; None
+            for greedy decoding.
+        (param generator): The CPU generator tokens are sampled with; torch's
+            global one if None.
+        """
+        device = self.draft.model.device
+        input_ids = torch.tensor(
+            [sequence[request.draft_length :]], device=device
+        )
+        logits, request.draft_cache = self.draft.prefill(
+            input_ids, past=request.draft_cache
+        )
+        request.draft_length = len(sequence)
+
+        tokens, distributions = [], []
+        while True:
+            token, distribution = SpeculativeDecoder.pick(
+                logits[:, -1, :], probabilities, generator
+            )
+            tokens.append(token)
+            distributions.append(distribution)
+            if len(tokens) == count:
+                return tokens, distributions
+            input_ids = torch.tensor([[token]], device=device)
+            logits, request.draft_cache = self.draft.prefill(
+                input_ids, past=request.draft_cache
+            )
+            request.draft_length += 1
+
+    def verify(
+        self,
+        request,
+        sequence_length: int,
+        logits: torch.Tensor,
+        tokens: list[int],
+        distributions: list,
+        probabilities=None,
+        generator: torch.Generator | None = None,
+    ) -> list[int]:
+        """
+        Returns the draft tokens the model accepts followed by one token of the
+        model's own, and forgets the draft's cache past the accepted tokens.
+        (param logits): The model's logits for its last sequence token followed
+            by the draft tokens, shaped (1, len(tokens) + 1, vocabulary).
+        """
+        accepted = []
+        for i, token in enumerate(tokens):
+            if probabilities is None:
+                target = int(logits[0, i].argmax())
+                if target != token:
+                    accepted.append(target)
+                    break
+            else:
+                p, q = (
+                    probabilities(logits[:, i, :])[0].cpu(),
+                    distributions[i][0],
+                )
+                if torch.rand((), generator=generator) >= p[token] / q[token]:
+                    residual = torch.clamp(p - q, min=0)
+                    residual = residual if residual.sum() > 0 else p
+                    accepted.append(
+                        int(
+                            torch.multinomial(
+                                residual / residual.sum(),
+                                1,
+                                generator=generator,
+                            )
+                        )
+                    )
+                    break
+            accepted.append(token)
+        else:
+            accepted.append(
+                SpeculativeDecoder.pick(
+                    logits[:, len(tokens), :], probabilities, generator
+                )[0]
+            )
+
+        matched = len(accepted) - 1
+        request.draft_length = min(
+            request.draft_length, sequence_length + matched
+        )
+        request.draft_cache = SpeculativeDecoder.crop(
+            request.draft_cache, request.draft_length
+        )
+        self.record_pass(len(tokens), matched)
+        return accepted
+
+    def record_pass(self, proposed: int, accepted: int):
+        with self._lock:
+            self.passes += 1
+            self.proposed += proposed
+            self.accepted += accepted
+            self._window.append((proposed, accepted))
+            if len(self._window) < SPECULATION_WINDOW:
+                return
+
+            rate = sum(a for _, a in self._window) / sum(
+                p for p, _ in self._window
+            )
+            if rate < self.min_acceptance_rate:
+                self.fallbacks += 1
+                self._paused_steps = SPECULATION_RETRY_STEPS
+                self._window.clear()
+                Logger.log(
+                    LogLevel.AGENT,
+                    f"Draft acceptance rate fell to {rate:.0%}, below "
+                    f"{self.min_acceptance_rate:.0%}; decoding without"
+                    f" speculation for the next {SPECULATION_RETRY_STEPS} "
+                    "steps.",
+                )
+
+    def record_timing(self, tokens: int, seconds: float, speculative: bool):
+        """
+        Tokens a lone request gained in one decode step, with or without
+        speculation.
+        """
+        with self._lock:
+            if speculative:
+                self.speculative_tokens += tokens
+                self.speculative_seconds += seconds
+            else:
+                self.control_tokens += tokens
+                self.control_seconds += seconds
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            speculative_rate = (
+                self.speculative_tokens / self.speculative_seconds
+                if self.speculative_seconds
+                else None
+            )
+            control_rate = (
+                self.control_tokens / self.control_seconds
+                if self.control_seconds
+                else None
+            )
+            return {
+                "draft_model": self.draft_name,
+                "draft_tokens": self.draft_tokens,
+                "state": "paused" if self._paused_steps > 0 else "speculating",
+                "verification_passes": self.passes,
+                "acceptance_rate": (
+                    round(self.accepted / self.proposed, 4)
+                    if self.proposed
+                    else None
+                ),
+                "tokens_per_pass": (
+                    round((self.accepted + self.passes) / self.passes, 3)
+                    if self.passes
+                    else None
+                ),
+                "fallbacks": self.fallbacks,
+                "speculative_tokens_per_second": (
+                    round(speculative_rate, 2) if speculative_rate else None
+                ),
+                "plain_tokens_per_second": (
+                    round(control_rate, 2) if control_rate else None
+                ),
+                "speedup": (
+                    round(speculative_rate / control_rate, 3)
+                    if speculative_rate and control_rate
+                    else None
+                ),
+            }
+
+    @staticmethod
+    def pick(
+        logits: torch.Tensor,
+        probabilities=None,
+        generator: torch.Generator | None = None,
+    ) -> tuple[int, torch.Tensor | None]:
+        if probabilities is None:
+            return int(logits[0].argmax()), None
+        distribution = probabilities(logits).cpu()
+        return (
+            int(torch.multinomial(distribution[0], 1, generator=generator)),
+            distribution,
+        )
+
+    @staticmethod
+    def crop(cache: tuple | None, length: int) -> tuple | None:
+        if cache is None:
+            return None
+        return tuple(
+            (k[:, :, :length, :], v[:, :, :length, :]) for k, v in cache
+        )
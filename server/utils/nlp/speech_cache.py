@@ -0,0 +1,258 @@
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+from collections import OrderedDict
+
+from services.env import EnvService, EnvVars
+from utils.logger import Logger, LogLevel
+
+TTS_CACHE_DIR = EnvService.get(
+    EnvVars.TTS_CACHE_DIR.value, os.getcwd() + "/.models/tts"
+)
+TTS_CACHE_MEMORY_MB = EnvService.get_int(EnvVars.TTS_CACHE_MEMORY_MB.value, 64)
+TTS_CACHE_DISK_MB = EnvService.get_int(EnvVars.TTS_CACHE_DISK_MB.value, 1024)
+# Bump when synthesis or post-processing changes so stale narration is not
+# reused
+SPEECH_CACHE_VERSION = 1
+
+
+class CachedSpeech:
+    def __init__(
+        self, samples: np.ndarray, sampling_rate: int, synthesis_seconds: float
+    ):
+        self.samples = samples
+        self.sampling_rate = sampling_rate
+        self.synthesis_seconds = synthesis_seconds
+
+
+class SpeechCache:
+    """
+    Narrated sentences, keyed by a hash of everything that determines the audio:
+    the text, the TTS checkpoint and its revision, the voice preset and the
+    sampling seed. Recent entries are kept in memory as float32 samples, least
+    recently used first out once memory_bytes is exceeded, and every entry is
+    also written to disk, where the least recently used files are deleted once
+    disk_bytes is exceeded. Samples are cached before encoding, so one entry
+    serves any codec and loudness.
+    """
+
+    def __init__(
+        self,
+        directory: str = TTS_CACHE_DIR,
+        memory_mb: int = TTS_CACHE_MEMORY_MB,
+        disk_mb: int = TTS_CACHE_DISK_MB,
+    ):
+        """(param disk_mb): 0 keeps entries in memory only."""
+        self.directory = directory
+        self.memory_bytes = max(memory_mb, 0) * 1024 * 1024
+        self.disk_bytes = max(disk_mb, 0) * 1024 * 1024
+
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(
+        text: str,
+        model: str,
+        revision: str,
+        voice_preset: str | None,
+        seed: int,
+    ) -> str:
+        parts = [
+            SPEECH_CACHE_VERSION,
+            model,
+            revision,
+            voice_preset,
+            seed,
+            text.strip(),
+        ]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[
+            :32
+        ]
+
+    def get(self, key: str) -> tuple[np.ndarray, int] | None:
+        """
+        Returns the cached (samples, sampling_rate) for key, or None. The
+        samples are read-only.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self.saved_seconds += entry.synthesis_seconds
+                return entry.samples, entry.sampling_rate
+
+        entry = self._load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.saved_seconds += entry.synthesis_seconds
+            self._remember(key, entry)
+        return entry.samples, entry.sampling_rate
+
+    def put(
+        self,
+        key: str,
+        samples: np.ndarray,
+        sampling_rate: int,
+        synthesis_seconds: float,
+    ):
+        samples = np.array(samples, dtype=np.float32).reshape(-1)
+        samples.flags.writeable = False
+        entry = CachedSpeech(samples, sampling_rate, synthesis_seconds)
+        with self._lock:
+            self._remember(key, entry)
+        self._save(key, entry)
+
+    def to_dict(self) -> dict:
+        disk_used = self._disk_usage() if self.disk_bytes else 0
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_budget_bytes": self.memory_bytes,
+                "disk_bytes": disk_used,
+                "disk_budget_bytes": self.disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    round((self.memory_hits + self.disk_hits) / lookups, 4)
+                    if lookups
+                    else None
+                ),
+                "saved_synthesis_seconds": round(self.saved_seconds, 3),
+            }
+
+    def _remember(self, key: str, entry: CachedSpeech):
+        # Callers hold self._lock
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= previous.samples.nbytes
+        if entry.samples.nbytes > self.memory_bytes:
+            return
+
+        self._memory[key] = entry
+        self._memory_used += entry.samples.nbytes
+        while self._memory_used > self.memory_bytes:
+            _, oldest = self._memory.popitem(last=False)
+            self._memory_used -= oldest.samples.nbytes
+
+    def _load(self, key: str) -> CachedSpeech | None:
+        if not self.disk_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                samples = data["samples"]
+                entry = CachedSpeech(
+                    samples,
+                    int(data["sampling_rate"]),
+                    float(data["synthesis_seconds"]),
+                )
+            samples.flags.writeable = False
+            # The modification time orders eviction, so a hit marks the file
+            # recently used
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            Logger.log(
+                LogLevel.ERROR,
+                f"Discarding unreadable cached narration {key}, {e}",
+            )
+            self._remove(path)
+            return None
+
+    def _save(self, key: str, entry: CachedSpeech):
+        """
+        Writes to a temporary file first so an interrupted write never leaves a
+        partial entry behind.
+        """
+        if not self.disk_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    samples=entry.samples,
+                    sampling_rate=entry.sampling_rate,
+                    synthesis_seconds=entry.synthesis_seconds,
+                )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            Logger.log(
+                LogLevel.ERROR, f"Failed to cache narration {key} to disk, {e}"
+            )
+            self._remove(tmp_path)
+            return
+
+        written = os.path.getsize(path)
+        with self._disk_lock:
+            # A first scan already counts the file just written
+            if self._disk_used is None:
+                self._disk_used = sum(size for _, _, size in self._scan())
+            else:
+                self._disk_used += written
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk()
+
+    def _disk_usage(self) -> int:
+        with self._disk_lock:
+            if self._disk_used is None:
+                self._disk_used = sum(size for _, _, size in self._scan())
+            return self._disk_used
+
+    def _evict_disk(self):
+        # Callers hold self._disk_lock. Rescanning also corrects for files
+        # written or deleted by other processes.
+        files = sorted(self._scan())
+        self._disk_used = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self._disk_used <= self.disk_bytes:
+                break
+            if self._remove(path):
+                self._disk_used -= size
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        """(modification time, path, size) of every entry on disk."""
+        files = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".npz"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.path, stat.st_size))
+        except FileNotFoundError:
+            pass
+        return files
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
@@ -0,0 +1,76 @@
+import queue
+import threading
+import time
+
+_ITEM, _ERROR, _END = range(3)
+
+
+class Stage:
+    """
+    One stage of a pipeline: iterates source on its own worker thread and hands
+    each item to the consumer through a bounded queue, so the stage runs ahead
+    of whatever consumes it by at most maxsize items.
+    Stages chain by using one stage as another's source. An exception raised by
+    the source is re-raised to the consumer, and closing the consumer's
+    iteration early stops the worker and closes the source.
+    """
+
+    def __init__(self, source, name: str, maxsize: int = 1):
+        self.name = name
+        # The source generator's return value, once it is exhausted
+        self.result = None
+        # perf_counter() times at which the source produced its first item and
+        # finished
+        self.first_item_at = None
+        self.finished_at = None
+
+        self._items = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(
+            target=self._run, args=(source,), name=name, daemon=True
+        )
+        self._worker.start()
+
+    def __iter__(self):
+        try:
+            while True:
+                kind, value = self._items.get()
+                if kind == _ERROR:
+                    raise value
+                if kind == _END:
+                    return
+                yield value
+        finally:
+            self.close()
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self, source):
+        source = iter(source)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    item = next(source)
+                except StopIteration as end:
+                    self.result = end.value
+                    break
+                if self.first_item_at is None:
+                    self.first_item_at = time.perf_counter()
+                self._put(_ITEM, item)
+        except Exception as e:
+            self._put(_ERROR, e)
+        finally:
+            self.finished_at = time.perf_counter()
+            if hasattr(source, "close"):
+                source.close()
+            self._put(_END, None)
+
+    def _put(self, kind: int, value):
+        # Poll so that a consumer which stops reading also releases the worker
+        while not self._stopped.is_set():
+            try:
+                self._items.put((kind, value), timeout=0.1)
+                return
+            except queue.Full:
+                continue
@@ -1,112 +1,450 @@
-import base64
-import io
 import numpy as np
-import scipy
+import os
+import re
+import time
 import torch
 
-from transformers import (
-    AutoModelForSpeechSeq2Seq,
-    AutoTokenizer,
-    pipeline,
-)
+from transformers import pipeline
 
+from services.audio import AUDIO_SAMPLE_RATE, AudioCodec, AudioService
+from services.env import EnvService, EnvVars
+from utils.nlp.batching import MicroBatcher
+from utils.nlp.precision import SPEECH_PRECISION, ModelPrecision
 from utils.nlp.enums import Models, Tasks
+from utils.nlp.registry import MODEL_REGISTRY, ModelRegistry
+from utils.nlp.speech_cache import SpeechCache
+from utils.nlp.stages import Stage
 from utils.logger import Logger, LogLevel
+from utils.metrics import STAGE_SECONDS, ServingStages
 
+ASR_MAX_BATCH_SIZE = EnvService.get_int(EnvVars.ASR_MAX_BATCH_SIZE.value, 8)
+ASR_MAX_WAIT_MS = EnvService.get_int(EnvVars.ASR_MAX_WAIT_MS.value, 10)
+TTS_MAX_BATCH_SIZE = EnvService.get_int(EnvVars.TTS_MAX_BATCH_SIZE.value, 4)
+TTS_MAX_WAIT_MS = EnvService.get_int(EnvVars.TTS_MAX_WAIT_MS.value, 10)
+# Seeds Bark's sampling so the same text narrates the same way, which lets
+# narration be cached; -1 (the default) samples freely and disables the cache
+TTS_SEED = EnvService.get_int(EnvVars.TTS_SEED.value, -1)
+# A Bark speaker such as "v2/en_speaker_6"; empty for Bark's default of a random
+# speaker per generation
+TTS_VOICE_PRESET = EnvService.get(EnvVars.TTS_VOICE_PRESET.value, "") or None
+
+# Sentences shorter than this are merged into the one before, since every Bark
+# call carries a fixed overhead
+TTS_MIN_SENTENCE_CHARS = 24
+# Bark generates roughly 13 seconds of speech per call, so longer sentences are
+# split at clause or word boundaries
+TTS_MAX_SENTENCE_CHARS = 220
+# Sentences synthesized ahead of the one being sent
+TTS_PIPELINE_DEPTH = 1
+ASR_SECONDS = STAGE_SECONDS.labels(ServingStages.ASR.value)
+TTS_SECONDS = STAGE_SECONDS.labels(ServingStages.TTS.value)
+AUDIO_ENCODE_SECONDS = STAGE_SECONDS.labels(ServingStages.AUDIO_ENCODE.value)
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n+")
+_CLAUSE_END = re.compile(r"(?<=[,)])\s+")
+
+
+class SentenceSplitter:
+    """
+    Incremental Synthesizer.split_sentences for text that arrives in pieces,
+    such as a reply as it is decoded. A sentence is only released once the text
+    after it has started, and later sentences shorter than
+    TTS_MIN_SENTENCE_CHARS are held back to be merged with the next one.
+    """
 
-class Synthesizer:
     def __init__(self):
-        self.stt_model = None
-        self.stt_pipeline = None
+        self._buffer = ""
+        self._released = 0
+
+    def push(self, text: str) -> list[str]:
+        """Adds text and returns the sentences it completes."""
+        self._buffer += text
+        boundaries = list(_SENTENCE_END.finditer(self._buffer))
+        if boundaries:
+            cut = boundaries[-1].end()
+        elif len(self._buffer) > TTS_MAX_SENTENCE_CHARS:
+            # An overlong sentence is released in pieces, cut at word boundaries
+            cut = self._buffer.rfind(" ") + 1
+        else:
+            return []
+
+        sentences = Synthesizer.split_sentences(self._buffer[:cut])
+        self._buffer = self._buffer[cut:]
+        if (
+            sentences
+            and self._released + len(sentences) > 1
+            and len(sentences[-1]) < TTS_MIN_SENTENCE_CHARS
+        ):
+            self._buffer = sentences.pop() + " " + self._buffer
+        self._released += len(sentences)
+        return sentences
+
+    def flush(self) -> list[str]:
+        """Returns whatever text is left over as the final sentences."""
+        sentences = Synthesizer.split_sentences(self._buffer)
+        self._buffer = ""
+        self._released += len(sentences)
+        return sentences
 
-        self.tts_pipeline = None
-        self.tts_tokenizer = None
+    def sentences(self, pieces):
+        """
+        Yields the sentences of an iterable of text pieces as they complete, and
+        returns that iterable's result.
+        """
+        pieces = iter(pieces)
+        while True:
+            try:
+                piece = next(pieces)
+            except StopIteration as end:
+                result = end.value
+                break
+            yield from self.push(piece)
+        yield from self.flush()
+        return result
+
+
+class Synthesizer:
+    def __init__(
+        self,
+        stt_model_name: str = Models.WHISPER_LARGE_V3_TURBO.value,
+        tts_model_name: str = Models.SUNO_BARK.value,
+        cache_speech: bool = True,
+    ):
+        """
+        (param cache_speech): Serve repeated narration from the speech cache,
+            see Synthesizer.synthesize.
+        """
+        # Both pipelines are loaded through the model registry on first use, and
+        # may be evicted when idle. Requests and transcription streams share
+        # them, and they are only driven from their batcher threads.
+        self.stt_model_name = stt_model_name
+        self.stt_batcher = MicroBatcher(
+            self.transcribe_batch,
+            "asr-batcher",
+            ASR_MAX_BATCH_SIZE,
+            ASR_MAX_WAIT_MS,
+        )
+
+        self.tts_model_name = tts_model_name
+        self.tts_batcher = MicroBatcher(
+            self.synthesize_batch,
+            "tts-batcher",
+            TTS_MAX_BATCH_SIZE,
+            TTS_MAX_WAIT_MS,
+        )
+        self.tts_model_revision = None
+        self.speech_cache = SpeechCache() if cache_speech else None
 
     def transcribe_audio(self, data):
         """
         Wrapper for the stt_pipeline
         Allows for other classes to use the same pipeline across all instances
-        (param) data: The audio data to be transcribed
+        (param) data: The audio data to be transcribed, float32 mono at
+            AUDIO_SAMPLE_RATE as from AudioService.load_audio
         """
-        if self.stt_pipeline is None:
-            self.init_stt_pipeline()
-
-        if isinstance(data, tuple):
-            # Extract the audio data from the tuple or process accordingly
-            audio_data = np.array(data[0] if data else [], dtype=np.float32).flatten()
-        else:
-            audio_data = np.array(data, dtype=np.float32).flatten()
+        # Views rather than copies when the samples are already float32
+        audio_data = np.asarray(data, dtype=np.float32).reshape(-1)
+        # Transcribed together with any other recordings submitted at the same
+        # moment
+        with ASR_SECONDS.time():
+            return self.stt_batcher(
+                {"raw": audio_data, "sampling_rate": AUDIO_SAMPLE_RATE}
+            )
 
-        return self.stt_pipeline(audio_data)
+    def transcribe_batch(self, inputs: list[dict]) -> list[dict]:
+        """
+        Runs Whisper over several recordings in one forward pass, returning
+        their transcriptions in order.
+        """
+        stt_pipeline = self.get_stt_pipeline()
+        if len(inputs) == 1:
+            return [stt_pipeline(inputs[0])]
+        return stt_pipeline(inputs, batch_size=len(inputs))
 
-    def generate_audio(self, transcript):
+    def generate_audio(
+        self, transcript, codec: AudioCodec = AudioCodec.WAV
+    ) -> bytes:
         Logger.log(LogLevel.SYNTHESIZER, f"Generating audio response...")
 
-        if self.tts_pipeline is None:
-            self.init_tts_pipeline()
+        audio_data, sampling_rate = self.synthesize(transcript)
+        encoded = Synthesizer.encode_audio(
+            audio_data, sampling_rate, codec=codec
+        )
+
+        Logger.log(LogLevel.SYNTHESIZER, f"Audio response generated.")
+        return encoded
+
+    def stream_audio(self, transcript, codec: AudioCodec = AudioCodec.WAV):
+        """
+        Yields the narration of transcript one sentence at a time, each as a
+        standalone audio file.
+        The next sentence is synthesized on a background thread while the
+        current one is being sent, so the first audio is ready after one
+        sentence rather than after the whole reply.
+        (param transcript): The text to narrate, or an iterable of sentences
+            such as a SentenceSplitter.sentences stream.
+        """
+        if isinstance(transcript, str) or transcript is None:
+            transcript = Synthesizer.split_sentences(transcript)
+            if not transcript:
+                return
+            Logger.log(
+                LogLevel.SYNTHESIZER,
+                f"Streaming audio response in {len(transcript)} chunks...",
+            )
+
+        # Every chunk gets the first one's gain, so sentences keep a consistent
+        # loudness
+        peak = None
+        for audio_data, sampling_rate in self.synthesize_stream(transcript):
+            if peak is None:
+                peak = (
+                    float(np.max(np.abs(audio_data)))
+                    if len(audio_data)
+                    else None
+                )
+            yield Synthesizer.encode_audio(
+                audio_data, sampling_rate, peak, codec
+            )
 
-        # Generate audio using the pipeline
-        audio_raw = self.tts_pipeline(
-            transcript, forward_params={"do_sample": True}
+        Logger.log(LogLevel.SYNTHESIZER, f"Audio response streamed.")
+
+    def synthesize_stream(self, sentences):
+        """
+        Yields (samples, sampling_rate) for each of sentences, synthesizing up
+        to TTS_PIPELINE_DEPTH sentences ahead of the consumer on a background
+        thread. Synthesis stops if the consumer stops iterating.
+        """
+        return iter(
+            Stage(
+                (self.synthesize(s) for s in sentences),
+                "tts-pipeline",
+                TTS_PIPELINE_DEPTH,
+            )
         )
 
-        # Convert the generated audio to a numpy array
-        audio_data = np.array(audio_raw["audio"], dtype=np.float32).flatten()
+    def synthesize(self, text: str) -> tuple[np.ndarray, int]:
+        """
+        Runs Bark over text, returning float32 mono samples and their sample
+        rate. Texts submitted at the same moment, e.g. by several narrated
+        replies, are synthesized together. With a fixed TTS_SEED, text narrated
+        before is served from the speech cache instead; its samples are
+        read-only. Text that will be cached is synthesized on its own, since a
+        batch's audio depends on the texts sharing it.
+        """
+        requested_at = time.perf_counter()
+        key = self.get_speech_cache_key(text)
+        if key is not None:
+            cached = self.speech_cache.get(key)
+            if cached is not None:
+                TTS_SECONDS.observe(time.perf_counter() - requested_at)
+                return cached
 
-        # Normalize audio data to the range of int16
-        wav = np.int16(audio_data / np.max(np.abs(audio_data)) * 32767)
+        start = time.perf_counter()
+        audio_data, sampling_rate = self.tts_batcher((text, key is not None))
+        if key is not None:
+            self.speech_cache.put(
+                key, audio_data, sampling_rate, time.perf_counter() - start
+            )
+        TTS_SECONDS.observe(time.perf_counter() - requested_at)
+        return audio_data, sampling_rate
 
-        # Store audio data to a buffer
-        audio_buffer = io.BytesIO()
-        scipy.io.wavfile.write(
-            audio_buffer, rate=audio_raw["sampling_rate"], data=wav
+    def get_speech_cache_key(self, text: str) -> str | None:
+        """
+        None when narration of text cannot be cached: sampling is unseeded, or
+        the checkpoint's revision is unknown.
+        """
+        if self.speech_cache is None or TTS_SEED < 0:
+            return None
+        if self.tts_model_revision is None:
+            self.tts_model_revision = ModelRegistry.model_revision(
+                self.tts_model_name
+            )
+            if self.tts_model_revision is None:
+                return None
+        # Reduced precision changes the audio as much as a new revision would
+        revision = f"{self.tts_model_revision}:{SPEECH_PRECISION.value}"
+        return SpeechCache.key(
+            text, self.tts_model_name, revision, TTS_VOICE_PRESET, TTS_SEED
         )
 
-        # Encode the audio buffer to base64
-        audio_buffer.seek(0)
-        Logger.log(LogLevel.SYNTHESIZER, f"Audio response generated.")
-        return base64.b64encode(audio_buffer.read()).decode("utf-8")
+    def synthesize_batch(
+        self, items: list[tuple[str, bool]]
+    ) -> list[tuple[np.ndarray, int]]:
+        """
+        Runs Bark over several texts, returning (samples, sample rate) for each
+        in order.
+        (param items): (text, cacheable) pairs. Texts whose audio will be cached
+            are generated one at a time, each from a freshly seeded generator,
+            so their audio depends only on the text; the rest share one
+            generation.
+        """
+        results = [None] * len(items)
+        batched = []
+        for i, (text, cacheable) in enumerate(items):
+            if cacheable:
+                results[i] = self.generate_speech([text])[0]
+            else:
+                batched.append(i)
+        if batched:
+            for i, result in zip(
+                batched, self.generate_speech([items[i][0] for i in batched])
+            ):
+                results[i] = result
+        return results
 
-    def init_stt_pipeline(self):
-        try:
-            Logger.log(LogLevel.SYNTHESIZER, "Initializing STT model...")
-            self.stt_model = AutoModelForSpeechSeq2Seq.from_pretrained(
-                Models.WHISPER_LARGE_V3_TURBO.value
+    def generate_speech(self, texts: list[str]) -> list[tuple[np.ndarray, int]]:
+        """
+        Runs Bark over texts in one generation, returning (samples, sample rate)
+        for each in order.
+        """
+        tts_pipeline = self.get_tts_pipeline()
+        preprocess_params = (
+            {"voice_preset": TTS_VOICE_PRESET} if TTS_VOICE_PRESET else {}
+        )
+        if TTS_SEED >= 0:
+            # Bark takes no generator of its own, so this seeds torch's global
+            # one; the generation scheduler samples from a private generator and
+            # is unaffected
+            torch.manual_seed(TTS_SEED)
+
+        if len(texts) == 1:
+            # Generate audio using the pipeline
+            audio_raw = tts_pipeline(
+                texts[0],
+                preprocess_params=preprocess_params,
+                forward_params={"do_sample": True},
             )
-            Logger.log(
-                LogLevel.SYNTHESIZER, "STT model initialized successfully."
+            # Convert the generated audio to a numpy array
+            audio_data = np.asarray(
+                audio_raw["audio"], dtype=np.float32
+            ).reshape(-1)
+            return [(audio_data, audio_raw["sampling_rate"])]
+
+        # The pipeline would return every waveform padded to the longest, so
+        # generate directly and trim each to its length
+        model = tts_pipeline.model
+        inputs = tts_pipeline.preprocess(texts, **preprocess_params).to(
+            model.device
+        )
+        with torch.inference_mode():
+            waveforms, lengths = model.generate(
+                **inputs, do_sample=True, return_output_lengths=True
+            )
+
+        sampling_rate = tts_pipeline.sampling_rate
+        return [
+            (
+                waveform[:length].to(device="cpu", dtype=torch.float32).numpy(),
+                sampling_rate,
             )
+            for waveform, length in zip(waveforms, lengths)
+        ]
+
+    @staticmethod
+    def encode_audio(
+        audio_data: np.ndarray,
+        sampling_rate: int,
+        peak: float | None = None,
+        codec: AudioCodec = AudioCodec.WAV,
+    ) -> bytes:
+        """
+        Encodes samples as a 16-bit audio file, normalized so that peak (by
+        default the loudest sample) is full scale.
+        (param peak): Reference level to normalize by; louder samples are
+            limited to full scale rather than wrapped.
+        """
+        with AUDIO_ENCODE_SECONDS.time():
+            if peak is None and len(audio_data):
+                peak = float(np.max(np.abs(audio_data)))
+            scale = 32767 / peak if peak else 0.0
+
+            # Normalize audio data to the range of int16
+            samples = np.int16(np.clip(audio_data * scale, -32767, 32767))
+            return AudioService.encode(samples, sampling_rate, codec)
+
+    @staticmethod
+    def split_sentences(text: str | None) -> list[str]:
+        """
+        Splits text into sentence-sized pieces to synthesize one at a time.
+        """
+        pieces = []
+        for sentence in _SENTENCE_END.split(text or ""):
+            sentence = sentence.strip()
+            while len(sentence) > TTS_MAX_SENTENCE_CHARS:
+                # Break overlong sentences at the last clause boundary, or
+                # failing that the last space, that fits
+                head = sentence[:TTS_MAX_SENTENCE_CHARS]
+                clauses = [m.end() for m in _CLAUSE_END.finditer(head)]
+                cut = (
+                    clauses[-1]
+                    if clauses
+                    else head.rfind(" ") + 1 or TTS_MAX_SENTENCE_CHARS
+                )
+                pieces.append(sentence[:cut].strip())
+                sentence = sentence[cut:].strip()
+            if sentence:
+                pieces.append(sentence)
+
+        # Only later pieces are merged, keeping the first one short so narration
+        # starts as soon as possible
+        sentences = []
+        for piece in pieces:
+            if (
+                sentences
+                and len(piece) < TTS_MIN_SENTENCE_CHARS
+                and len(sentences[-1]) + len(piece) < TTS_MAX_SENTENCE_CHARS
+            ):
+                sentences[-1] += " " + piece
+            else:
+                sentences.append(piece)
+        return sentences
 
+    def get_stt_pipeline(self):
+        return MODEL_REGISTRY.get(
+            ModelRegistry.key(Tasks.ASR.value, self.stt_model_name),
+            self.load_stt_pipeline,
+            Tasks.ASR.value,
+        )
+
+    def get_tts_pipeline(self):
+        return MODEL_REGISTRY.get(
+            ModelRegistry.key(Tasks.TTS.value, self.tts_model_name),
+            self.load_tts_pipeline,
+            Tasks.TTS.value,
+        )
+
+    def load_stt_pipeline(self):
+        try:
+            # The pipeline loads the model itself, so it is only read from disk
+            # once
             Logger.log(LogLevel.SYNTHESIZER, "Loading STT pipeline...")
-            self.stt_pipeline = pipeline(
+            stt_pipeline = pipeline(
                 Tasks.ASR.value,
-                Models.WHISPER_LARGE_V3_TURBO.value,
-                torch_dtype=torch.float32,
+                self.stt_model_name,
+                torch_dtype=ModelPrecision.load_dtype(SPEECH_PRECISION),
             )
+            ModelPrecision.apply(stt_pipeline.model, SPEECH_PRECISION)
             Logger.log(
                 LogLevel.SYNTHESIZER, "STT pipeline loaded successfully."
             )
+            return stt_pipeline
         except Exception as e:
             Logger.log(LogLevel.ERROR, "STT pipeline failed to initialize.")
             raise ValueError("STT pipeline failed to initialize.")
 
-    def init_tts_pipeline(self):
+    def load_tts_pipeline(self):
         try:
             Logger.log(LogLevel.SYNTHESIZER, "Loading TTS pipeline...")
-            self.tts_pipeline = pipeline(
-                Tasks.TTS.value, Models.SUNO_BARK.value
+            tts_pipeline = pipeline(
+                Tasks.TTS.value,
+                self.tts_model_name,
+                torch_dtype=ModelPrecision.load_dtype(SPEECH_PRECISION),
             )
+            ModelPrecision.apply(tts_pipeline.model, SPEECH_PRECISION)
             Logger.log(
                 LogLevel.SYNTHESIZER, "TTS pipeline loaded successfully."
             )
-
-            Logger.log(LogLevel.SYNTHESIZER, "Loading tokenizer...")
-            self.tts_tokenizer = AutoTokenizer.from_pretrained(
-                Models.WHISPER_LARGE_V3_TURBO.value, use_fast=True
-            )
-            Logger.log(
-                LogLevel.SYNTHESIZER, "TTS tokenizer loaded successfully."
-            )
+            return tts_pipeline
         except Exception as e:
             Logger.log(LogLevel.ERROR, "TTS pipeline failed to initialize.")
             raise ValueError("TTS pipeline failed to initialize.")
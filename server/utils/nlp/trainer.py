@@ -1,34 +1,87 @@
-import json
 import os
 import time
+import torch
+import zlib
 
 from services.env import EnvService, EnvVars
 from utils.logger import Logger, LogLevel
+from utils.nlp.checkpoints import CheckpointManifest
+from utils.nlp.dataset_cache import DatasetCache
 from utils.nlp.enums import Models
+from utils.nlp.formatter import PatternFormatter
+from utils.nlp.packing import SequencePacker
 
-from datasets import load_dataset, concatenate_datasets
+from datasets import (
+    DatasetDict,
+    load_dataset,
+    concatenate_datasets,
+    interleave_datasets,
+)
 from enum import Enum
-from transformers import Trainer as T, TrainingArguments
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DataCollatorForLanguageModeling,
+    Trainer as T,
+    TrainingArguments,
+    default_data_collator,
+)
 
-MAX_NEW_TOKENS = EnvService.get_int(EnvVars.MAX_NEW_TOKENS.value)
+DATASET_FORMAT_BATCH_SIZE = 10000
+DATASET_NUM_PROC = EnvService.get_int(
+    EnvVars.DATASET_NUM_PROC.value, os.cpu_count() or 1
+)
+# Below this many rows the cost of starting worker processes outweighs the
+# formatting itself
+DATASET_NUM_PROC_MIN_ROWS = 50000
 MODEL = EnvService.get(EnvVars.DEFAULT_MODEL.value, Models.GPT2.value)
-NUM_TRAINING_EPOCHS = EnvService.get_int(EnvVars.TRAINING_ARGS_NUM_EPOCHS.value, 1)
-PRETRAINED_MODEL_DIR = EnvService.get(EnvVars.PRETRAINED_MODEL_DIR.value, "../.models/pretrained")
-
-training_args = TrainingArguments(
-    per_device_train_batch_size=4,
-    per_device_eval_batch_size=4,
-    num_train_epochs=NUM_TRAINING_EPOCHS,
-    eval_strategy="epoch",
-    save_strategy="epoch",
-    save_total_limit=2,
-    prediction_loss_only=True,
-    push_to_hub=False,
+NUM_TRAINING_EPOCHS = EnvService.get_int(
+    EnvVars.TRAINING_ARGS_NUM_EPOCHS.value, 1
+)
+PRETRAINED_MODEL_DIR = EnvService.get(
+    EnvVars.PRETRAINED_MODEL_DIR.value, "../.models/pretrained"
 )
+TRAINING_MAX_LENGTH = EnvService.get_int(
+    EnvVars.TRAINING_MAX_LENGTH.value, 1024
+)
+# -1 trains for NUM_TRAINING_EPOCHS instead; streamed datasets have no length,
+# so they always need a step count
+TRAINING_MAX_STEPS = EnvService.get_int(EnvVars.TRAINING_MAX_STEPS.value, -1)
+# Multiple of 8 padded lengths map onto tensor cores on GPUs
+TRAINING_PAD_TO_MULTIPLE_OF = 8
+
+# Share of examples held out for evaluation, chosen by a hash of their text, so
+# an example lands on the same side of the split whether its dataset is prepared
+# or streamed, and the precision guard only measures held-out examples
+EVAL_PERCENT = 10
+STREAMING_EVAL_MAX_EXAMPLES = 1000
+STREAMING_SHUFFLE_BUFFER_SIZE = 10000
+SPLIT_SEED = 67
+
+
+class TrainingDataMode(Enum):
+    # Examples are concatenated into fixed TRAINING_MAX_LENGTH blocks with
+    # per-example attention boundaries
+    PACKED = "packed"
+    # Examples are padded to the longest in their batch, and batches are drawn
+    # from examples of similar length
+    DYNAMIC = "dynamic"
+    # Every example is padded to TRAINING_MAX_LENGTH
+    PADDED = "padded"
 
 
 class TrainingRequestOpts(Enum):
+    HOT_SWAP = "hot_swap"
+    MAX_STEPS = "max_steps"
     RESUME_FROM_CHECKPOINT = "resume_from_checkpoint"
+    STREAMING = "streaming"
+
+
+TRAINING_DATA_MODE = TrainingDataMode(
+    EnvService.get(
+        EnvVars.TRAINING_DATA_MODE.value, TrainingDataMode.PACKED.value
+    ).lower()
+)
 
 
 class Trainer:
@@ -37,22 +90,61 @@ class Trainer:
         self.tokenizer = tokenizer
         self.trainer = None
 
-    def init_trainer(self):
-        training_args.output_dir = (
-            PRETRAINED_MODEL_DIR + "/results/" + MODEL + "/" + str(time.time())
+    def init_trainer(
+        self,
+        callbacks: list | None = None,
+        streaming: bool | None = None,
+        max_steps: int | None = None,
+    ):
+        """
+        (param streaming): Stream the datasets rather than preparing them up
+            front. When None, the run streams if any active datasets.json entry
+            sets "streaming": true.
+        (param max_steps): Number of optimizer steps to train for, overriding
+            TRAINING_MAX_STEPS.
+        """
+        training_args = Trainer.training_arguments(
+            PRETRAINED_MODEL_DIR + "/results/" + MODEL + "/" + str(time.time()),
+            max_steps or TRAINING_MAX_STEPS,
         )
-        training_args.logging_dir = "/logs"
 
         dataset_configs = Trainer.load_dataset_configs()
-        dataset = Trainer.combine_datasets(dataset_configs)
-        tokenized_dataset = Trainer.tokenize_dataset(dataset, self.tokenizer)
+        if Trainer.is_streaming(dataset_configs, streaming):
+            if training_args.max_steps <= 0:
+                raise ValueError(
+                    "Streaming training requires max_steps or "
+                    "TRAINING_MAX_STEPS to be set."
+                )
+            tokenized_dataset = Trainer.stream_datasets(
+                dataset_configs, self.tokenizer
+            )
+
+            # Streams have no epochs, so evaluate and checkpoint as often as an
+            # epoch-based run would
+            interval = max(1, training_args.max_steps // NUM_TRAINING_EPOCHS)
+            training_args.eval_strategy = training_args.save_strategy = "steps"
+            training_args.eval_steps = training_args.save_steps = interval
+        else:
+            tokenized_dataset = Trainer.prepare_datasets(
+                dataset_configs, self.tokenizer
+            )
+
+        Trainer.configure_sampling(training_args, TRAINING_DATA_MODE)
+        if TRAINING_DATA_MODE == TrainingDataMode.PACKED:
+            # transformers only derives per-example attention boundaries from
+            # position_ids when no KV cache is built
+            self.model.config.use_cache = False
 
         try:
             self.trainer = T(
                 model=self.model,
                 args=training_args,
+                data_collator=Trainer.data_collator(
+                    self.tokenizer, TRAINING_DATA_MODE
+                ),
                 train_dataset=tokenized_dataset["train"],
                 eval_dataset=tokenized_dataset["test"],
+                callbacks=callbacks,
             )
             Logger.log(LogLevel.INFO, "Trainer initialized successfully.")
         except Exception as e:
@@ -60,108 +152,372 @@ class Trainer:
                 LogLevel.ERROR,
                 f"Failed to initialize Trainer: {e}",
             )
-
-    def handle_training_start(self, request):
-        opts = Trainer.parse_request_options(request)
-        try:
-            self.init_trainer()
-            self.trainer.train(
-                resume_from_checkpoint=opts.get(
-                    TrainingRequestOpts.RESUME_FROM_CHECKPOINT
-                )
-            )
-            self.handle_training_end()
-        except Exception as e:
-            Logger.log(
-                LogLevel.ERROR,
-                f"Error during training: {e}",
-            )
+            # Raised so the training job fails with the real cause rather than
+            # on trainer being None later
+            raise
 
     def handle_training_end(self):
+        """Saves the trained model and returns the directory it was saved to."""
         if self.trainer is not None:
             try:
                 Logger.log(LogLevel.INFO, "Saving model...")
+                self.model.config.use_cache = True
                 self.trainer.save_model()
                 Logger.log(LogLevel.INFO, "Model saved successfully.")
 
+                output_dir = self.trainer.args.output_dir
+                CheckpointManifest(
+                    PRETRAINED_MODEL_DIR + "/results/" + MODEL
+                ).register(output_dir)
                 del self.trainer
+                self.trainer = None
+                return output_dir
             except Exception as e:
                 Logger.log(LogLevel.ERROR, f"Error saving model: {e}")
+                raise
 
         else:
             err_msg = "Trainer is not initialized, cannot save model."
             Logger.log(LogLevel.ERROR, err_msg)
+            raise ValueError(err_msg)
 
     @staticmethod
-    def tokenize_dataset(dataset, t):
+    def training_arguments(
+        output_dir: str, max_steps: int
+    ) -> TrainingArguments:
+        """
+        Built per run rather than at import, so importing this module builds
+        nothing and runs never share changes.
         """
-        (param dataset): The corpus of data to be tokenized returned from combine_datasets().
+        training_args = TrainingArguments(
+            output_dir=output_dir,
+            per_device_train_batch_size=4,
+            per_device_eval_batch_size=4,
+            num_train_epochs=NUM_TRAINING_EPOCHS,
+            max_steps=max_steps,
+            eval_strategy="epoch",
+            save_strategy="epoch",
+            save_total_limit=2,
+            prediction_loss_only=True,
+            push_to_hub=False,
+        )
+        training_args.logging_dir = "/logs"
+        return training_args
+
+    @staticmethod
+    def load_providers():
+        """
+        Loads a fresh copy of the most recently trained model (or the default
+        model) and its tokenizer to train. Training jobs never touch the
+        instance the agent is serving from.
+        """
+        from utils.nlp.agent import Agent
+
+        path = Agent.load_most_recently_trained_model(
+            PRETRAINED_MODEL_DIR + "/results/" + MODEL
+        )
+        Logger.log(
+            LogLevel.TRAINER, f"Loading model for training: {path or MODEL}"
+        )
+
+        model = AutoModelForCausalLM.from_pretrained(
+            path or MODEL, use_safetensors=True, torch_dtype=torch.float32
+        )
+        tokenizer = AutoTokenizer.from_pretrained(MODEL)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+            model.config.pad_token_id = model.config.eos_token_id
+        return model, tokenizer
+
+    @staticmethod
+    def tokenize_dataset(
+        dataset, t, mode: TrainingDataMode = TRAINING_DATA_MODE
+    ):
+        """
+        (param dataset): The corpus of data to be tokenized returned from
+            combine_datasets().
         (param t): The tokenizer generated by AutoTokenizer.from_pretrained().
+        (param mode): How examples are laid out in training sequences, see
+            TrainingDataMode.
         """
+        max_length = Trainer.training_max_length(t)
 
         def tokenize_function(examples):
-            # Tokenize the text, pad to max_length, and truncate if necessary
-            tokenized = t(
-                examples["text"],
-                padding="max_length",
-                truncation=True,
-                max_length=MAX_NEW_TOKENS,
-            )
-            # For language modeling, the labels are the input_ids themselves
-            tokenized["labels"] = tokenized["input_ids"].copy()
+            if mode == TrainingDataMode.PADDED:
+                # Tokenize the text, pad to max_length, and truncate if
+                # necessary
+                tokenized = t(
+                    examples["text"],
+                    padding="max_length",
+                    truncation=True,
+                    max_length=max_length,
+                )
+                # For language modeling, the labels are the input_ids themselves
+                tokenized["labels"] = tokenized["input_ids"].copy()
+                return tokenized
+
+            if mode == TrainingDataMode.DYNAMIC:
+                # Padding and labels are added per batch by the data collator
+                return t(
+                    examples["text"], truncation=True, max_length=max_length
+                )
+
+            # Packed examples are split across blocks rather than truncated
+            return {"input_ids": t(examples["text"])["input_ids"]}
+
+        # Column names are spelled out because streamed datasets may not know
+        # theirs
+        tokenized = dataset.map(
+            tokenize_function, batched=True, remove_columns=["text"]
+        )
+        if mode != TrainingDataMode.PACKED:
             return tokenized
 
-        return dataset.map(tokenize_function, batched=True)
+        packer = SequencePacker(max_length, t.eos_token_id, t.pad_token_id)
+        return tokenized.map(
+            packer,
+            batched=True,
+            batch_size=DATASET_FORMAT_BATCH_SIZE,
+            remove_columns=["input_ids"],
+        )
+
+    @staticmethod
+    def training_max_length(t) -> int:
+        """
+        TRAINING_MAX_LENGTH, capped at the longest sequence the model accepts.
+        """
+        return min(
+            TRAINING_MAX_LENGTH, t.model_max_length or TRAINING_MAX_LENGTH
+        )
+
+    @staticmethod
+    def data_collator(t, mode: TrainingDataMode = TRAINING_DATA_MODE):
+        if mode == TrainingDataMode.DYNAMIC:
+            return DataCollatorForLanguageModeling(
+                t, mlm=False, pad_to_multiple_of=TRAINING_PAD_TO_MULTIPLE_OF
+            )
+        # Packed and padded examples already have a fixed length and their
+        # labels
+        return default_data_collator
+
+    @staticmethod
+    def configure_sampling(
+        args: TrainingArguments, mode: TrainingDataMode = TRAINING_DATA_MODE
+    ):
+        """
+        Groups examples of similar length into the same batch in dynamic mode,
+        so little padding is needed.
+        """
+        group_by_length = mode == TrainingDataMode.DYNAMIC
+        if hasattr(args, "train_sampling_strategy"):
+            args.train_sampling_strategy = (
+                "group_by_length" if group_by_length else "random"
+            )
+        else:
+            args.group_by_length = group_by_length
 
     @staticmethod
     def combine_datasets(configs):
-        all_datasets = []
-        for config in configs:
-            if (config.get("active")) is True:
-                dataset = load_dataset(
-                    config.get("hf_id"),
-                    config.get("config_type"),
-                    split=config.get("split", "train"),
+        all_datasets = [
+            Trainer.format_dataset(config)
+            for config in configs
+            if (config.get("active")) is True
+        ]
+        return Trainer.split_dataset(concatenate_datasets(all_datasets))
+
+    @staticmethod
+    def format_dataset(config, streaming: bool = False):
+        dataset = load_dataset(
+            config.get("hf_id"),
+            config.get("config_type"),
+            split=config.get("split", "train"),
+            streaming=streaming,
+        )
+
+        # Format the text for each example into a new 'text' column, column-wise
+        # over Arrow batches
+        formatter = PatternFormatter(
+            config.get("pattern"), config.get("columns")
+        )
+        if streaming:
+            formatted = dataset.with_format("arrow").map(
+                formatter,
+                batched=True,
+                batch_size=DATASET_FORMAT_BATCH_SIZE,
+                remove_columns=dataset.column_names,
+            )
+            return formatted.with_format(None).select_columns(["text"])
+
+        num_proc = (
+            DATASET_NUM_PROC
+            if DATASET_NUM_PROC > 1
+            and len(dataset) >= DATASET_NUM_PROC_MIN_ROWS
+            else None
+        )
+
+        # Drop the source columns so datasets with different schemas can be
+        # concatenated
+        formatted = dataset.with_format("arrow").map(
+            formatter,
+            batched=True,
+            batch_size=DATASET_FORMAT_BATCH_SIZE,
+            num_proc=num_proc,
+            remove_columns=dataset.column_names,
+        )
+        return formatted.with_format(None)
+
+    @staticmethod
+    def split_dataset(dataset, shuffle: bool = True) -> DatasetDict:
+        """
+        Splits formatted examples into train and test by is_eval_example,
+        shuffling the training examples.
+        """
+        train = dataset.filter(
+            Trainer.train_rows,
+            batched=True,
+            batch_size=DATASET_FORMAT_BATCH_SIZE,
+        )
+        test = dataset.filter(
+            Trainer.eval_rows,
+            batched=True,
+            batch_size=DATASET_FORMAT_BATCH_SIZE,
+        )
+        return DatasetDict(
+            {
+                "train": train.shuffle(seed=SPLIT_SEED) if shuffle else train,
+                "test": test,
+            }
+        )
+
+    @staticmethod
+    def is_streaming(configs, streaming: bool | None = None) -> bool:
+        if streaming is not None:
+            return streaming
+        return any(
+            c.get("active") is True and c.get("streaming") is True
+            for c in configs
+        )
+
+    @staticmethod
+    def stream_datasets(configs, tokenizer):
+        """
+        Lazily interleaves every active dataset, sampling each in proportion to
+        its datasets.json "weight" (default 1), and formats and tokenizes
+        examples as training consumes them, so memory use does not grow with the
+        corpus. Evaluation examples are held out by a hash of their text, so the
+        split is the same on every run and resume.
+        """
+        active = [
+            config for config in configs if (config.get("active")) is True
+        ]
+        weights = [float(config.get("weight", 1)) for config in active]
+        Logger.log(
+            LogLevel.DATA,
+            "Streaming datasets: "
+            + ", ".join(
+                f"'{c.get('name')}' (weight {w})"
+                for c, w in zip(active, weights)
+            ),
+        )
+
+        streams = [
+            Trainer.format_dataset(config, streaming=True) for config in active
+        ]
+        combined = interleave_datasets(
+            streams,
+            probabilities=[w / sum(weights) for w in weights],
+            seed=SPLIT_SEED,
+            stopping_strategy="all_exhausted",
+        )
+
+        train = combined.filter(lambda e: not Trainer.is_eval_example(e))
+        test = combined.filter(Trainer.is_eval_example).take(
+            STREAMING_EVAL_MAX_EXAMPLES
+        )
+        return {
+            "train": Trainer.tokenize_dataset(
+                train.shuffle(
+                    seed=SPLIT_SEED, buffer_size=STREAMING_SHUFFLE_BUFFER_SIZE
+                ),
+                tokenizer,
+            ),
+            "test": Trainer.tokenize_dataset(test, tokenizer),
+        }
+
+    @staticmethod
+    def is_eval_example(example) -> bool:
+        return zlib.crc32(example["text"].encode("utf-8")) % 100 < EVAL_PERCENT
+
+    @staticmethod
+    def eval_rows(batch) -> list[bool]:
+        return [
+            zlib.crc32(text.encode("utf-8")) % 100 < EVAL_PERCENT
+            for text in batch["text"]
+        ]
+
+    @staticmethod
+    def train_rows(batch) -> list[bool]:
+        return [not held_out for held_out in Trainer.eval_rows(batch)]
+
+    @staticmethod
+    def prepare_datasets(configs, tokenizer):
+        """
+        Formats, splits, tokenizes and concatenates every active dataset,
+        reusing on-disk cache entries where possible. Each dataset is cached
+        individually, so editing one datasets.json entry only reprocesses that
+        dataset, and the final split is cached as well so repeat and resumed
+        runs skip preprocessing entirely.
+        """
+        cache = DatasetCache()
+        active = [
+            config for config in configs if (config.get("active")) is True
+        ]
+        fingerprints = [
+            DatasetCache.dataset_fingerprint(
+                config,
+                tokenizer,
+                Trainer.training_max_length(tokenizer),
+                mode=TRAINING_DATA_MODE.value,
+            )
+            for config in active
+        ]
+
+        split_key = DatasetCache.fingerprint("split", fingerprints)
+        split = cache.load(split_key)
+        if split is not None:
+            return split
+
+        tokenized = []
+        for config, key in zip(active, fingerprints):
+            dataset = cache.load(key)
+            if dataset is None:
+                Logger.log(
+                    LogLevel.DATA,
+                    f"Processing dataset '{config.get('name')}'...",
+                )
+                # Split before tokenizing, while the text that decides each
+                # example's side is still there
+                split = Trainer.split_dataset(
+                    Trainer.format_dataset(config), shuffle=False
                 )
+                cache.save(key, Trainer.tokenize_dataset(split, tokenizer))
+                dataset = cache.load(key)
+            tokenized.append(dataset)
 
-                # Format the text for each example into a new 'text' column
-                def format_batch(batch):
-                    pattern = config.get("pattern")
-                    columns = config.get("columns")
-                    formatted_texts = []
-                    num_examples = len(batch[columns[0]])
-                    for i in range(num_examples):
-                        values = []
-                        for col in columns:
-                            val = batch[col][i]
-                            if isinstance(val, dict) and "text" in val:
-                                # Take the first answer if it's a list
-                                values.append(
-                                    val["text"][0]
-                                    if isinstance(val["text"], list) and val["text"]
-                                    else ""
-                                )
-                            else:
-                                values.append(str(val))
-                        formatted_texts.append(pattern.format(*values))
-                    return {"text": formatted_texts}
-
-                formatted_dataset = dataset.map(format_batch, batched=True)
-                all_datasets.append(formatted_dataset)
-            else:
-                pass
-
-        concatenated_dataset = concatenate_datasets(all_datasets)
-        return concatenated_dataset.train_test_split(test_size=0.1, seed=67)
+        split = DatasetDict(
+            {
+                "train": concatenate_datasets(
+                    [d["train"] for d in tokenized]
+                ).shuffle(seed=SPLIT_SEED),
+                "test": concatenate_datasets([d["test"] for d in tokenized]),
+            }
+        )
+        cache.save(split_key, split)
+        return cache.load(split_key)
 
     @staticmethod
     def load_dataset_configs():
-        datasets_path = os.path.join(
-            os.path.abspath(os.path.join(__file__, "../../..")), "datasets.json"
-        )
-        with open(datasets_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
+        return DatasetCache.load_configs()
 
     @staticmethod
     def parse_request_options(request):
@@ -172,6 +528,23 @@ class Trainer:
             == "true"
         )
 
+        hot_swap = (
+            request.args.get(TrainingRequestOpts.HOT_SWAP.value, "true").lower()
+            == "true"
+        )
+
+        # Unset leaves the choice to datasets.json
+        streaming = request.args.get(TrainingRequestOpts.STREAMING.value)
+        if streaming is not None:
+            streaming = streaming.lower() == "true"
+
+        max_steps = request.args.get(
+            TrainingRequestOpts.MAX_STEPS.value, type=int
+        )
+
         return {
+            TrainingRequestOpts.HOT_SWAP: hot_swap,
+            TrainingRequestOpts.MAX_STEPS: max_steps,
             TrainingRequestOpts.RESUME_FROM_CHECKPOINT: resume_from_checkpoint,
+            TrainingRequestOpts.STREAMING: streaming,
         }
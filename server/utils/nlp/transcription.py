@@ -0,0 +1,197 @@
+import numpy as np
+import queue
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from services.audio import AUDIO_SAMPLE_RATE, AudioStreamDecoder
+from services.vad import VAD_MAX_SEGMENT_SECONDS, VoiceActivityDetector
+from utils.logger import Logger, LogLevel
+
+# Streams that receive no audio for this long are assumed abandoned by their
+# client and discarded
+ASR_STREAM_IDLE_SECONDS = 60
+
+
+class TranscriptionStream:
+    """
+    A recording being transcribed while it is uploaded.
+    Audio pieces are decoded and split into utterance segments by voice activity
+    as they arrive, and each finished segment is transcribed in the background
+    while the speaker carries on, so by the time the recording ends only its
+    last segment is left to transcribe.
+    """
+
+    def __init__(
+        self,
+        synthesizer,
+        content_type: str | None = None,
+        options: dict | None = None,
+    ):
+        """
+        (param options): The request options the stream was opened with, applied
+            when it is finished.
+        """
+        self.id = uuid.uuid4().hex
+        self.options = options or {}
+        self.synthesizer = synthesizer
+        self.transcripts = []
+        self.error = None
+        self.updated_at = time.monotonic()
+
+        self._vad = VoiceActivityDetector(AUDIO_SAMPLE_RATE)
+        self._vad_lock = threading.Lock()
+        self._segments = queue.Queue()
+        # Decoded audio is kept until the first segment starts, so that audio
+        # before it which holds sound, or a recording in which voice activity
+        # detection finds no speech at all (e.g. one on a quiet microphone), is
+        # still transcribed rather than dropped
+        self._unsegmented = []
+        self._decoder = AudioStreamDecoder(self._on_samples, content_type)
+        self._worker = threading.Thread(
+            target=self._transcribe_segments,
+            name="asr-stream-worker",
+            daemon=True,
+        )
+        self._worker.start()
+
+    def write(self, data: bytes):
+        self.updated_at = time.monotonic()
+        self._decoder.write(data)
+        if self.error is not None:
+            raise self.error
+
+    def finish(self) -> str:
+        """
+        Ends the recording and returns the full transcript once its remaining
+        segments are transcribed.
+        """
+        self._decoder.close()
+        with self._vad_lock:
+            last = self._vad.flush()
+            remaining = [last] if last is not None else []
+            if self._unsegmented is not None:
+                # No segment ever opened
+                remaining = self._leading_segments(None)
+        for segment in remaining:
+            self._segments.put(segment)
+        self._segments.put(None)
+        self._worker.join()
+
+        if self.error is not None:
+            raise self.error
+        return self.partial()
+
+    def abort(self):
+        self._decoder.abort()
+        with self._vad_lock:
+            self._unsegmented = None
+        self._segments.put(None)
+
+    def partial(self) -> str:
+        return " ".join(t for t in self.transcripts if t)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "partial": self.partial(),
+            "segments": len(self.transcripts),
+            "pending_segments": self._segments.qsize(),
+            "speaking": self._vad.is_speaking(),
+        }
+
+    def _on_samples(self, samples):
+        with self._vad_lock:
+            segments = self._vad.push(samples)
+            leading = []
+            if self._unsegmented is not None:
+                self._unsegmented.append(samples)
+                if self._vad.first_segment_start is not None:
+                    leading = self._leading_segments(
+                        self._vad.first_segment_start
+                    )
+        for segment in leading + segments:
+            self._segments.put(segment)
+
+    def _leading_segments(self, start: int | None) -> list:
+        """
+        The audio before the first segment started (all of it when none has), in
+        pieces Whisper can transcribe, or nothing if it is silent. The
+        unsegmented audio is released afterwards.
+        """
+        leading = (
+            np.concatenate(self._unsegmented)[:start]
+            if self._unsegmented
+            else np.empty(0, dtype=np.float32)
+        )
+        self._unsegmented = None
+        if not VoiceActivityDetector.has_sound(leading, self._vad.frame_size):
+            return []
+        piece = VAD_MAX_SEGMENT_SECONDS * AUDIO_SAMPLE_RATE
+        return [leading[i : i + piece] for i in range(0, len(leading), piece)]
+
+    def _transcribe_segments(self):
+        while (segment := self._segments.get()) is not None:
+            if self.error is not None:
+                continue
+            try:
+                transcription = self.synthesizer.transcribe_audio(segment)
+                self.transcripts.append(transcription.get("text", "").strip())
+            except Exception as e:
+                Logger.log(
+                    LogLevel.ERROR, f"Failed to transcribe audio segment, {e}"
+                )
+                self.error = e
+
+
+class TranscriptionStreams:
+    """
+    The open TranscriptionStreams, by id. Abandoned streams are discarded
+    whenever a new one is opened.
+    """
+
+    def __init__(
+        self, synthesizer, idle_seconds: int = ASR_STREAM_IDLE_SECONDS
+    ):
+        self.synthesizer = synthesizer
+        self.idle_seconds = idle_seconds
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(
+        self, content_type: str | None = None, options: dict | None = None
+    ) -> TranscriptionStream:
+        self._discard_idle()
+        stream = TranscriptionStream(self.synthesizer, content_type, options)
+        with self._lock:
+            self._streams[stream.id] = stream
+        Logger.log(
+            LogLevel.SYNTHESIZER, f"Transcription stream {stream.id} opened."
+        )
+        return stream
+
+    def get(self, stream_id: str) -> TranscriptionStream | None:
+        return self._streams.get(stream_id)
+
+    def close(self, stream_id: str) -> TranscriptionStream | None:
+        with self._lock:
+            return self._streams.pop(stream_id, None)
+
+    def _discard_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                s
+                for s in self._streams.values()
+                if now - s.updated_at > self.idle_seconds
+            ]
+            for stream in idle:
+                del self._streams[stream.id]
+        for stream in idle:
+            Logger.log(
+                LogLevel.SYNTHESIZER,
+                f"Discarding idle transcription stream {stream.id}.",
+            )
+            stream.abort()
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+
+from utils.logger import Logger, LogLevel
+
+
+class StartupState(Enum):
+    STARTING = "starting"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class Startup:
+    """
+    Runs a server's startup pipeline on a background thread, so the server can
+    bind and answer health checks while its models load, and records how long
+    each phase of the pipeline took. Everything here is read from cached state,
+    so is_ready and to_dict are cheap enough to call on every health probe.
+    """
+
+    def __init__(self):
+        self.state = StartupState.STARTING
+        self.error = None
+        # Phase name -> seconds, in the order the phases finished
+        self.phases = {}
+        self._running = {}
+        self._started_at = time.perf_counter()
+        self._finished_at = None
+        self._lock = threading.Lock()
+
+    def start(self, pipeline) -> threading.Thread:
+        """
+        Calls pipeline() on a startup thread; the server is ready once it
+        returns, and failed if it raises.
+        """
+        thread = threading.Thread(
+            target=self._run, args=(pipeline,), name="startup", daemon=True
+        )
+        thread.start()
+        return thread
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the enclosed block as the named phase."""
+        started_at = time.perf_counter()
+        with self._lock:
+            self._running[name] = started_at
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running.pop(name, None)
+                self.phases[name] = round(time.perf_counter() - started_at, 3)
+
+    def parallel(self, steps: dict) -> dict:
+        """
+        Runs each step of a {phase name: callable} dict on its own thread, timed
+        as its own phase, and returns their results by name once all have
+        finished. The first step to raise has its exception re-raised.
+        """
+        with ThreadPoolExecutor(
+            max_workers=len(steps), thread_name_prefix="startup"
+        ) as pool:
+            futures = {
+                name: pool.submit(self._timed, name, step)
+                for name, step in steps.items()
+            }
+            return {name: future.result() for name, future in futures.items()}
+
+    def is_ready(self) -> bool:
+        return self.state == StartupState.READY
+
+    def has_failed(self) -> bool:
+        return self.state == StartupState.FAILED
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            now = time.perf_counter()
+            return {
+                "state": self.state.value,
+                "phases": dict(self.phases),
+                "running": {
+                    name: round(now - at, 3)
+                    for name, at in self._running.items()
+                },
+                "seconds": round(
+                    (self._finished_at or now) - self._started_at, 3
+                ),
+                "error": self.error,
+            }
+
+    def _timed(self, name: str, step):
+        with self.phase(name):
+            return step()
+
+    def _run(self, pipeline):
+        error = None
+        try:
+            pipeline()
+        except Exception as e:
+            error = e
+            Logger.log(LogLevel.ERROR, f"Server startup failed, {e}")
+
+        with self._lock:
+            self._finished_at = time.perf_counter()
+            self.error = str(error) if error is not None else None
+            self.state = (
+                StartupState.FAILED if error is not None else StartupState.READY
+            )
+
+        timings = ", ".join(
+            f"{name} {seconds:.2f} s" for name, seconds in self.phases.items()
+        )
+        Logger.log(
+            LogLevel.INFO,
+            f"Server {self.state.value} after "
+            f"{self._finished_at - self._started_at:.2f} s ({timings}).",
+        )